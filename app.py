@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 from stacks.back_end.serverless_kinesis_producer_stack.serverless_kinesis_producer_stack import ServerlessKinesisProducerStack
+from stacks.back_end.serverless_kinesis_consumer_stack.serverless_kinesis_consumer_stack import ServerlessKinesisConsumerStack
+from stacks.back_end.serverless_eventbridge_consumer_stack.serverless_eventbridge_consumer_stack import ServerlessEventBridgeConsumerStack
 from stacks.back_end.glue_stacks.glue_table_stack import GlueTableStack
 from stacks.back_end.glue_stacks.glue_job_stack import GlueJobStack
 from stacks.back_end.glue_stacks.glue_crawler_stack import GlueCrawlerStack
@@ -16,6 +18,22 @@ serverless_kinesis_producer_stack = ServerlessKinesisProducerStack(
     stack_log_level="INFO",
     description="Miztiik Automation: Kinesis Data Producer on Lambda")
 
+# Kinesis Batch Consumer on Lambda
+serverless_kinesis_consumer_stack = ServerlessKinesisConsumerStack(
+    app,
+    f"{app.node.try_get_context('project')}-consumer-stack",
+    stack_log_level="INFO",
+    src_stream=serverless_kinesis_producer_stack.get_stream,
+    description="Miztiik Automation: Kinesis Batch Consumer on Lambda")
+
+# EventBridge rules & consumer, for the stream events the consumer stack puts on its bus
+serverless_eventbridge_consumer_stack = ServerlessEventBridgeConsumerStack(
+    app,
+    f"{app.node.try_get_context('project')}-events-consumer-stack",
+    stack_log_level="INFO",
+    orders_bus=serverless_kinesis_consumer_stack.get_orders_bus,
+    description="Miztiik Automation: EventBridge Consumer on Lambda")
+
 
 # S3 Bucket to hold our datasources
 etl_bkt_stack = S3Stack(
@@ -56,6 +74,8 @@ glue_crawler_stack = GlueCrawlerStack(
     etl_bkt=etl_bkt_stack.data_bkt,
     etl_bkt_prefix=glue_job_stack.etl_prefix,
     glue_db_name=glue_tbl_stack.glue_db_name.value_as_string,
+    # Partitions are registered by the streaming job, ex: -c crawler_schedule="cron(0 * * * ? *)" to crawl hourly as well
+    schedule_expression=app.node.try_get_context("crawler_schedule"),
     description="Miztiik Automation: Glue Crawler Stack"
 )
 
@@ -16,13 +16,15 @@ class GlueCrawlerStack(cdk.Stack):
         etl_bkt,
         etl_bkt_prefix,
         glue_db_name: str,
+        schedule_expression: str = None,
         **kwargs,
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
         self.template_options.metadata = {"License": "Miztiik Corp."}
 
-        # Glue Crawler
+        # Glue Crawler, a fallback: the streaming job registers the partitions it writes(--catalog_table).
+        # Runs on demand, or on schedule_expression ex: cron(0 * * * ? *)
         sale_txns_crawler = _glue.CfnCrawler(
             self,
             "glueDataLakeCrawler",
@@ -35,14 +37,14 @@ class GlueCrawlerStack(cdk.Stack):
                 "s3Targets": [
                     {
                         "path": f"s3://{etl_bkt.bucket_name}/{etl_bkt_prefix}",
-                        "exclusions": ["checkpoint/**"]
+                        "exclusions": ["checkpoint/**", "_metrics/**", "_manifest/**"]
                     }
                 ]
             },
             configuration="{\"Version\":1.0,\"CrawlerOutput\":{\"Partitions\":{\"AddOrUpdateBehavior\":\"InheritFromTable\"},\"Tables\":{\"AddOrUpdateBehavior\":\"MergeNewColumns\"}}}",
             schedule=_glue.CfnCrawler.ScheduleProperty(
-                schedule_expression="cron(0 * * * ? *)"
-            )
+                schedule_expression=schedule_expression
+            ) if schedule_expression else None
         )
         # Configuration As JSON in human readable format
         """
@@ -0,0 +1,63 @@
+from aws_cdk import aws_glue as _glue
+from aws_cdk import core as cdk
+from stacks.back_end.glue_stacks.glue_job_scripts import catalog_partitions
+from stacks.back_end.glue_stacks.glue_job_scripts import schema_registry
+
+
+class GlueCuratedTable(cdk.Construct):
+    """
+    The parquet output of the streaming etl as a catalog table, partitioned like the job writes it. Partition
+    projection lets athena plan a query from the table parameters alone, no crawler & no partition lookups
+    """
+
+    def __init__(
+        self,
+        scope: cdk.Construct,
+        construct_id: str,
+        glue_db_name: str,
+        table_name: str,
+        location: str,
+        partition_mode: str = "ingest_time",
+        partition_cols: str = "evnt_type",
+        schema_version: str = "latest",
+        **kwargs,
+    ) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+
+        _keys = catalog_partitions.partition_keys(
+            partition_mode, partition_cols)
+        self.table = _glue.CfnTable(
+            self,
+            "glueCuratedTable",
+            catalog_id=cdk.Aws.ACCOUNT_ID,
+            database_name=glue_db_name,
+            table_input=_glue.CfnTable.TableInputProperty(
+                description="Sales transactions in parquet, written by the streaming etl job",
+                name=table_name,
+                table_type="EXTERNAL_TABLE",
+                parameters=dict(
+                    {"classification": "parquet", "EXTERNAL": "TRUE"},
+                    **catalog_partitions.projection_parameters(location, _keys)
+                ),
+                partition_keys=[
+                    _glue.CfnTable.ColumnProperty(name=k, type="string")
+                    for k in _keys
+                ],
+                storage_descriptor=_glue.CfnTable.StorageDescriptorProperty(
+                    # Partition columns are in the path & not in the files
+                    columns=[
+                        _glue.CfnTable.ColumnProperty(
+                            name=c["name"], type=c["type"])
+                        for c in schema_registry.glue_columns(schema_version) if c["name"] not in _keys
+                    ],
+                    location=location,
+                    input_format="org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
+                    output_format="org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
+                    serde_info=_glue.CfnTable.SerdeInfoProperty(
+                        serialization_library="org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe",
+                        parameters={"serialization.format": "1"}
+                    )
+                )
+            )
+        )
+
@@ -0,0 +1,309 @@
+"""
+Adaptive micro-batch window & kinesis fetch limits for the streaming ETL.
+
+After every batch the controller looks at the batch time, the input rows & the consumer lag(age of the oldest
+record of the batch when the batch started) & picks the trigger window & the fetch limits of the query, within
+the configured bounds:
+
+    latency     keep window + batch time under latency_slo_secs. Shrink the window while the batches are short,
+                grow it & the fetch limits when the batches overrun or the lag builds up
+    throughput  fewest, largest batches(& files). Grow the window up to its max while the job keeps up, more
+                records per fetch when it falls behind
+
+Lag while the batches still finish within the window means the fetch limit holds the job back, only the fetch
+settings are raised then.
+
+The signals are smoothed(EWMA) & a change for another reason than the previous one needs cooldown_batches batches
+since that one, a single slow batch does not flap the settings. Spark can not change the trigger or the source options of a running query, a
+change is applied by restarting the query on its checkpoint(stream_etl_core.run_adaptive). Every decision, holds
+included, is logged & handed to audit as JSON lines.
+
+    python batch_controller.py --goal latency --latency-slo-secs 120
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import math
+
+from batch_metrics import _percentile
+
+
+logger = logging.getLogger(__name__)
+
+GOALS = ("latency", "throughput")
+
+
+def _bounds(val, cast=int):
+    lo, hi = (cast(x) for x in val.split(","))
+    return lo, hi
+
+
+def kinesis_options(settings):
+    """ Fetch settings as options of the glue kinesis source """
+    return {
+        "maxFetchRecordsPerShard": str(settings["fetch_records"]),
+        "idleTimeBetweenReadsInMs": str(settings["fetch_interval_ms"]),
+        "addIdleTimeBetweenReads": "true",
+    }
+
+
+class BatchController:
+    def __init__(
+        self,
+        goal="latency",
+        latency_slo_secs=120,
+        window_bounds_secs=(10, 300),
+        fetch_records_bounds=(10000, 500000),
+        fetch_interval_ms_bounds=(200, 5000),
+        window_secs=100,
+        fetch_records=100000,
+        fetch_interval_ms=1000,
+        step=1.5,
+        high_util=0.9,
+        low_util=0.3,
+        target_util=0.6,
+        cooldown_batches=3,
+        alpha=0.5,
+        shards=None,
+        audit=None,
+        max_history=1000,
+    ):
+        if goal not in GOALS:
+            raise ValueError(f"goal must be one of {GOALS}, not {goal}")
+        self.goal = goal
+        self.latency_slo_secs = latency_slo_secs
+        self.window_bounds_secs = window_bounds_secs
+        self.fetch_records_bounds = fetch_records_bounds
+        self.fetch_interval_ms_bounds = fetch_interval_ms_bounds
+        self.step = step
+        self.high_util = high_util
+        self.low_util = low_util
+        self.target_util = target_util
+        self.cooldown_batches = cooldown_batches
+        self.alpha = alpha
+        self.shards = shards
+        self.audit = audit
+        self.max_history = max_history
+        self.settings = {
+            "window_secs": self._clamp(window_secs, window_bounds_secs),
+            "fetch_records": self._clamp(fetch_records, fetch_records_bounds),
+            "fetch_interval_ms": self._clamp(fetch_interval_ms, fetch_interval_ms_bounds),
+        }
+        self.smoothed = {}
+        self.decisions = []
+        self.changes = 0
+        self._since_change = cooldown_batches
+        self._last_change = None
+
+    @classmethod
+    def from_args(cls, args, window_secs=100, shards=None, audit=None):
+        """ From the resolved options of the glue job, None when batch_controller is off """
+        goal = args["batch_controller"].strip().lower()
+        if goal in ("", "off"):
+            return None
+        return cls(
+            goal=goal,
+            latency_slo_secs=int(args["latency_slo_secs"]),
+            window_bounds_secs=_bounds(args["window_bounds_secs"]),
+            fetch_records_bounds=_bounds(args["fetch_records_bounds"]),
+            fetch_interval_ms_bounds=_bounds(args["fetch_interval_ms_bounds"]),
+            window_secs=window_secs,
+            shards=shards,
+            audit=audit,
+        )
+
+    @staticmethod
+    def _clamp(val, bounds):
+        return int(min(max(val, bounds[0]), bounds[1]))
+
+    def _ewma(self, name, val):
+        if val is None:
+            return self.smoothed.get(name)
+        _prev = self.smoothed.get(name)
+        self.smoothed[name] = val if _prev is None else round(
+            self.alpha * val + (1 - self.alpha) * _prev, 3)
+        return self.smoothed[name]
+
+    def _propose(self, batch_secs, lag_secs, rows):
+        """ Next settings & the reason, from the smoothed signals & the rows of the last batch """
+        s = self.settings
+        w = s["window_secs"]
+        util = batch_secs / w
+        # Records waited for more than a trigger before their batch started, the job does not keep up
+        behind = util > self.high_util or lag_secs > w + batch_secs
+        # With a known shard count, a batch that got the most rows the fetch limit allows was cut short by it
+        capped = bool(self.shards) and rows >= 0.95 * \
+            s["fetch_records"] * self.shards
+        new = dict(s)
+        if capped or (behind and util <= self.high_util):
+            # The batches finish in time yet the records wait, the fetch limit is the bottleneck & not the job
+            new["fetch_records"] = s["fetch_records"] * self.step * self.step
+            new["fetch_interval_ms"] = s["fetch_interval_ms"] / self.step
+            reason = "fetch_bound"
+        elif behind:
+            _w = w * self.step
+            if self.goal == "latency":
+                # Larger batches amortize the per batch overhead, as long as window + batch time fits the slo
+                _w = min(_w, max(self.latency_slo_secs - batch_secs, w))
+            new["window_secs"] = _w
+            new["fetch_records"] = s["fetch_records"] * self.step
+            new["fetch_interval_ms"] = s["fetch_interval_ms"] / self.step
+            reason = "behind"
+        elif self.goal == "latency" and w + batch_secs > self.latency_slo_secs:
+            new["window_secs"] = self.latency_slo_secs - batch_secs
+            reason = "over_slo"
+        elif util < self.low_util:
+            if self.goal == "latency":
+                new["window_secs"] = max(
+                    w / self.step, math.ceil(batch_secs / self.target_util))
+            else:
+                new["window_secs"] = w * self.step
+            # Fewer GetRecords calls while the stream is quiet
+            new["fetch_interval_ms"] = s["fetch_interval_ms"] * self.step
+            reason = "idle"
+        else:
+            reason = "on_target"
+        new["window_secs"] = self._clamp(
+            new["window_secs"], self.window_bounds_secs)
+        new["fetch_records"] = self._clamp(
+            new["fetch_records"], self.fetch_records_bounds)
+        new["fetch_interval_ms"] = self._clamp(
+            new["fetch_interval_ms"], self.fetch_interval_ms_bounds)
+        return new, reason
+
+    def observe(self, rec):
+        """ Decision for the batch metrics rec, the new settings are in self.settings """
+        batch_secs = self._ewma("batch_secs", rec.get("batch_secs"))
+        lag_secs = self._ewma("lag_secs", rec.get("lag_secs")) or 0
+        self._ewma("rows", rec.get("row_count") or 0)
+        self._since_change += 1
+        new, reason = self._propose(
+            batch_secs, lag_secs, rec.get("row_count") or 0)
+        action = "hold"
+        if new != self.settings:
+            # Hysteresis, a ramp keeps stepping every batch but turning around waits cooldown_batches
+            if reason != self._last_change and self._since_change < self.cooldown_batches:
+                reason = f"{reason}_cooldown"
+            else:
+                action = "change"
+        decision = {
+            "batch_id": rec.get("batch_id"),
+            "decided_at": datetime.datetime.utcnow().isoformat(),
+            "goal": self.goal,
+            "action": action,
+            "reason": reason,
+            "signals": {
+                "batch_secs": rec.get("batch_secs"),
+                "row_count": rec.get("row_count"),
+                "lag_secs": rec.get("lag_secs"),
+                "smoothed": dict(self.smoothed),
+            },
+            "settings": dict(self.settings),
+        }
+        if action == "change":
+            decision["new_settings"] = new
+            self.settings = new
+            self.changes += 1
+            self._since_change = 0
+            self._last_change = reason
+        self.decisions.append(decision)
+        # Keep the history bounded, the job runs for days
+        self.decisions = self.decisions[-self.max_history:]
+        logger.info(json.dumps({"batch_controller": decision}))
+        if self.audit:
+            try:
+                self.audit("\n".join(json.dumps(d) for d in self.decisions))
+            except Exception as e:
+                logger.warning(json.dumps(
+                    {"controller_audit_write_failed": str(e)}))
+        return decision
+
+
+def simulate(controller, profile, shards=2, overhead_secs=8.0, row_secs=1 / 4000, restart_secs=20, window_secs=100):
+    """
+    A kinesis stream with arrivals per second from profile & a job with a fixed per batch overhead & a cost per row.
+    No controller: the static window_secs. Record latency is arrival to the end of its batch
+    """
+    s = controller.settings if controller else {
+        "window_secs": window_secs, "fetch_records": 10 ** 9, "fetch_interval_ms": 1000}
+    backlog = []  # [arrival_sec, rows]
+    fed = 0
+    t = 0.0
+    lat, lag, batches, overruns, rows_done = [], [], 0, 0, 0
+    get_records = 0.0
+    while fed < len(profile) or backlog:
+        while fed < min(len(profile), int(t) + 1):
+            backlog.append([fed, profile[fed]])
+            fed += 1
+        cap = s["fetch_records"] * shards
+        take, rows = [], 0
+        while backlog and rows < cap:
+            n = min(backlog[0][1], cap - rows)
+            take.append((backlog[0][0], n))
+            rows += n
+            backlog[0][1] -= n
+            if not backlog[0][1]:
+                backlog.pop(0)
+        batch_secs = overhead_secs + rows * row_secs if rows else 0.5
+        end = t + batch_secs
+        if rows:
+            batches += 1
+            rows_done += rows
+            lag.append(t - take[0][0])
+            lat.extend([end - a] * max(1, n // 100) for a, n in take)
+            if batch_secs > s["window_secs"]:
+                overruns += 1
+        get_records += shards * max(end - t, s["window_secs"]) * \
+            1000 / s["fetch_interval_ms"]
+        nxt = max(end, t + s["window_secs"])
+        if controller and rows:
+            _before = dict(controller.settings)
+            controller.observe({"batch_id": batches, "batch_secs": round(batch_secs, 3),
+                                "row_count": rows, "lag_secs": round(t - take[0][0], 1)})
+            if controller.settings != _before:
+                s = controller.settings
+                # Stop after this batch & restart the query with the new settings
+                nxt = end + restart_secs
+        t = nxt
+    lat = [x for chunk in lat for x in chunk]
+    return {
+        "batches": batches,
+        "rows": rows_done,
+        "batches_over_window": overruns,
+        "latency_secs": {"p50": round(_percentile(lat, 50), 1), "p95": round(_percentile(lat, 95), 1),
+                         "max": round(max(lat), 1)},
+        "max_lag_secs": round(max(lag), 1),
+        "get_records_calls": int(get_records),
+        "setting_changes": controller.changes if controller else 0,
+        "final_settings": s,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Simulate the controller against a quiet, peak, quiet load profile")
+    parser.add_argument("--goal", choices=GOALS, nargs="+", default=list(GOALS))
+    parser.add_argument("--latency-slo-secs", type=int, default=120)
+    parser.add_argument("--window-bounds-secs", default="10,300")
+    parser.add_argument("--quiet-rows-per-sec", type=int, default=50)
+    parser.add_argument("--peak-rows-per-sec", type=int, default=3000)
+    parser.add_argument("--phase-mins", type=int, default=20)
+    parser.add_argument("--shards", type=int, default=2)
+    parser.add_argument("--audit", action="store_true",
+                        help="Print every decision")
+    cli = parser.parse_args()
+
+    _phase = cli.phase_mins * 60
+    _profile = [cli.quiet_rows_per_sec] * _phase + \
+        [cli.peak_rows_per_sec] * _phase + [cli.quiet_rows_per_sec] * _phase
+    res = {"static_100_secs": simulate(None, _profile, shards=cli.shards)}
+    for goal in cli.goal:
+        ctl = BatchController(goal=goal, latency_slo_secs=cli.latency_slo_secs,
+                              window_bounds_secs=_bounds(cli.window_bounds_secs), shards=cli.shards)
+        res[goal] = simulate(ctl, _profile, shards=cli.shards)
+        if cli.audit:
+            for d in ctl.decisions:
+                print(json.dumps(d))
+    print(json.dumps(res, indent=2))
@@ -0,0 +1,154 @@
+"""
+Per micro-batch instrumentation for the streaming ETL.
+
+Every batch gets one structured log line & optionally CloudWatch metrics. A rolling JSON summary
+of the whole run is handed to write_summary after every batch.
+"""
+
+import datetime
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+_CW_UNITS = {
+    "row_count": "Count",
+    "input_bytes": "Bytes",
+    "parse_secs": "Seconds",
+    "write_secs": "Seconds",
+    "files_written": "Count",
+    "bad_rows": "Count",
+    "bad_record_rate": "None",
+    "dedup_state_rows": "Count",
+    "dedup_state_bytes": "Bytes",
+    "duplicates_dropped": "Count",
+    "dedup_rows_dropped": "Count",
+    "rollup_late_rows": "Count",
+    "lag_secs": "Seconds",
+    "partitions_failed": "Count",
+    "batch_secs": "Seconds",
+}
+
+
+def _percentile(vals, p):
+    if not vals:
+        return None
+    vals = sorted(vals)
+    return vals[int(round(p / 100 * (len(vals) - 1)))]
+
+
+class BatchRecord(dict):
+    """ Metrics of a single micro-batch, a dict so it logs as is """
+
+    def __init__(self, batch_id):
+        super().__init__(batch_id=batch_id, started_at=datetime.datetime.utcnow().isoformat())
+        self.started_ms = int(time.time() * 1000)
+        self._t0 = time.perf_counter()
+
+    @contextmanager
+    def timed(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self[name] = round(self.get(name, 0) +
+                               time.perf_counter() - t, 3)
+
+    def close(self):
+        self["batch_secs"] = round(time.perf_counter() - self._t0, 3)
+
+
+class BatchMetrics:
+    def __init__(self, job_name, window_secs=None, namespace=None, cw_client=None, write_summary=None, max_history=1000):
+        self.job_name = job_name
+        self.window_secs = window_secs
+        self.namespace = namespace
+        self.cw_client = cw_client
+        self.write_summary = write_summary
+        self.max_history = max_history
+        self.run_started_at = datetime.datetime.utcnow().isoformat()
+        self.batches = 0
+        self.empty_batches = 0
+        self.tot_rows = 0
+        self.tot_input_bytes = 0
+        self.tot_files = 0
+        self.tot_bad_rows = 0
+        self.over_window = 0
+        self._durations = []
+        self._slowest = None
+
+    def start(self, batch_id):
+        return BatchRecord(batch_id)
+
+    def empty(self, rec):
+        self.empty_batches += 1
+        logger.debug(json.dumps({"empty_batch": rec["batch_id"]}))
+
+    def finish(self, rec):
+        rec.close()
+        self.batches += 1
+        self.tot_rows += rec.get("row_count") or 0
+        self.tot_input_bytes += rec.get("input_bytes") or 0
+        self.tot_files += rec.get("files_written") or 0
+        self.tot_bad_rows += rec.get("bad_rows") or 0
+        if self.window_secs and rec["batch_secs"] > self.window_secs:
+            rec["over_window"] = True
+            self.over_window += 1
+        self._durations.append(rec["batch_secs"])
+        # Keep the history bounded, the job runs for days
+        self._durations = self._durations[-self.max_history:]
+        if self._slowest is None or rec["batch_secs"] > self._slowest["batch_secs"]:
+            self._slowest = dict(rec)
+
+        logger.info(json.dumps({"batch_metrics": rec}))
+        self._put_metrics(rec)
+        if self.write_summary:
+            try:
+                self.write_summary(json.dumps(self.summary(), indent=2))
+            except Exception as e:
+                logger.warning(json.dumps(
+                    {"run_summary_write_failed": str(e)}))
+
+    def _put_metrics(self, rec):
+        if not (self.namespace and self.cw_client):
+            return
+        _data = [
+            {
+                "MetricName": k,
+                "Dimensions": [{"Name": "JobName", "Value": self.job_name}],
+                "Value": float(rec[k]),
+                "Unit": u,
+            }
+            for k, u in _CW_UNITS.items() if rec.get(k) is not None
+        ]
+        try:
+            self.cw_client.put_metric_data(
+                Namespace=self.namespace, MetricData=_data)
+        except Exception as e:
+            # Metrics must never fail a batch
+            logger.warning(json.dumps({"put_metric_data_failed": str(e)}))
+
+    def summary(self):
+        return {
+            "job_name": self.job_name,
+            "run_started_at": self.run_started_at,
+            "updated_at": datetime.datetime.utcnow().isoformat(),
+            "window_secs": self.window_secs,
+            "batches": self.batches,
+            "empty_batches": self.empty_batches,
+            "batches_over_window": self.over_window,
+            "rows": self.tot_rows,
+            "input_bytes": self.tot_input_bytes,
+            "files_written": self.tot_files,
+            "bad_rows": self.tot_bad_rows,
+            "bad_record_rate": round(self.tot_bad_rows / self.tot_rows, 4) if self.tot_rows else 0,
+            "batch_secs": {
+                "p50": _percentile(self._durations, 50),
+                "p95": _percentile(self._durations, 95),
+                "max": max(self._durations) if self._durations else None,
+            },
+            "slowest_batch": self._slowest,
+        }
@@ -0,0 +1,344 @@
+"""
+Partitions of the stream-etl table registered in the glue data catalog by the streaming job itself.
+
+The hourly crawler leaves a new partition invisible to athena for up to an hour & re-lists the whole prefix on
+every run. After every batch the job registers the partitions it wrote: the ones it has already seen are skipped
+from an in memory cache, the new ones go out in BatchCreatePartition calls of up to 100. The table is created
+on the first write, from the schema of the written rows, when it does not exist yet. A partition that fails to
+register stays out of the cache & is tried again with the next batch it gets rows in, the crawler remains as an
+on demand fallback.
+
+LocalCatalog stands in for the glue api, it keeps the catalog in a json file. To compare the calls per batch
+with & without the cache, over a day of batches,
+
+    python catalog_partitions.py /tmp/local-catalog.json --batches 1440 --fail-rate 0.05
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import random
+import time
+
+# botocore ships with glue & boto3, the local stand-in raises the same errors when it is around
+try:
+    from botocore.exceptions import ClientError
+except ImportError:
+    ClientError = None
+
+
+logger = logging.getLogger(__name__)
+
+# BatchCreatePartition takes at most 100 partitions per call
+MAX_BATCH = 100
+INGEST_KEYS = ["ingest_year", "ingest_month", "ingest_day", "ingest_hour"]
+EVENT_TIME_KEYS = ["evnt_date", "evnt_hour"]
+# Values of the enum partition columns, the etl writes the events without one to "unknown"
+PARTITION_ENUMS = {"evnt_type": ["sales-events", "inventory-events", "unknown"]}
+# Oldest date or year the partition projection covers
+PROJECTION_START = "2021-01-01"
+
+
+def partition_keys(partition_mode="ingest_time", partition_cols="evnt_type"):
+    """ Partition keys of the etl output in path order, partition_cols only apply to event_time """
+    if partition_mode.lower() != "event_time":
+        return list(INGEST_KEYS)
+    return EVENT_TIME_KEYS + [c.strip() for c in partition_cols.split(",") if c.strip()]
+
+
+def ingest_values(now):
+    """ INGEST_KEYS values of a wall clock time """
+    return tuple(now.strftime(f) for f in ("%Y", "%m", "%d", "%H"))
+
+
+def partition_path(root, keys, values):
+    return root.rstrip("/") + "/" + "".join(f"{k}={v}/" for k, v in zip(keys, values))
+
+
+def projection_parameters(location, keys):
+    """
+    Athena partition projection of the etl output, table parameters. Events a day ahead of the clock still
+    project, the columns without known values are injected & must be in the WHERE clause
+    """
+    _year = PROJECTION_START[:4]
+    _ranges = {
+        "ingest_year": ("integer", {"range": f"{_year},2099", "digits": "4"}),
+        "ingest_month": ("integer", {"range": "1,12", "digits": "2"}),
+        "ingest_day": ("integer", {"range": "1,31", "digits": "2"}),
+        "ingest_hour": ("integer", {"range": "0,23", "digits": "2"}),
+        "evnt_date": ("date", {"format": "yyyy-MM-dd", "range": f"{PROJECTION_START},NOW+1DAYS"}),
+        "evnt_hour": ("integer", {"range": "0,23", "digits": "2"}),
+    }
+    params = {"projection.enabled": "true"}
+    for k in keys:
+        if k in _ranges:
+            _type, _props = _ranges[k]
+        elif k in PARTITION_ENUMS:
+            _type, _props = "enum", {"values": ",".join(PARTITION_ENUMS[k])}
+        else:
+            _type, _props = "injected", {}
+        params[f"projection.{k}.type"] = _type
+        params.update({f"projection.{k}.{p}": v for p, v in _props.items()})
+    params["storage.location.template"] = partition_path(
+        location, keys, [f"${{{k}}}" for k in keys])
+    return params
+
+
+def _error_code(e):
+    return getattr(e, "response", {}).get("Error", {}).get("Code")
+
+
+def _storage_descriptor(location, columns):
+    """ Parquet storage of the table & every partition """
+    return {
+        "Columns": columns,
+        "Location": location,
+        "InputFormat": "org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
+        "OutputFormat": "org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
+        "SerdeInfo": {
+            "SerializationLibrary": "org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe",
+            "Parameters": {"serialization.format": "1"},
+        },
+    }
+
+
+def columns_of(schema, partition_keys=()):
+    """ Glue columns of a spark schema, the partition keys are not stored in the files """
+    return [{"name": f.name, "type": f.dataType.simpleString()}
+            for f in schema.fields if f.name not in partition_keys]
+
+
+class PartitionRegistrar:
+    def __init__(self, glue_client, database, table, location, partition_keys, batch_size=MAX_BATCH, max_attempts=3):
+        self.glue = glue_client
+        self.database = database
+        self.table = table
+        self.location = location.rstrip("/") + "/"
+        self.partition_keys = list(partition_keys)
+        self.batch_size = min(batch_size, MAX_BATCH)
+        self.max_attempts = max_attempts
+        # Partition values already in the catalog, registered by this run or found to exist
+        self.known = set()
+        self._table_ready = False
+        self.calls = 0
+
+    def partition_location(self, values):
+        return partition_path(self.location, self.partition_keys, values)
+
+    def ensure_table(self, columns):
+        """ Create the table on the first write, an existing one must have the same partition keys """
+        if self._table_ready:
+            return False
+        created = False
+        try:
+            self.calls += 1
+            _keys = [k["Name"] for k in self.glue.get_table(
+                DatabaseName=self.database, Name=self.table)["Table"].get("PartitionKeys", [])]
+            if _keys != self.partition_keys:
+                raise ValueError(
+                    f"{self.database}.{self.table} is partitioned by {_keys}, the job writes {self.partition_keys}")
+        except Exception as e:
+            if _error_code(e) != "EntityNotFoundException":
+                raise
+            try:
+                self.calls += 1
+                self.glue.create_table(
+                    DatabaseName=self.database,
+                    TableInput={
+                        "Name": self.table,
+                        "Description": "Sales transactions in parquet, partitions registered by the streaming etl job",
+                        "TableType": "EXTERNAL_TABLE",
+                        "Parameters": {"classification": "parquet", "EXTERNAL": "TRUE"},
+                        "PartitionKeys": [{"Name": k, "Type": "string"} for k in self.partition_keys],
+                        "StorageDescriptor": _storage_descriptor(self.location, columns),
+                    }
+                )
+                created = True
+            except Exception as e:
+                # Created by a concurrent run or the crawler in between
+                if _error_code(e) != "AlreadyExistsException":
+                    raise
+        self._table_ready = True
+        return created
+
+    def _create(self, values, columns):
+        """ One BatchCreatePartition call, returns the values that failed for another reason than already existing """
+        self.calls += 1
+        resp = self.glue.batch_create_partition(
+            DatabaseName=self.database,
+            TableName=self.table,
+            PartitionInputList=[
+                {"Values": list(v), "StorageDescriptor": _storage_descriptor(
+                    self.partition_location(v), columns)}
+                for v in values
+            ]
+        )
+        failed = {}
+        for err in resp.get("Errors", []):
+            if err["ErrorDetail"]["ErrorCode"] != "AlreadyExistsException":
+                failed[tuple(err["PartitionValues"])
+                       ] = err["ErrorDetail"]["ErrorCode"]
+        return failed
+
+    def register(self, partition_values, columns):
+        """ Registers the partitions not seen before, partition_values are tuples in partition_keys order """
+        _calls = self.calls
+        res = {"table_created": self.ensure_table(columns)}
+        new = [v for v in dict.fromkeys(tuple(str(x) for x in v) for v in partition_values)
+               if v not in self.known]
+        failed = {}
+        for i in range(0, len(new), self.batch_size):
+            pending = new[i:i + self.batch_size]
+            for attempt in range(self.max_attempts):
+                try:
+                    failed = self._create(pending, columns)
+                except Exception as e:
+                    if _error_code(e) not in ("ThrottlingException", "InternalServiceException", "OperationTimeoutException"):
+                        raise
+                    failed = {v: _error_code(e) for v in pending}
+                self.known.update(v for v in pending if v not in failed)
+                pending = [v for v in pending if v in failed]
+                if not pending:
+                    break
+                time.sleep(min(0.1 * 2 ** attempt, 2))
+            if pending:
+                logger.warning(json.dumps({"catalog_partitions_failed": {
+                    "table": self.table, "count": len(pending), "errors": sorted(set(failed.values()))}}))
+        res.update({
+            "partitions_new": len(new),
+            "partitions_failed": sum(1 for v in new if v not in self.known),
+            "catalog_calls": self.calls - _calls,
+        })
+        return res
+
+
+class LocalCatalog:
+    """
+    In memory glue catalog with the request & response shapes of the boto3 glue client, persisted to path if given.
+    fail_rate makes that share of the partitions of a BatchCreatePartition fail with InternalServiceException
+    """
+
+    def __init__(self, path=None, fail_rate=0.0, seed=7):
+        self.path = path
+        self.fail_rate = fail_rate
+        self._rnd = random.Random(seed)
+        self.tables = {}
+        self.partitions = {}
+        self.calls = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                _saved = json.load(f)
+            self.tables = _saved["tables"]
+            self.partitions = {k: {tuple(json.loads(v)): p for v, p in parts.items()}
+                               for k, parts in _saved["partitions"].items()}
+
+    def _error(self, code, op):
+        if ClientError is None:
+            e = Exception(code)
+            e.response = {"Error": {"Code": code}}
+            return e
+        return ClientError({"Error": {"Code": code, "Message": code}}, op)
+
+    def _call(self, op):
+        self.calls[op] = self.calls.get(op, 0) + 1
+
+    def _save(self):
+        if not self.path:
+            return
+        with open(self.path, "w") as f:
+            json.dump({"tables": self.tables,
+                       "partitions": {k: {json.dumps(list(v)): p for v, p in parts.items()}
+                                      for k, parts in self.partitions.items()}}, f, indent=2, default=str)
+
+    def get_table(self, DatabaseName, Name):
+        self._call("GetTable")
+        _key = f"{DatabaseName}.{Name}"
+        if _key not in self.tables:
+            raise self._error("EntityNotFoundException", "GetTable")
+        return {"Table": self.tables[_key]}
+
+    def create_table(self, DatabaseName, TableInput):
+        self._call("CreateTable")
+        _key = f"{DatabaseName}.{TableInput['Name']}"
+        if _key in self.tables:
+            raise self._error("AlreadyExistsException", "CreateTable")
+        self.tables[_key] = dict(TableInput, DatabaseName=DatabaseName,
+                                 CreateTime=datetime.datetime.utcnow().isoformat())
+        self.partitions[_key] = {}
+        self._save()
+        return {}
+
+    def batch_create_partition(self, DatabaseName, TableName, PartitionInputList):
+        self._call("BatchCreatePartition")
+        _key = f"{DatabaseName}.{TableName}"
+        if _key not in self.tables:
+            raise self._error("EntityNotFoundException",
+                              "BatchCreatePartition")
+        if len(PartitionInputList) > MAX_BATCH:
+            raise self._error("ValidationException", "BatchCreatePartition")
+        errors = []
+        for p in PartitionInputList:
+            vals = tuple(p["Values"])
+            if vals in self.partitions[_key]:
+                code = "AlreadyExistsException"
+            elif self._rnd.random() < self.fail_rate:
+                code = "InternalServiceException"
+            else:
+                self.partitions[_key][vals] = dict(
+                    p, CreationTime=datetime.datetime.utcnow().isoformat())
+                continue
+            errors.append({"PartitionValues": list(vals), "ErrorDetail": {
+                          "ErrorCode": code, "ErrorMessage": code}})
+        self._save()
+        return {"Errors": errors}
+
+    def get_partitions(self, DatabaseName, TableName):
+        self._call("GetPartitions")
+        return {"Partitions": [dict(p, Values=list(v)) for v, p in
+                               self.partitions.get(f"{DatabaseName}.{TableName}", {}).items()]}
+
+
+def _simulate(cli):
+    """ A day of batches, each writing to the partitions of its hour, with & without the cache """
+    _columns = [{"name": c, "type": "string"} for c in ("request_id", "store_id", "sales")]
+    _types = ["sales-events", "inventory-events"]
+    res = {}
+    for mode in ("cached", "uncached"):
+        if os.path.exists(cli.catalog):
+            os.remove(cli.catalog)
+        glue = LocalCatalog(cli.catalog, fail_rate=cli.fail_rate)
+        reg = PartitionRegistrar(glue, "miztiik_sales_db", "sales_txns_stream_etl_curated",
+                                 "s3://bkt/stream-etl/", ["evnt_date", "evnt_hour", "evnt_type"])
+        t = time.perf_counter()
+        failed = 0
+        for b in range(cli.batches):
+            _ts = datetime.datetime(2021, 3, 20) + \
+                datetime.timedelta(seconds=b * 86400 / cli.batches)
+            # Late events of the previous hour come in with the current ones
+            _hours = {_ts, _ts - datetime.timedelta(minutes=10)}
+            vals = [(h.strftime("%Y-%m-%d"), h.strftime("%H"), e)
+                    for h in _hours for e in _types]
+            if mode == "uncached":
+                reg.known.clear()
+            failed += reg.register(vals, _columns)["partitions_failed"]
+        res[mode] = {
+            "batches": cli.batches,
+            "partitions": len(glue.get_partitions(reg.database, reg.table)["Partitions"]),
+            "batch_create_partition_calls": glue.calls.get("BatchCreatePartition", 0),
+            "calls_per_batch": round(sum(glue.calls.values()) / cli.batches, 2),
+            "partitions_failed": failed,
+            "secs": round(time.perf_counter() - t, 3),
+        }
+    return res
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Register a day of stream-etl partitions in a local stand-in of the glue catalog")
+    parser.add_argument("catalog", help="Local catalog json file")
+    parser.add_argument("--batches", type=int, default=1440)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    cli = parser.parse_args()
+    print(json.dumps(_simulate(cli), indent=2))
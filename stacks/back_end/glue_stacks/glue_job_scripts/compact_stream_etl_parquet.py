@@ -0,0 +1,80 @@
+import sys
+from awsglue.utils import getResolvedOptions
+from pyspark.context import SparkContext
+from awsglue.context import GlueContext
+from awsglue.job import Job
+import json
+import logging
+# Shipped with --extra-py-files
+import parquet_compaction
+import sales_rollups
+import table_manifest
+from parquet_layout import ParquetLayout
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.getLogger("parquet_compaction").setLevel(logging.INFO)
+
+# @params: [JOB_NAME]
+args = getResolvedOptions(sys.argv, [
+    "JOB_NAME",
+    "datalake_bkt_name",
+    "datalake_bkt_prefix",
+    "target_file_mb",
+    "small_file_mb",
+    "min_small_files",
+    "closed_after_mins",
+    "gold_prefix",
+    "dry_run",
+    "table_manifest",
+    "manifest_lock_table",
+    "parquet_codec",
+    "parquet_row_group_mb",
+    "parquet_page_kb",
+    "parquet_dictionary",
+    "sort_cols"
+])
+
+sc = SparkContext()
+glueContext = GlueContext(sc)
+spark = glueContext.spark_session
+job = Job(glueContext)
+job.init(args["JOB_NAME"], args)
+
+logger.info(f'{{"starting_job": "{args["JOB_NAME"]}"}}')
+
+_opts = {
+    "target_bytes": int(float(args["target_file_mb"]) * 1024 * 1024),
+    "small_file_bytes": int(float(args["small_file_mb"]) * 1024 * 1024),
+    "min_files": int(args["min_small_files"]),
+    "closed_after_secs": int(args["closed_after_mins"]) * 60,
+    "dry_run": args["dry_run"].lower() == "true",
+    # The compacted files are the long lived ones, sorted & with row groups small enough to prune
+    "layout": ParquetLayout.from_args(args)
+}
+
+_etl_root = f"s3://{args['datalake_bkt_name']}/{args['datalake_bkt_prefix']}"
+# The swaps are committed to the commit log of the streaming job, readers of the manifest never see both file sets
+summary = parquet_compaction.run(
+    spark,
+    _etl_root,
+    manifest=table_manifest.TableManifest(
+        table_manifest.manifest_fs(
+            spark, _etl_root, None if args["manifest_lock_table"].lower() == "off" else args["manifest_lock_table"]),
+        _etl_root) if args["table_manifest"].lower() == "true" else None,
+    **_opts
+)
+logger.info(json.dumps({"compaction_summary": summary}))
+
+# The gold partials of closed partitions are merged, one row per window & dims
+gold_summary = parquet_compaction.run(
+    spark,
+    f"s3://{args['datalake_bkt_name']}/{args['gold_prefix']}",
+    rewrite=sales_rollups.merge_partials,
+    checksum=sales_rollups.checksum,
+    **_opts
+)
+logger.info(json.dumps({"gold_compaction_summary": gold_summary}))
+
+job.commit()
@@ -4,14 +4,19 @@ from awsglue.utils import getResolvedOptions
 from pyspark.context import SparkContext
 from awsglue.context import GlueContext
 from awsglue.job import Job
-from pyspark.sql import DataFrame, Row
-import datetime
+import boto3
 import logging
 from awsglue import DynamicFrame
+# Shipped with --extra-py-files, the glue free part of the ETL
+from batch_controller import BatchController, kinesis_options
+from stream_etl_core import EtlConfig, StreamEtl, run_adaptive
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
+logging.getLogger("stream_etl_core").setLevel(logging.INFO)
+logging.getLogger("batch_metrics").setLevel(logging.INFO)
+logging.getLogger("batch_controller").setLevel(logging.INFO)
 
 # @params: [JOB_NAME]
 args = getResolvedOptions(sys.argv, [
@@ -19,7 +24,35 @@ args = getResolvedOptions(sys.argv, [
     "src_db_name",
     "src_tbl_name",
     "datalake_bkt_name",
-    "datalake_bkt_prefix"
+    "datalake_bkt_prefix",
+    "src_stream_name",
+    "src_stream_endpoint",
+    "kpl_aggregated",
+    "wire_format",
+    "compressed_frames",
+    "persist_batch",
+    "schema_version",
+    "quarantine_prefix",
+    "dedup_watermark",
+    "gold_prefix",
+    "rollup_watermark",
+    "partition_mode",
+    "partition_cols",
+    "metrics_namespace",
+    "batch_controller",
+    "latency_slo_secs",
+    "window_bounds_secs",
+    "fetch_records_bounds",
+    "fetch_interval_ms_bounds",
+    "table_manifest",
+    "manifest_lock_table",
+    "parquet_codec",
+    "parquet_row_group_mb",
+    "parquet_page_kb",
+    "parquet_dictionary",
+    "sort_cols",
+    "catalog_db",
+    "catalog_table"
 ])
 
 sc = SparkContext()
@@ -30,47 +63,82 @@ job.init(args["JOB_NAME"], args)
 
 logger.info(f'{{"starting_job": "{args["JOB_NAME"]}"}}')
 
-data_frame_datasource0 = glueContext.create_data_frame.from_catalog(
-    database=args["src_db_name"],
-    table_name=args["src_tbl_name"],
-    transformation_ctx="datasource0",
-    additional_options={
-        "startingPosition": "TRIM_HORIZON", "inferSchema": "true"}
+WINDOW_SECS = 100
+cfg = EtlConfig.from_args(args, window_secs=WINDOW_SECS)
+
+
+def _glue_writer(data_frame, path, partition_keys=None, ctx=None):
+    """ The sinks of StreamEtl, as DynamicFrames through the glue s3 sink """
+    _sink_options = {"path": path}
+    if partition_keys:
+        _sink_options["partitionKeys"] = partition_keys
+    glueContext.write_dynamic_frame.from_options(
+        frame=DynamicFrame.fromDF(data_frame, glueContext, f"from_{ctx}"),
+        connection_type="s3",
+        connection_options=_sink_options,
+        format="parquet",
+        format_options=cfg.parquet_layout.format_options(),
+        transformation_ctx=ctx
+    )
+
+
+# off: the fixed WINDOW_SECS & default fetch options. latency|throughput: adapted between batches, see batch_controller.py
+controller = BatchController.from_args(
+    args,
+    window_secs=WINDOW_SECS,
+    audit=lambda txt: etl.write_text(
+        f"{cfg.etl_root}_metrics/controller_audit_{args['JOB_NAME']}_{cfg.run_id}.jsonl", txt)
+)
+
+etl = StreamEtl(
+    spark,
+    cfg,
+    writer=_glue_writer,
+    cw_client=boto3.client("cloudwatch") if cfg.metrics_namespace else None,
+    controller=controller,
+    glue_client=boto3.client("glue") if cfg.catalog_table else None
 )
 
 
-def processBatch(data_frame, batchId):
-    if (data_frame.count() > 0):
-        datasource0 = DynamicFrame.fromDF(
-            data_frame, glueContext, "from_data_frame")
-        now = datetime.datetime.now()
-        year = now.year
-        month = now.month
-        day = now.day
-        hour = now.hour
-        minute = now.minute
-        path_datasink1 = f"s3://{args['datalake_bkt_name']}/{args['datalake_bkt_prefix']}" + "/ingest_year=" + "{:0>4}".format(str(year)) + "/ingest_month=" + "{:0>2}".format(
-            str(month)) + "/ingest_day=" + "{:0>2}".format(str(day)) + "/ingest_hour=" + "{:0>2}".format(str(hour)) + "/"
-        datasink1 = glueContext.write_dynamic_frame.from_options(
-            frame=datasource0,
-            connection_type="s3",
-            connection_options={
-                "path": path_datasink1
-            },
-            format="parquet",
-            transformation_ctx="datasink1"
+def _source(settings=None):
+    """ The kinesis stream, with the fetch settings of the controller when there is one """
+    _fetch = kinesis_options(settings) if settings else {}
+    if controller:
+        # Shards come & go with resharding, the fetch limit is per shard
+        controller.shards = boto3.client("kinesis").describe_stream_summary(
+            StreamName=args["src_stream_name"])["StreamDescriptionSummary"]["OpenShardCount"]
+    if cfg.raw_source:
+        # Read the raw kinesis payload & parse it on the stream, binary records through python, json in the JVM
+        _reader = (
+            spark.readStream.format("kinesis")
+            .option("streamName", args["src_stream_name"])
+            .option("endpointUrl", args["src_stream_endpoint"])
+            .option("startingPosition", "TRIM_HORIZON")
         )
-        logger.info(f'{{"batch_process_successful":True}}')
+        for k, v in _fetch.items():
+            _reader = _reader.option(k, v)
+        return _reader.load()
+    return glueContext.create_data_frame.from_catalog(
+        database=args["src_db_name"],
+        table_name=args["src_tbl_name"],
+        transformation_ctx="datasource0",
+        additional_options={
+            "startingPosition": "TRIM_HORIZON", "inferSchema": "true", **_fetch}
+    )
 
 
-glueContext.forEachBatch(
-    frame=data_frame_datasource0,
-    batch_function=processBatch,
-    options={
-        "windowSize": "100 seconds",
-        "checkpointLocation": f"s3://{args['datalake_bkt_name']}/{args['datalake_bkt_prefix']}/checkpoint"
-        # "s3://raw-data-bkt-010/stream-etl/checkpoint/"
-    }
-)
+if controller:
+    # The trigger & source options of a running query are fixed, a change restarts the query on its checkpoint
+    run_adaptive(etl, _source, f"{cfg.etl_root}checkpoint")
+else:
+    glueContext.forEachBatch(
+        frame=etl.prepare(_source()),
+        batch_function=etl.process_batch,
+        options={
+            "windowSize": f"{WINDOW_SECS} seconds",
+            "checkpointLocation": f"{cfg.etl_root}checkpoint"
+            # "s3://raw-data-bkt-010/stream-etl/checkpoint/"
+        }
+    )
 
 job.commit()
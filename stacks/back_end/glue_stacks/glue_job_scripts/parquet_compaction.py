@@ -0,0 +1,327 @@
+"""
+Small file compaction for the stream-etl parquet prefix.
+
+Every closed partition(no new file for closed_after_secs) with at least min_files small files gets those files
+rewritten into target sized ones. Works with any hadoop filesystem, s3:// on glue & file:// on a laptop.
+
+The swap of a partition:
+    1. The compacted files are written to <partition>/_compaction_<run_id>/, hidden from spark, athena & the crawler
+    2. Row counts(or the checksum of a rewrite) of the old & new files are compared, any mismatch aborts the partition
+    3. A journal(_SWAP.json) with the old & new files is written to the staging directory
+    4. New files are moved into the partition, then the old ones are deleted
+Readers never see the partition without its rows, but the swap is not atomic for the readers listing the
+partition(athena, the crawler, spark on the path): between the first move & the last delete they see both the
+old & the new files & count those rows twice. On S3 a move is a copy & a delete, the window is seconds per file,
+the swap_window_ms of every partition. Only closed partitions are compacted, closed_after_secs must be past the
+last late writer & past the last reader of a partition, ex: the hourly jobs reading an ingest_hour.
+A run that dies mid swap is rolled forward from the journal by the next run, staging directories without a
+journal are dropped.
+
+With a table manifest(table_manifest.py) only the files live in it are compacted & every swap is one commit to
+it, the new files added & the old ones removed, before the old files are deleted. For the readers planning from
+the manifest(table_manifest.read) the swap is atomic, they see either the old or the new files.
+
+    python parquet_compaction.py /tmp/stream-etl --seed-demo 200 --target-mb 1 --closed-after-secs 0
+"""
+
+import argparse
+import json
+import logging
+import math
+import time
+import uuid
+
+import table_manifest
+
+
+logger = logging.getLogger(__name__)
+
+_STAGING_PREFIX = "_compaction_"
+_JOURNAL = "_SWAP.json"
+_SKIP_DIRS = ("checkpoint",)
+
+
+class _Fs:
+    """ Thin wrapper over the hadoop FileSystem of a path """
+
+    def __init__(self, spark, root):
+        self._jvm = spark._jvm
+        self._conf = spark._jsc.hadoopConfiguration()
+        self.fs = self.path(root).getFileSystem(self._conf)
+
+    def path(self, p):
+        return self._jvm.org.apache.hadoop.fs.Path(p)
+
+    def ls(self, p):
+        return list(self.fs.listStatus(self.path(p))) if self.fs.exists(self.path(p)) else []
+
+    def exists(self, p):
+        return self.fs.exists(self.path(p))
+
+    def rename(self, src, dst):
+        if not self.fs.rename(self.path(src), self.path(dst)):
+            raise IOError(f"Unable to move {src} to {dst}")
+
+    def delete(self, p, recursive=False):
+        return self.fs.delete(self.path(p), recursive)
+
+    def read_text(self, p):
+        _in = self.fs.open(self.path(p))
+        try:
+            return self._jvm.org.apache.commons.io.IOUtils.toString(_in, "UTF-8")
+        finally:
+            _in.close()
+
+    def write_text(self, p, text):
+        out = self.fs.create(self.path(p), True)
+        try:
+            out.write(bytearray(text.encode("utf-8")))
+        finally:
+            out.close()
+
+
+def _is_data_file(name):
+    return name.endswith(".parquet") and not name.startswith(("_", "."))
+
+
+def scan(fs, root):
+    """
+    Partition directories under root with their parquet files as [(path, bytes, mtime_ms)] & any leftover staging
+    directories. checkpoint/ & hidden(_, .) directories are never walked into
+    """
+    partitions, staging = {}, []
+    _todo = [root.rstrip("/")]
+    while _todo:
+        _dir = _todo.pop()
+        for st in fs.ls(_dir):
+            name = st.getPath().getName()
+            path = st.getPath().toString()
+            if st.isDirectory():
+                if name.startswith(_STAGING_PREFIX):
+                    staging.append(path)
+                elif name not in _SKIP_DIRS and not name.startswith(("_", ".")):
+                    _todo.append(path)
+            elif _is_data_file(name):
+                partitions.setdefault(_dir, []).append(
+                    (path, st.getLen(), st.getModificationTime()))
+    return partitions, staging
+
+
+def plan(partitions, target_bytes, small_file_bytes, min_files=2, closed_after_secs=3600, now_ms=None):
+    """ [{partition, files, out_files}] for the closed partitions worth compacting """
+    now_ms = now_ms or int(time.time() * 1000)
+    plans = []
+    for part, files in sorted(partitions.items()):
+        if max(f[2] for f in files) > now_ms - closed_after_secs * 1000:
+            continue
+        small = [f for f in files if f[1] < small_file_bytes]
+        if len(small) < min_files:
+            continue
+        _bytes = sum(f[1] for f in small)
+        plans.append({
+            "partition": part,
+            "files": small,
+            "out_files": max(1, math.ceil(_bytes / target_bytes)),
+        })
+    return plans
+
+
+def _swap(fs, journal, commit=None):
+    """
+    Idempotent, run again on a half done swap to finish it. A repeated commit(journal) adds & removes nothing new.
+    Returns the ms listing readers saw both the old & the new files
+    """
+    t = time.perf_counter()
+    for src, dst in journal["new"]:
+        if fs.exists(src):
+            fs.rename(src, dst)
+    if commit:
+        commit(journal)
+    for old in journal["old"]:
+        if fs.exists(old):
+            fs.delete(old)
+    return int((time.perf_counter() - t) * 1000)
+
+
+def recover(fs, staging_dirs, commit=None):
+    """ Roll forward interrupted swaps, drop the staging of runs that died before their swap """
+    recovered = 0
+    for _dir in staging_dirs:
+        _journal = f"{_dir}/{_JOURNAL}"
+        if fs.exists(_journal):
+            _swap(fs, json.loads(fs.read_text(_journal)), commit)
+            recovered += 1
+            logger.info(json.dumps({"swap_rolled_forward": _dir}))
+        fs.delete(_dir, True)
+    return recovered
+
+
+def _count(data_frame):
+    return data_frame.count()
+
+
+def compact_partition(spark, fs, p, run_id, dry_run=False, rewrite=None, checksum=_count, commit=None, layout=None):
+    """
+    rewrite(data_frame) may transform the rows on the way, ex: merge partial aggregates, checksum must hold.
+    layout(parquet_layout.ParquetLayout) sorts the rows of the new files
+    """
+    part = p["partition"]
+    old = [f[0] for f in p["files"]]
+    res = {
+        "partition": part,
+        "files_before": len(old),
+        "bytes_before": sum(f[1] for f in p["files"]),
+        "files_after": p["out_files"],
+    }
+    if dry_run:
+        return res
+    staging = f"{part}/{_STAGING_PREFIX}{run_id}"
+    # The files of one partition were written by different batches, their inferred schemas may differ
+    src = spark.read.option("mergeSchema", "true").option(
+        "basePath", part).parquet(*old)
+    _out = (rewrite(src) if rewrite else src).repartition(p["out_files"])
+    (layout.sort(_out) if layout else _out).write.mode(
+        "overwrite").parquet(f"{staging}/data")
+
+    _staged = [st for st in fs.ls(f"{staging}/data")
+               if _is_data_file(st.getPath().getName())]
+    _sum_old = checksum(src)
+    _sum_new = checksum(spark.read.parquet(f"{staging}/data"))
+    if _sum_old != _sum_new:
+        fs.delete(staging, True)
+        raise ValueError(
+            f"Checksum mismatch in {part}, {_sum_old} old vs {_sum_new} compacted")
+
+    journal = {
+        "old": old,
+        "new": [
+            (st.getPath().toString(),
+             f"{part}/part-compacted-{run_id}-{i:05d}.parquet")
+            for i, st in enumerate(_staged)
+        ],
+    }
+    fs.write_text(f"{staging}/{_JOURNAL}", json.dumps(journal))
+    res["swap_window_ms"] = _swap(fs, journal, commit)
+    fs.delete(staging, True)
+    res.update({
+        "files_after": len(_staged),
+        "bytes_after": sum(st.getLen() for st in _staged),
+        "checksum": _sum_new,
+    })
+    return res
+
+
+def _manifest_commit(spark, manifest, root):
+    """ commit(journal) of a swap, to the table_manifest.TableManifest of root """
+    def _commit(journal):
+        manifest.commit(
+            add=table_manifest.file_stats(
+                spark, manifest.fs, [dst for _, dst in journal["new"]], root),
+            remove=journal["old"],
+            operation="compact"
+        )
+    return _commit
+
+
+def run(spark, root, target_bytes=128 * 1024 * 1024, small_file_bytes=None, min_files=2, closed_after_secs=3600, dry_run=False, rewrite=None, checksum=_count, manifest=None, layout=None):
+    """ Compact every closed partition under root, returns a JSON friendly summary """
+    t = time.perf_counter()
+    run_id = uuid.uuid4().hex[:12]
+    fs = _Fs(spark, root)
+    partitions, staging = scan(fs, root)
+    commit = _manifest_commit(spark, manifest, root) if manifest else None
+    # Interrupted swaps move & delete files, the plan is made from a listing after them
+    recovered = 0 if dry_run else recover(fs, staging, commit)
+    if staging and not dry_run:
+        partitions, _ = scan(fs, root)
+    if layout:
+        layout.apply(spark)
+    if manifest:
+        # Files outside the manifest(uncommitted batches, replays) must not get into the table through a compaction
+        _live = {table_manifest.file_key(p)
+                 for p in manifest.snapshot().files}
+        partitions = {
+            part: [f for f in files if table_manifest.file_key(f[0]) in _live]
+            for part, files in partitions.items()
+        }
+        partitions = {part: files for part,
+                      files in partitions.items() if files}
+    summary = {
+        "run_id": run_id,
+        "root": root,
+        "dry_run": dry_run,
+        "partitions_scanned": len(partitions),
+        "swaps_recovered": recovered,
+        "partitions_compacted": 0,
+        "partitions_failed": 0,
+        "files_before": 0,
+        "files_after": 0,
+        "bytes_before": 0,
+        "bytes_after": 0,
+        "swap_window_ms": 0,
+        "partitions": [],
+    }
+    plans = plan(
+        partitions,
+        target_bytes,
+        small_file_bytes or target_bytes // 2,
+        min_files,
+        closed_after_secs
+    )
+    for p in plans:
+        try:
+            res = compact_partition(
+                spark, fs, p, run_id, dry_run, rewrite, checksum, commit, layout)
+        except Exception as e:
+            summary["partitions_failed"] += 1
+            logger.error(json.dumps(
+                {"compaction_failed": p["partition"], "error": str(e)}))
+            continue
+        summary["partitions_compacted"] += 1
+        for k in ("files_before", "files_after", "bytes_before", "bytes_after", "swap_window_ms"):
+            summary[k] += res.get(k, 0)
+        summary["partitions"].append(res)
+    summary["secs"] = round(time.perf_counter() - t, 3)
+    return summary
+
+
+def _seed_demo(spark, root, files):
+    """ files tiny parquet files spread over two ingest hours, like the streaming job writes them """
+    for i in range(files):
+        spark.createDataFrame(
+            [(str(uuid.uuid4()), f"store_{i % 5}", float(i))],
+            "request_id string, store_id string, sales double"
+        ).coalesce(1).write.mode("append").parquet(
+            f"{root}/ingest_year=2021/ingest_month=03/ingest_day=20/ingest_hour={i % 2:0>2}")
+
+
+if __name__ == "__main__":
+    from pyspark.sql import SparkSession
+
+    parser = argparse.ArgumentParser(
+        description="Compact small parquet files on a local filesystem")
+    parser.add_argument("root")
+    parser.add_argument("--target-mb", type=float, default=128)
+    parser.add_argument("--small-file-mb", type=float)
+    parser.add_argument("--min-files", type=int, default=2)
+    parser.add_argument("--closed-after-secs", type=int, default=3600)
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--seed-demo", type=int, default=0, metavar="FILES",
+                        help="Write this many tiny files under root first")
+    cli = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    spark = SparkSession.builder.master("local[*]").appName(
+        "parquet_compaction").getOrCreate()
+    if cli.seed_demo:
+        _seed_demo(spark, cli.root, cli.seed_demo)
+    print(json.dumps(run(
+        spark,
+        cli.root,
+        target_bytes=int(cli.target_mb * 1024 * 1024),
+        small_file_bytes=int(
+            cli.small_file_mb * 1024 * 1024) if cli.small_file_mb else None,
+        min_files=cli.min_files,
+        closed_after_secs=cli.closed_after_secs,
+        dry_run=cli.dry_run
+    ), indent=2))
@@ -0,0 +1,209 @@
+"""
+Parquet layout of the stream-etl output: codec, row group & page size, dictionary encoding & the sort order of
+the rows within every file.
+
+Athena & spark skip whole row groups by their min/max statistics. Rows sorted by store_id(then category) inside
+a file give every row group a narrow store_id range, a query on one store reads a few row groups & not all of
+them. Smaller row groups prune finer, but compress a little worse & make the footers larger. The streaming job
+writes small files, the sort pays off most in the files the compaction job rewrites with the same layout.
+
+zstd needs the hadoop zstd codec of spark 3(glue 3.0+), apply() rejects it on glue 2.0(spark 2.4), which writes
+snappy, gzip or uncompressed.
+
+    python parquet_layout.py /tmp/parquet-layout --rows 2000000 --codec snappy zstd gzip --row-group-mb 128 8
+"""
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import time
+
+# pyarrow is optional, only the benchmark reads the parquet footers
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+
+CODECS = ("snappy", "zstd", "gzip", "uncompressed")
+# Spark major version a codec needs
+_CODEC_MIN_SPARK = {"zstd": 3}
+
+
+def _cols(val):
+    return tuple(c.strip() for c in val.split(",") if c.strip() and c.strip().lower() != "off")
+
+
+class ParquetLayout:
+    def __init__(self, codec="snappy", row_group_mb=128, page_kb=1024, dictionary=True, sort_cols=()):
+        if codec not in CODECS:
+            raise ValueError(f"codec must be one of {CODECS}, not {codec}")
+        self.codec = codec
+        self.row_group_mb = row_group_mb
+        self.page_kb = page_kb
+        self.dictionary = dictionary
+        self.sort_cols = tuple(sort_cols)
+
+    @classmethod
+    def from_args(cls, args):
+        """ From the resolved options of a glue job """
+        return cls(
+            codec=args["parquet_codec"].lower(),
+            row_group_mb=int(args["parquet_row_group_mb"]),
+            page_kb=int(args["parquet_page_kb"]),
+            dictionary=args["parquet_dictionary"].lower() == "true",
+            sort_cols=_cols(args["sort_cols"]),
+        )
+
+    def apply(self, spark):
+        """ Session wide, for the spark & the glue parquet writers alike """
+        _min_spark = _CODEC_MIN_SPARK.get(self.codec)
+        if _min_spark and int(spark.version.split(".")[0]) < _min_spark:
+            raise ValueError(
+                f"codec {self.codec} needs spark {_min_spark}+(glue 3.0+), not spark {spark.version}")
+        spark.conf.set("spark.sql.parquet.compression.codec", self.codec)
+        _conf = spark._jsc.hadoopConfiguration()
+        _conf.set("parquet.block.size", str(self.row_group_mb * 1024 * 1024))
+        _conf.set("parquet.page.size", str(self.page_kb * 1024))
+        _conf.set("parquet.enable.dictionary", str(self.dictionary).lower())
+
+    def format_options(self):
+        """ format_options of the glue parquet sink """
+        return {
+            "compression": self.codec,
+            "blockSize": self.row_group_mb * 1024 * 1024,
+            "pageSize": self.page_kb * 1024,
+        }
+
+    def sort(self, data_frame, partition_keys=None):
+        """
+        Rows of every task sorted by sort_cols. Partition keys go first, the order the partitioned writer needs,
+        so spark does not sort again
+        """
+        _by = list(partition_keys or []) + \
+            [c for c in self.sort_cols if c in data_frame.columns]
+        return data_frame.sortWithinPartitions(*_by) if self.sort_cols else data_frame
+
+    def to_dict(self):
+        return {"codec": self.codec, "row_group_mb": self.row_group_mb, "page_kb": self.page_kb,
+                "dictionary": self.dictionary, "sort_cols": ",".join(self.sort_cols) or "off"}
+
+
+def _may_match(stats, op, val):
+    if stats is None or not stats.has_min_max:
+        return True
+    lo, hi = stats.min, stats.max
+    if op == "=":
+        return lo <= val <= hi
+    if op == "between":
+        return hi >= val[0] and lo <= val[1]
+    raise ValueError(op)
+
+
+def scan_bytes(paths, filters, columns):
+    """
+    Bytes & row groups a reader with row group pruning(athena, spark) reads for
+    SELECT <columns> WHERE <filters>, from the footers of the files
+    """
+    res = {"row_groups": 0, "row_groups_read": 0, "bytes_scanned": 0}
+    for p in paths:
+        md = pq.ParquetFile(p).metadata
+        _idx = {md.schema.column(i).name: i for i in range(md.num_columns)}
+        for g in range(md.num_row_groups):
+            rg = md.row_group(g)
+            res["row_groups"] += 1
+            if all(_may_match(rg.column(_idx[c]).statistics, op, val) for c, op, val in filters):
+                res["row_groups_read"] += 1
+                res["bytes_scanned"] += sum(rg.column(_idx[c]).total_compressed_size
+                                            for c in columns if c in _idx)
+    return res
+
+
+# Representative queries of the sales events, SELECT sum(sales) WHERE ..
+QUERIES = {
+    "store_id": [("store_id", "=", "store_7")],
+    "category": [("category", "=", "Laptops")],
+    "store_and_category": [("store_id", "=", "store_7"), ("category", "=", "Laptops")],
+    "evnt_time_5_mins": [("evnt_time", "between", ("2021-03-20T21:00:00", "2021-03-20T21:05:00"))],
+}
+
+
+def _events(spark, rows, stores=50):
+    """ Events of a busy hour in arrival(evnt_time) order, the order a micro-batch brings them in """
+    from pyspark.sql import functions as F
+    _cats = ["Books", "Games", "Mobiles", "Groceries", "Shoes", "Stationaries", "Laptops", "Tablets",
+             "Notebooks", "Camera", "Printers", "Monitors", "Speakers", "Projectors", "Cables", "Furniture"]
+    _rnd = F.rand(7)
+    return spark.range(rows).select(
+        F.expr("uuid()").alias("request_id"),
+        F.element_at(F.array(*[F.lit(c) for c in _cats]),
+                     (F.rand(1) * len(_cats)).cast("int") + 1).alias("category"),
+        F.concat(F.lit("store_"), ((F.rand(2) * stores).cast("int") + 1).cast("string")).alias("store_id"),
+        F.date_format((F.lit(1616272800) + F.col("id") * 3600 / rows).cast("timestamp"),
+                      "yyyy-MM-dd'T'HH:mm:ss.SSSSSS").alias("evnt_time"),
+        F.when(_rnd < 0.5, F.lit("sales-events")).otherwise(F.lit("inventory-events")).alias("evnt_type"),
+        F.round(F.rand(3) * 100, 2).alias("sales"),
+        (F.rand(4) < 0.5).alias("is_return"),
+        F.lit("github.com/miztiik").alias("contact_me"),
+    )
+
+
+def _bench(spark, cli):
+    src = f"{cli.root}/_src"
+    if not os.path.exists(src):
+        _events(spark, cli.rows).write.mode("overwrite").parquet(src)
+    data_frame = spark.read.parquet(src).coalesce(cli.files).cache()
+    data_frame.count()
+    res = []
+    for codec, rg_mb, sort, dictionary in itertools.product(cli.codec, cli.row_group_mb, cli.sort, cli.dictionary):
+        layout = ParquetLayout(codec, rg_mb, cli.page_kb,
+                               dictionary == "true", _cols(sort))
+        layout.apply(spark)
+        out = f"{cli.root}/{codec}_rg{rg_mb}_{sort.replace(',', '+')}_dict{dictionary}"
+        shutil.rmtree(out, ignore_errors=True)
+        t = time.perf_counter()
+        layout.sort(data_frame).write.parquet(out)
+        _secs = time.perf_counter() - t
+        _files = [os.path.join(out, f)
+                  for f in os.listdir(out) if f.endswith(".parquet")]
+        r = dict(layout.to_dict(), **{
+            "write_secs": round(_secs, 2),
+            "files": len(_files),
+            "bytes": sum(os.path.getsize(f) for f in _files),
+            "queries": {},
+        })
+        for name, filters in QUERIES.items():
+            r["queries"][name] = scan_bytes(
+                _files, filters, [c for c, _, _ in filters] + ["sales"])
+        res.append(r)
+        print(json.dumps(r))
+    return res
+
+
+if __name__ == "__main__":
+    from pyspark.sql import SparkSession
+
+    parser = argparse.ArgumentParser(
+        description="File size, write time & bytes scanned per parquet layout")
+    parser.add_argument("root")
+    parser.add_argument("--rows", type=int, default=2000000)
+    parser.add_argument("--files", type=int, default=1)
+    parser.add_argument("--codec", nargs="+", choices=CODECS,
+                        default=["snappy", "zstd", "gzip"])
+    parser.add_argument("--row-group-mb", type=int,
+                        nargs="+", default=[128, 8])
+    parser.add_argument("--page-kb", type=int, default=1024)
+    parser.add_argument("--sort", nargs="+",
+                        default=["off", "store_id,category"])
+    parser.add_argument("--dictionary", nargs="+",
+                        choices=["true", "false"], default=["true"])
+    cli = parser.parse_args()
+
+    if pq is None:
+        raise SystemExit("pip install pyarrow, the benchmark reads the parquet footers with it")
+    spark = SparkSession.builder.master("local[*]").appName(
+        "parquet_layout_bench").getOrCreate()
+    spark.sparkContext.setLogLevel("ERROR")
+    print(json.dumps({"rows": cli.rows, "runs": _bench(spark, cli)}, indent=2))
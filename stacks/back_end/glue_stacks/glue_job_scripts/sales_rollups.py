@@ -0,0 +1,167 @@
+"""
+Tumbling window sales rollups(gold) of the valid events, per minute & per hour.
+
+Every micro-batch appends one partial row per (window, store_id, category, evnt_type) it saw, so a window that
+spans batches, or gets late events, has several partial rows. Counts & sums add up, min & max combine, readers
+aggregate the partials(see GOLD_VIEW_SQL) & the compaction job merges the partials of closed partitions into one row.
+
+Late data: the watermark trails the newest evnt_time seen by the job by the configured delay. Events older than
+the watermark are left out of the rollups(they are still in the raw data) & counted as rollup_late_rows.
+
+Re-runs: the partials are plain appends, a batch written twice would count twice. The watermark is saved only
+after the gold write succeeded, with the batch_id it was written for. A batch the query runs again after a failure
+(same query, batch_id at or below the saved one) is not written again.
+"""
+
+import json
+
+
+GRAINS = {"minute": "1 minute", "hour": "1 hour"}
+DIMS = ["store_id", "category", "evnt_type"]
+PARTITION_KEYS = ["grain", "window_date", "window_hour"]
+
+# Columns of the gold table, the partition keys are not part of the files
+GOLD_COLUMNS = [
+    {"name": "window_start", "type": "timestamp"},
+    {"name": "window_end", "type": "timestamp"},
+    {"name": "store_id", "type": "string"},
+    {"name": "category", "type": "string"},
+    {"name": "evnt_type", "type": "string"},
+    {"name": "evnt_count", "type": "bigint"},
+    {"name": "sales_sum", "type": "double"},
+    {"name": "sales_min", "type": "double"},
+    {"name": "sales_max", "type": "double"},
+    {"name": "return_count", "type": "bigint"},
+    {"name": "return_sales_sum", "type": "double"},
+    {"name": "batch_id", "type": "bigint"},
+]
+
+GOLD_VIEW_SQL = """
+SELECT grain, window_start, window_end, store_id, category, evnt_type,
+       sum(evnt_count) AS evnt_count, sum(sales_sum) AS sales_sum, min(sales_min) AS sales_min,
+       max(sales_max) AS sales_max, sum(return_count) AS return_count, sum(return_sales_sum) AS return_sales_sum
+FROM {table}
+GROUP BY grain, window_start, window_end, store_id, category, evnt_type
+"""
+
+_UNITS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+def interval_secs(interval):
+    """ Seconds of a spark style interval, ex: "15 minutes" """
+    n, unit = interval.split()
+    return int(n) * _UNITS[unit.lower().rstrip("s")]
+
+
+class RollupWatermark:
+    """
+    Newest evnt_time seen & the last batch written to gold, kept across job restarts through load & save callables
+    of a small JSON document
+    """
+
+    def __init__(self, delay, load=None, save=None):
+        self.delay_secs = interval_secs(delay)
+        self._save = save
+        self.max_evnt_ts = None
+        # Last batch whose partials are written & the streaming query it belongs to, batch_ids restart with a new checkpoint
+        self.batch_id = None
+        self.query_id = None
+        if load:
+            try:
+                doc = json.loads(load())
+                self.max_evnt_ts = doc.get("max_evnt_ts")
+                self.batch_id = doc.get("batch_id")
+                self.query_id = doc.get("query_id")
+            except Exception:
+                # First run, or an unreadable document, start from the first batch
+                self.max_evnt_ts = None
+
+    @property
+    def watermark_ts(self):
+        return None if self.max_evnt_ts is None else self.max_evnt_ts - self.delay_secs
+
+    def written(self, batch_id, query_id=None):
+        """ True when the partials of batch_id are already in gold, the query runs a failed batch again """
+        return self.batch_id is not None and query_id == self.query_id and batch_id <= self.batch_id
+
+    def advance(self, batch_max_ts, batch_id=None, query_id=None):
+        """ Call once the partials of the batch are written """
+        if batch_max_ts is not None and (self.max_evnt_ts is None or batch_max_ts > self.max_evnt_ts):
+            self.max_evnt_ts = batch_max_ts
+        self.batch_id, self.query_id = batch_id, query_id
+        if self._save:
+            self._save(json.dumps({"max_evnt_ts": self.max_evnt_ts, "delay_secs": self.delay_secs,
+                                   "batch_id": batch_id, "query_id": query_id}))
+
+
+def partials(data_frame, watermark, batch_id, grains=tuple(GRAINS)):
+    """
+    Partial rollup rows of one batch, for every grain, the batch stats & the newest evnt_time of the batch. The
+    watermark is read before the batch & advanced by the caller once the rows are written, events of this batch
+    never make each other late
+    """
+    from pyspark.sql import functions as F
+    _ts = F.to_timestamp(F.col("evnt_time"))
+    data_frame = data_frame.withColumn("_evnt_ts", _ts).filter(
+        F.col("_evnt_ts").isNotNull())
+    _wm = watermark.watermark_ts
+    _late = F.col("_evnt_ts") < F.lit(_wm).cast(
+        "timestamp") if _wm is not None else F.lit(False)
+    r = data_frame.agg(
+        F.max(F.col("_evnt_ts").cast("double")).alias("max_ts"),
+        F.sum(_late.cast("long")).alias("late")
+    ).collect()[0]
+
+    data_frame = data_frame.filter(~_late)
+    for d in DIMS:
+        data_frame = data_frame.withColumn(
+            d, F.coalesce(F.col(d).cast("string"), F.lit("unknown")))
+    _ret = F.coalesce(F.col("is_return"), F.lit(False))
+    out = None
+    for grain in grains:
+        _g = (
+            data_frame
+            .groupBy(F.window(F.col("_evnt_ts"), GRAINS[grain]).alias("w"), *DIMS)
+            .agg(
+                F.count(F.lit(1)).alias("evnt_count"),
+                F.sum("sales").alias("sales_sum"),
+                F.min("sales").alias("sales_min"),
+                F.max("sales").alias("sales_max"),
+                F.sum(_ret.cast("long")).alias("return_count"),
+                F.sum(F.when(_ret, F.col("sales")).otherwise(
+                    F.lit(0.0))).alias("return_sales_sum"),
+            )
+            .select(
+                F.col("w.start").alias("window_start"),
+                F.col("w.end").alias("window_end"),
+                *DIMS,
+                "evnt_count", "sales_sum", "sales_min", "sales_max", "return_count", "return_sales_sum",
+                F.lit(batch_id).cast("long").alias("batch_id"),
+                F.lit(grain).alias("grain"),
+                F.date_format(F.col("w.start"), "yyyy-MM-dd").alias("window_date"),
+                F.date_format(F.col("w.start"), "HH").alias("window_hour"),
+            )
+        )
+        out = _g if out is None else out.unionByName(_g)
+    # One file per gold partition & batch
+    return out.repartition(*PARTITION_KEYS), {"rollup_late_rows": r["late"] or 0}, r["max_ts"]
+
+
+def merge_partials(data_frame):
+    """ One row per window & dims from any number of partial rows, the compaction rewrite of a gold partition """
+    from pyspark.sql import functions as F
+    return data_frame.groupBy("window_start", "window_end", *DIMS).agg(
+        F.sum("evnt_count").alias("evnt_count"),
+        F.sum("sales_sum").alias("sales_sum"),
+        F.min("sales_min").alias("sales_min"),
+        F.max("sales_max").alias("sales_max"),
+        F.sum("return_count").alias("return_count"),
+        F.sum("return_sales_sum").alias("return_sales_sum"),
+        F.max("batch_id").alias("batch_id"),
+    )
+
+
+def checksum(data_frame):
+    """ Events behind the rows, unchanged by a merge """
+    from pyspark.sql import functions as F
+    return data_frame.agg(F.sum("evnt_count")).collect()[0][0]
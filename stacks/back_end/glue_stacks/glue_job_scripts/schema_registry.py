@@ -0,0 +1,160 @@
+"""
+Versioned schemas of the store events, the streaming ETL parses with one of these instead of inferring one.
+
+v1 is seeded from sample_records/producer_event.json. v2 adds the fields the producer sends today(new_order, bad_msg)
+& the order type rule. Never change a released version, add a new one & move the job's --schema_version to it.
+
+Events failing validation are quarantined with comma separated reason codes:
+    unparsable              payload is not an event in the wire format
+    bad_type_<field>        field holds a value of another type(binary wire formats only, json fails as missing_)
+    missing_<field>         required field is absent or null
+    bad_evnt_time           evnt_time is not an ISO timestamp
+    flagged_bad_msg         producer marked the event as bad(bad_msg=true)
+    ambiguous_order_type    neither or both of new_order & is_return are set
+
+    python schema_registry.py --seed sample_records/producer_event.json
+"""
+
+import argparse
+import json
+from functools import reduce
+
+
+SCHEMAS = {
+    1: {
+        "seeded_from": "sample_records/producer_event.json",
+        "fields": [
+            {"name": "request_id", "type": "string", "required": True},
+            {"name": "name", "type": "string", "required": True},
+            {"name": "category", "type": "string", "required": True},
+            {"name": "store_id", "type": "string", "required": True},
+            {"name": "evnt_time", "type": "string", "required": True},
+            {"name": "evnt_type", "type": "string", "required": True},
+            {"name": "sales", "type": "double", "required": True},
+            {"name": "contact_me", "type": "string", "required": True},
+            {"name": "is_return", "type": "boolean", "required": False},
+        ],
+        "rules": [],
+    },
+    2: {
+        "seeded_from": "v1 & stream_data_producer",
+        "fields": [
+            {"name": "request_id", "type": "string", "required": True},
+            {"name": "name", "type": "string", "required": True},
+            {"name": "category", "type": "string", "required": True},
+            {"name": "store_id", "type": "string", "required": True},
+            {"name": "evnt_time", "type": "string", "required": True},
+            {"name": "evnt_type", "type": "string", "required": True},
+            {"name": "new_order", "type": "boolean", "required": False},
+            {"name": "sales", "type": "double", "required": True},
+            {"name": "contact_me", "type": "string", "required": True},
+            {"name": "is_return", "type": "boolean", "required": False},
+            {"name": "bad_msg", "type": "boolean", "required": False},
+        ],
+        "rules": ["flagged_bad_msg", "ambiguous_order_type"],
+    },
+}
+LATEST = max(SCHEMAS)
+
+_PY_TYPES = {
+    "string": (str,),
+    "double": (float, int),
+    "boolean": (bool,),
+}
+
+
+def get_schema(version="latest"):
+    version = LATEST if str(version) == "latest" else int(version)
+    if version not in SCHEMAS:
+        raise ValueError(f"Unknown schema version:{version}")
+    return version, SCHEMAS[version]
+
+
+def field_names(version="latest"):
+    return [f["name"] for f in get_schema(version)[1]["fields"]]
+
+
+def glue_columns(version="latest"):
+    """ Columns for a glue catalog table """
+    return [{"name": f["name"], "type": f["type"]} for f in get_schema(version)[1]["fields"]]
+
+
+def spark_schema(version="latest", extra_string_cols=()):
+    """ All fields nullable, so a broken event still parses & can be quarantined """
+    from pyspark.sql.types import BooleanType, DoubleType, StringType, StructField, StructType
+    _types = {"string": StringType(), "double": DoubleType(),
+              "boolean": BooleanType()}
+    return StructType(
+        [StructField(f["name"], _types[f["type"]], True) for f in get_schema(version)[1]["fields"]] +
+        [StructField(c, StringType(), True) for c in extra_string_cols]
+    )
+
+
+def coerce(evnt, version="latest"):
+    """ Row tuple of a decoded event & its bad_type_ reason codes. Values of the wrong type become None """
+    vals, reasons = [], []
+    for f in get_schema(version)[1]["fields"]:
+        v = evnt.get(f["name"])
+        # bool is an int in python, never let it pass as a double
+        if v is not None and (not isinstance(v, _PY_TYPES[f["type"]]) or (f["type"] != "boolean" and isinstance(v, bool))):
+            reasons.append(f"bad_type_{f['name']}")
+            v = None
+        elif v is not None and f["type"] == "double":
+            v = float(v)
+        vals.append(v)
+    return tuple(vals), reasons
+
+
+def with_reasons(data_frame, version="latest", decode_reasons_col="_decode_reasons"):
+    """
+    Adds quarantine_reasons, "" for a valid event. Built from spark column expressions only, so the check runs
+    in the JVM within the parse stage
+    """
+    from pyspark.sql import functions as F
+    _, schema = get_schema(version)
+    _names = [f["name"] for f in schema["fields"]]
+    _unparsable = reduce(lambda a, b: a & b, [
+                         F.col(n).isNull() for n in _names])
+    _checks = [F.col(decode_reasons_col), F.when(
+        _unparsable, F.lit("unparsable"))]
+    _checks += [
+        F.when(~_unparsable & F.col(f["name"]).isNull(),
+               F.lit(f"missing_{f['name']}"))
+        for f in schema["fields"] if f["required"]
+    ]
+    _checks.append(F.when(F.col("evnt_time").isNotNull() & F.to_timestamp(
+        F.col("evnt_time")).isNull(), F.lit("bad_evnt_time")))
+    if "flagged_bad_msg" in schema["rules"]:
+        _checks.append(F.when(F.col("bad_msg") == F.lit(
+            True), F.lit("flagged_bad_msg")))
+    if "ambiguous_order_type" in schema["rules"]:
+        _new = F.coalesce(F.col("new_order"), F.lit(False))
+        _ret = F.coalesce(F.col("is_return"), F.lit(False))
+        _checks.append(F.when(~_unparsable & (_new == _ret),
+                              F.lit("ambiguous_order_type")))
+    return data_frame.withColumn("quarantine_reasons", F.concat_ws(",", *_checks))
+
+
+def seed_from_sample(path):
+    """ Fields of a sample event, every field of the sample is taken as required except the booleans """
+    with open(path, encoding="utf-8") as f:
+        sample = json.load(f)
+    _types = {str: "string", float: "double", int: "double", bool: "boolean"}
+    return [
+        {"name": k, "type": _types[type(v)], "required": not isinstance(v, bool)}
+        for k, v in sample.items()
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Seed a schema from a sample event & compare it with a registered version")
+    parser.add_argument("--seed", default="sample_records/producer_event.json")
+    parser.add_argument("--version", default="1")
+    cli = parser.parse_args()
+    seeded = seed_from_sample(cli.seed)
+    _, registered = get_schema(cli.version)
+    print(json.dumps({
+        "seeded": seeded,
+        "matches_registered": seeded == registered["fields"],
+    }, indent=2))
@@ -0,0 +1,163 @@
+"""
+request_id deduplication of the event stream, within an event time watermark.
+
+Spark keeps the seen (request_id, evnt_time) keys in its state store, under the checkpointLocation of the query,
+so a restarted job does not admit the duplicates again. Keys older than the watermark are evicted, the state holds
+roughly the request_ids of one watermark window. Events arriving later than the watermark are dropped by spark
+as late data, pick a watermark above the worst lateness(replays of old files included).
+
+    python stream_dedup.py --keys 1000000 10000000 --dup-rate 0.05 --state-store rocksdb
+"""
+
+import argparse
+import json
+import shutil
+import time
+
+
+_TS_COL = "_dedup_ts"
+_KEY_COL = "_dedup_key"
+
+
+def dedup(stream, watermark, key_col="request_id", time_col="evnt_time"):
+    """
+    Drop repeated key_col values within watermark(ex: "10 minutes") of time_col. Producer retries & kinesis
+    redeliveries repeat the whole event, so duplicates share their evnt_time as well. Events without a key are
+    never dropped, events without a usable time_col take the batch time
+    """
+    from pyspark.sql import functions as F
+    _ts = F.coalesce(F.to_timestamp(F.col(time_col)), F.current_timestamp())
+    _key = F.coalesce(F.col(key_col), F.concat(
+        F.lit("no_key:"), F.expr("uuid()")))
+    return (
+        stream
+        .withColumn(_TS_COL, _ts)
+        .withColumn(_KEY_COL, _key)
+        .withWatermark(_TS_COL, watermark)
+        .dropDuplicates([_KEY_COL, _TS_COL])
+        .drop(_KEY_COL, _TS_COL)
+    )
+
+
+class DedupCounter:
+    """
+    Rows the dedup dropped per micro-batch(duplicates & rows later than the watermark): rows into it minus rows out
+    of it. Spark reports the drops itself only from 3.1(late rows) & 3.3(duplicates), glue 2.0 runs spark 2.4.
+    Rows out are the row count of the persisted batch. Rows in are the decoded events when the batch counts them,
+    else the numInputRows of the query progress(one event per source row), only out once the batch is done
+    """
+
+    def __init__(self, keep=100):
+        self.keep = keep
+        # batch_id: rows out, of the batches waiting for their progress
+        self._rows_out = {}
+
+    def observe(self, spark, batch_id, rows_out, rows_in=None):
+        """ dedup_rows_dropped of this batch, or of the earlier batches whose progress is out by now """
+        if rows_in is not None:
+            return {"dedup_rows_dropped": max(rows_in - rows_out, 0)}
+        self._rows_out[batch_id] = rows_out
+        _dropped = None
+        for q in spark.streams.active:
+            for _progress in q.recentProgress:
+                _out = self._rows_out.pop(_progress.get("batchId"), None)
+                if _out is not None:
+                    _dropped = (_dropped or 0) + \
+                        max(_progress["numInputRows"] - _out, 0)
+        # Batches whose progress is no longer in recentProgress
+        for b in sorted(self._rows_out)[:-self.keep]:
+            self._rows_out.pop(b)
+        return {} if _dropped is None else {"dedup_rows_dropped": _dropped}
+
+
+def state_metrics(spark):
+    """
+    Dedup state as of the last completed micro-batch, from the progress of the active streaming query. The
+    dropped row counts are only in the progress of spark 3.1+ & 3.3+, see DedupCounter for all versions
+    """
+    for q in spark.streams.active:
+        _progress = q.lastProgress
+        if not _progress or not _progress.get("stateOperators"):
+            continue
+        op = _progress["stateOperators"][0]
+        res = {
+            "dedup_state_rows": op.get("numRowsTotal"),
+            "dedup_state_bytes": op.get("memoryUsedBytes"),
+            "dedup_late_rows_dropped": op.get("numRowsDroppedByWatermark"),
+            "duplicates_dropped": (op.get("customMetrics") or {}).get("numDroppedDuplicateRows"),
+        }
+        return {k: v for k, v in res.items() if v is not None}
+    return {}
+
+
+def _bench(spark, keys, dup_rate, watermark, workdir):
+    """ keys unique request_ids in one watermark window, dup_rate of them sent twice, through one micro-batch """
+    from pyspark.sql import functions as F
+    src = f"{workdir}/src_{keys}"
+    ckpt = f"{workdir}/checkpoint_{keys}"
+    shutil.rmtree(ckpt, ignore_errors=True)
+    rows = int(keys * (1 + dup_rate))
+    # Event times spread over a minute, well inside the watermark, every key stays in the state
+    spark.range(rows).select(
+        F.concat(F.lit("req-"), (F.col("id") % keys).cast("string")
+                 ).alias("request_id"),
+        F.date_format(
+            (F.lit(1616276342) + (F.col("id") % keys) * 60 / keys).cast("timestamp"),
+            "yyyy-MM-dd'T'HH:mm:ss.SSSSSS"
+        ).alias("evnt_time"),
+        F.lit(1.0).alias("sales")
+    ).write.mode("overwrite").parquet(src)
+
+    stream = spark.readStream.schema(
+        "request_id string, evnt_time string, sales double").parquet(src)
+    t = time.perf_counter()
+    q = (
+        dedup(stream, watermark).writeStream.format("noop")
+        .option("checkpointLocation", ckpt)
+        .trigger(once=True)
+        .start()
+    )
+    q.awaitTermination()
+    secs = time.perf_counter() - t
+    _progress = q.lastProgress
+    op = _progress["stateOperators"][0]
+    return {
+        "keys": keys,
+        "input_rows": _progress["numInputRows"],
+        "output_rows": _progress["sink"].get("numOutputRows"),
+        "secs": round(secs, 3),
+        "rows_per_sec": int(_progress["numInputRows"] / secs),
+        "state_rows": op["numRowsTotal"],
+        "state_bytes": op["memoryUsedBytes"],
+        "state_bytes_per_key": round(op["memoryUsedBytes"] / max(op["numRowsTotal"], 1), 1),
+    }
+
+
+if __name__ == "__main__":
+    from pyspark.sql import SparkSession
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the dedup throughput & state size per watermark window")
+    parser.add_argument("--keys", type=int, nargs="+",
+                        default=[1000000, 10000000, 100000000])
+    parser.add_argument("--dup-rate", type=float, default=0.05)
+    parser.add_argument("--watermark", default="10 minutes")
+    parser.add_argument("--state-store", choices=["hdfs", "rocksdb"], default="hdfs",
+                        help="rocksdb keeps the state off the JVM heap, spark 3.2+")
+    parser.add_argument("--shuffle-partitions", type=int, default=8)
+    parser.add_argument("--workdir", default="/tmp/stream_dedup_bench")
+    cli = parser.parse_args()
+
+    builder = SparkSession.builder.master("local[*]").appName("stream_dedup_bench").config(
+        "spark.sql.shuffle.partitions", cli.shuffle_partitions)
+    if cli.state_store == "rocksdb":
+        builder = builder.config(
+            "spark.sql.streaming.stateStore.providerClass",
+            "org.apache.spark.sql.execution.streaming.state.RocksDBStateStoreProvider")
+    spark = builder.getOrCreate()
+    res = []
+    for k in cli.keys:
+        res.append(_bench(spark, k, cli.dup_rate, cli.watermark, cli.workdir))
+        print(json.dumps(res[-1]))
+    print(json.dumps({"state_store": cli.state_store,
+                      "watermark": cli.watermark, "runs": res}, indent=2))
@@ -0,0 +1,764 @@
+"""
+Glue free core of the streaming ETL, plain PySpark.
+
+StreamEtl holds the parse, quarantine, dedup & per batch logic. The sinks are a writer callable,
+write(data_frame, path, partition_keys, ctx), so the glue job writes DynamicFrames & a local
+SparkSession writes plain parquet. kinesis_streams_batch_to_s3_etl.py is the glue adapter, this
+module runs the same ETL locally against a rate or file source & benchmarks it.
+
+The stream handed to StreamEtl.prepare() has the kinesis record payload in a binary `data` column & optionally
+the arrival time of the record in approximateArrivalTimestamp, the consumer lag of every batch is measured from it.
+
+    python stream_etl_core.py run /tmp/stream-etl-local --source rate --rows-per-sec 2000 --run-secs 60
+    python stream_etl_core.py bench /tmp/stream-etl-bench --window-secs 5 20 --partition-mode ingest_time event_time
+"""
+
+import argparse
+import base64
+import datetime
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from pyspark import StorageLevel
+from pyspark.sql import functions as F
+from pyspark.sql.types import ArrayType
+
+import catalog_partitions
+import sales_rollups
+import schema_registry
+import stream_dedup
+import table_manifest
+from parquet_layout import ParquetLayout, _cols as _layout_cols
+from batch_metrics import BatchMetrics
+# Shipped with --extra-py-files, shared with the producer
+from frame_codec import expand
+from kpl_aggregation import deaggregate
+from wire_serializers import decode, wire_format
+
+
+logger = logging.getLogger(__name__)
+
+# Parse stage helper columns, never written with the valid events
+_WORK_COLS = ("raw_data", "_decode_reasons", "_raw_bytes", "quarantine_reasons", "_arrival_ts")
+_ARRIVAL_COL = "approximateArrivalTimestamp"
+
+
+def _off(val):
+    """ "" for the "off" sentinel of the interval args """
+    return "" if (val or "").strip().lower() in ("", "off") else val.strip()
+
+
+class EtlConfig:
+    """ Settings of one ETL run, from the glue job args or the local runner """
+
+    def __init__(
+        self,
+        etl_root,
+        quarantine_root=None,
+        gold_root=None,
+        job_name="stream-etl-local",
+        kpl_aggregated=False,
+        wire_format="json",
+        compressed_frames=False,
+        persist_batch=False,
+        schema_version="2",
+        dedup_watermark="off",
+        rollup_watermark="off",
+        partition_mode="ingest_time",
+        partition_cols="evnt_type",
+        metrics_namespace="",
+        window_secs=100,
+        table_manifest=False,
+        manifest_lock_table="off",
+        parquet_layout=None,
+        catalog_db="",
+        catalog_table="off",
+    ):
+        self.etl_root = etl_root.rstrip("/") + "/"
+        self.quarantine_root = quarantine_root or self.etl_root.rstrip("/") + "-quarantine/"
+        self.gold_root = gold_root or self.etl_root.rstrip("/") + "-gold/"
+        self.job_name = job_name
+        self.kpl_aggregated = kpl_aggregated
+        self.wire_format = wire_format.lower()
+        self.compressed_frames = compressed_frames
+        # infer: the catalog table with inferSchema. <version>|latest: parse with a registered schema & quarantine invalid events
+        self.schema_version = schema_version.lower()
+        self.explicit_schema = self.schema_version != "infer"
+        self.py_decode = kpl_aggregated or compressed_frames or self.wire_format != "json"
+        self.raw_source = self.py_decode or self.explicit_schema
+        # off: no dedup. ex: "10 minutes", drop repeated request_ids within that much event time
+        self.dedup_watermark = _off(dedup_watermark)
+        # off: no gold rollups. ex: "15 minutes", events this much older than the newest one are left out of the rollups
+        self.rollup_watermark = _off(rollup_watermark)
+        # Commit the files of every batch to <etl_root>/_manifest/, see table_manifest.py
+        self.table_manifest = table_manifest
+        # off: S3 conditional writes. ex: "stream-etl-manifest-commits", the dynamodb table of the S3 commits
+        self.manifest_lock_table = _off(manifest_lock_table)
+        # off: partitions found by the crawler. ex: "sales_txns_stream_etl_curated", registered after every batch
+        self.catalog_db = catalog_db
+        self.catalog_table = _off(catalog_table)
+        # Valid, quarantined events & rollups are all written from the batch, stateful batches must not be recomputed
+        # & the manifest & the catalog need the partitions of the batch
+        self.persist_batch = persist_batch or self.explicit_schema or bool(
+            self.dedup_watermark) or bool(self.rollup_watermark) or table_manifest or bool(self.catalog_table)
+        # ingest_time: one wall clock ingest_year/../ingest_hour path per batch. event_time: partitioned by the records themselves
+        self.event_time_partitions = partition_mode.lower() == "event_time"
+        self.partition_cols = catalog_partitions.partition_keys(
+            "event_time", partition_cols)
+        self.metrics_namespace = metrics_namespace
+        self.window_secs = window_secs
+        # Codec, row group & page size, dictionary & sort order of the parquet files
+        self.parquet_layout = parquet_layout or ParquetLayout()
+        self.run_id = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+
+    @classmethod
+    def from_args(cls, args, window_secs=100):
+        """ From the resolved options of the glue job """
+        _bkt = args["datalake_bkt_name"]
+        return cls(
+            etl_root=f"s3://{_bkt}/{args['datalake_bkt_prefix']}",
+            quarantine_root=f"s3://{_bkt}/{args['quarantine_prefix']}",
+            gold_root=f"s3://{_bkt}/{args['gold_prefix']}",
+            job_name=args["JOB_NAME"],
+            kpl_aggregated=args["kpl_aggregated"].lower() == "true",
+            wire_format=args["wire_format"],
+            compressed_frames=args["compressed_frames"].lower() == "true",
+            persist_batch=args["persist_batch"].lower() == "true",
+            schema_version=args["schema_version"],
+            dedup_watermark=args["dedup_watermark"],
+            rollup_watermark=args["rollup_watermark"],
+            partition_mode=args["partition_mode"],
+            partition_cols=args["partition_cols"],
+            metrics_namespace=args["metrics_namespace"],
+            window_secs=window_secs,
+            table_manifest=args["table_manifest"].lower() == "true",
+            manifest_lock_table=args["manifest_lock_table"],
+            parquet_layout=ParquetLayout.from_args(args),
+            catalog_db=args["catalog_db"],
+            catalog_table=args["catalog_table"],
+        )
+
+
+def parquet_writer(data_frame, path, partition_keys=None, ctx=None):
+    """ Plain spark sink, appends like the glue s3 sink does """
+    _w = data_frame.write.mode("append")
+    if partition_keys:
+        _w = _w.partitionBy(*partition_keys)
+    _w.parquet(path)
+
+
+def _raw_text(payload):
+    payload = bytes(payload)
+    if wire_format(payload) == "json":
+        return payload.decode("utf-8", errors="replace")
+    return base64.b64encode(payload).decode("ascii")
+
+
+def _record_decoder(schema_version, decode_bytes, decode_secs, decode_events):
+    """
+    Decode function of the udf. Only the schema version & the accumulators are captured, the closure is pickled
+    to every executor
+    """
+    _unparsable = (None,) * len(schema_registry.field_names(schema_version))
+
+    def _decode_payload(payload):
+        """ Row of one event, an event that does not decode is kept as an all null row with its raw payload """
+        try:
+            vals, reasons = schema_registry.coerce(
+                decode(payload), schema_version)
+        except Exception:
+            vals, reasons = _unparsable, []
+        return vals + (_raw_text(payload), len(payload), ",".join(reasons) or None)
+
+    def _decode_record(data):
+        """ Rows of the events in one plain, KPL aggregated or framed kinesis record, in any wire format """
+        t = time.perf_counter()
+        try:
+            rows = [_decode_payload(p) for blob in deaggregate(data)
+                    for p in expand(blob)]
+        except Exception:
+            # Broken aggregate or frame, quarantine the whole kinesis record
+            rows = [_unparsable + (_raw_text(data), len(data), None)]
+        decode_secs.add(time.perf_counter() - t)
+        decode_bytes.add(len(data))
+        decode_events.add(len(rows))
+        return rows
+
+    return _decode_record
+
+
+class StreamEtl:
+    def __init__(self, spark, cfg, writer=parquet_writer, cw_client=None, controller=None, glue_client=None):
+        self.spark = spark
+        self.cfg = cfg
+        self.writer = writer
+        # batch_controller.BatchController, sees the metrics of every batch
+        self.controller = controller
+        self._schema_version = cfg.schema_version if cfg.explicit_schema else "latest"
+        self.event_schema = schema_registry.spark_schema(
+            self._schema_version, extra_string_cols=("raw_data",)).add("_raw_bytes", "long").add("_decode_reasons", "string")
+        # Executor side counters of the python decode, process_batch reads their growth over a batch
+        self._decode_bytes = spark.sparkContext.accumulator(0)
+        self._decode_secs = spark.sparkContext.accumulator(0.0)
+        self._decode_events = spark.sparkContext.accumulator(0)
+        self.dedup_counter = stream_dedup.DedupCounter()
+        self.batch_metrics = BatchMetrics(
+            job_name=cfg.job_name,
+            window_secs=cfg.window_secs,
+            namespace=cfg.metrics_namespace,
+            cw_client=cw_client,
+            write_summary=lambda txt: self.write_text(
+                f"{cfg.etl_root}_metrics/run_summary_{cfg.job_name}_{cfg.run_id}.json", txt)
+        )
+        self.rollup_watermark = sales_rollups.RollupWatermark(
+            cfg.rollup_watermark,
+            load=lambda: self.read_text(f"{cfg.gold_root}_watermark.json"),
+            save=lambda txt: self.write_text(
+                f"{cfg.gold_root}_watermark.json", txt)
+        ) if cfg.rollup_watermark else None
+        self.manifest = table_manifest.TableManifest(
+            table_manifest.manifest_fs(spark, cfg.etl_root, cfg.manifest_lock_table or None),
+            cfg.etl_root) if cfg.table_manifest else None
+        cfg.parquet_layout.apply(spark)
+        # Registers the partitions of every batch in the glue catalog, glue_client may be a catalog_partitions.LocalCatalog
+        self.catalog = catalog_partitions.PartitionRegistrar(
+            glue_client, cfg.catalog_db, cfg.catalog_table, cfg.etl_root,
+            cfg.partition_cols if cfg.event_time_partitions else catalog_partitions.INGEST_KEYS
+        ) if cfg.catalog_table and glue_client else None
+
+    def _hadoop_fs(self, path):
+        _path = self.spark._jvm.org.apache.hadoop.fs.Path(path)
+        return _path, _path.getFileSystem(self.spark._jsc.hadoopConfiguration())
+
+    def _files_written(self, path, since_ms):
+        """ Data files under path that were written since since_ms, files moved in by the compaction job excluded """
+        _path, fs = self._hadoop_fs(path)
+        if not fs.exists(_path):
+            return []
+        files = []
+        _it = fs.listFiles(_path, True)
+        while _it.hasNext():
+            _st = _it.next()
+            _name = _st.getPath().getName()
+            if _st.getModificationTime() >= since_ms and not _name.startswith(("_", ".", "part-compacted-")):
+                files.append(_st.getPath().toString())
+        return files
+
+    def write_text(self, path, text):
+        _path, fs = self._hadoop_fs(path)
+        out = fs.create(_path, True)
+        try:
+            out.write(bytearray(text.encode("utf-8")))
+        finally:
+            out.close()
+
+    def read_text(self, path):
+        _path, fs = self._hadoop_fs(path)
+        _in = fs.open(_path)
+        try:
+            return self.spark._jvm.org.apache.commons.io.IOUtils.toString(_in, "UTF-8")
+        finally:
+            _in.close()
+
+    def _decode_records(self, stream):
+        """ One row per event. A udf & not an rdd, so it runs on the stream itself, ahead of any stateful stage """
+        _decode = F.udf(
+            _record_decoder(self._schema_version,
+                            self._decode_bytes, self._decode_secs, self._decode_events),
+            ArrayType(self.event_schema)
+        )
+        _carry = [c for c in ("_arrival_ts",) if c in stream.columns]
+        return stream.select(F.explode(_decode(F.col("data"))).alias("evnt"), *_carry).select("evnt.*", *_carry)
+
+    def _parse_json(self, stream):
+        """ Plain JSON records, parsed in the JVM with the registered schema. Nothing is inferred """
+        _carry = [c for c in ("_arrival_ts",) if c in stream.columns]
+        _raw = stream.select(
+            F.col("data").cast("string").alias("raw_data"), *_carry)
+        return _raw.select(
+            F.from_json(F.col("raw_data"), schema_registry.spark_schema(
+                self._schema_version)).alias("evnt"),
+            "raw_data",
+            F.length(F.col("raw_data")).alias("_raw_bytes"),
+            F.lit(None).cast("string").alias("_decode_reasons"),
+            *_carry
+        ).select("evnt.*", "raw_data", "_raw_bytes", "_decode_reasons", *_carry)
+
+    def _with_quarantine_reasons(self, data_frame):
+        data_frame = schema_registry.with_reasons(
+            data_frame, self._schema_version)
+        # The raw payload is only kept for the quarantine, do not cache it for every valid event
+        return data_frame.withColumn("raw_data", F.when(
+            F.col("quarantine_reasons") != "", F.col("raw_data")))
+
+    def prepare(self, stream):
+        """ Parse, validate & dedup the source stream, before it is split into micro-batches """
+        if _ARRIVAL_COL in stream.columns:
+            stream = stream.withColumnRenamed(_ARRIVAL_COL, "_arrival_ts")
+        if self.cfg.py_decode:
+            stream = self._decode_records(stream)
+        elif self.cfg.explicit_schema:
+            stream = self._parse_json(stream)
+        if self.cfg.explicit_schema:
+            stream = self._with_quarantine_reasons(stream)
+        if self.cfg.dedup_watermark:
+            # The dedup state is kept with the checkpointLocation of the query, a restart does not admit the duplicates again
+            stream = stream_dedup.dedup(stream, self.cfg.dedup_watermark)
+        return stream
+
+    def _quarantine_stats(self, data_frame, started_ms):
+        """ Rows, bad rows, bad rows per reason code & the consumer lag of a persisted batch """
+        _bad = F.col("quarantine_reasons") != ""
+        _aggs = [F.count(F.lit(1)).alias("rows"),
+                 F.sum(_bad.cast("long")).alias("bad")]
+        if "_raw_bytes" in data_frame.columns:
+            _aggs.append(F.sum("_raw_bytes").alias("bytes"))
+        if "_arrival_ts" in data_frame.columns:
+            _aggs.append(
+                F.min(F.col("_arrival_ts").cast("double")).alias("oldest"))
+        r = data_frame.agg(*_aggs).collect()[0]
+        stats = {
+            "row_count": r["rows"],
+            "bad_rows": r["bad"] or 0,
+            "bad_record_rate": round((r["bad"] or 0) / r["rows"], 4) if r["rows"] else 0,
+        }
+        if "_raw_bytes" in data_frame.columns:
+            stats["input_bytes"] = r["bytes"]
+        if "_arrival_ts" in data_frame.columns and r["oldest"] is not None:
+            # Age of the oldest record of the batch when the batch started
+            stats["lag_secs"] = round(
+                max(started_ms / 1000 - r["oldest"], 0), 1)
+        if stats["bad_rows"]:
+            stats["bad_reasons"] = {
+                x["reason"]: x["count"] for x in data_frame.filter(_bad)
+                .select(F.explode(F.split(F.col("quarantine_reasons"), ",")).alias("reason"))
+                .groupBy("reason").count().collect()
+            }
+        return stats
+
+    def _write_quarantine(self, data_frame):
+        now = datetime.datetime.utcnow()
+        _df = (
+            data_frame.drop("_decode_reasons", "_raw_bytes")
+            .withColumn("schema_version", F.lit(self.cfg.schema_version))
+            .withColumn("quarantined_at", F.lit(now.isoformat()))
+        )
+        self.writer(_df, self.cfg.quarantine_root +
+                    now.strftime("ingest_date=%Y-%m-%d/ingest_hour=%H/"), None, "quarantine_sink")
+
+    def _with_event_partitions(self, data_frame):
+        """
+        Partition columns from the events, evnt_date & evnt_hour from evnt_time. Events without a usable evnt_time fall back
+        to the ingest time & missing values(ex: store_id of inventory events) go to "unknown", not __HIVE_DEFAULT_PARTITION__
+        """
+        _ts = F.coalesce(F.to_timestamp(
+            F.col("evnt_time")), F.current_timestamp())
+        data_frame = (
+            data_frame
+            .withColumn("evnt_date", F.date_format(_ts, "yyyy-MM-dd"))
+            .withColumn("evnt_hour", F.date_format(_ts, "HH"))
+        )
+        for c in self.cfg.partition_cols[2:]:
+            data_frame = data_frame.withColumn(
+                c, F.coalesce(F.col(c).cast("string"), F.lit("unknown")))
+        # One task per partition value, so each partition directory gets one file per batch
+        return data_frame.repartition(*self.cfg.partition_cols)
+
+    def _query_id(self):
+        """ Id of the streaming query, kept in its checkpoint. None unless exactly one query is active """
+        _active = self.spark.streams.active
+        return str(_active[0].id) if len(_active) == 1 else None
+
+    def _write_rollups(self, data_frame, batch_id):
+        """
+        Partial minute & hour rollups of the valid events of the batch, appended to the gold prefix. A batch already
+        written, run again after a failure later in the batch, is skipped
+        """
+        _query_id = self._query_id()
+        if self.rollup_watermark.written(batch_id, _query_id):
+            return {"rollup_skipped": True}
+        rollups, stats, _max_ts = sales_rollups.partials(
+            data_frame, self.rollup_watermark, batch_id)
+        self.writer(rollups, self.cfg.gold_root,
+                    sales_rollups.PARTITION_KEYS, "gold_sink")
+        self.rollup_watermark.advance(_max_ts, batch_id, _query_id)
+        return stats
+
+    def _partition_values(self, data_frame):
+        """ Partition values the batch writes to, cheap only when the batch is persisted """
+        return [tuple(r) for r in data_frame.select(*self.cfg.partition_cols).distinct().collect()]
+
+    def _partition_path(self, values):
+        return catalog_partitions.partition_path(self.cfg.etl_root, self.cfg.partition_cols, values)
+
+    def ingest_path(self, now=None):
+        now = now or datetime.datetime.now()
+        return catalog_partitions.partition_path(
+            self.cfg.etl_root, catalog_partitions.INGEST_KEYS, catalog_partitions.ingest_values(now))
+
+    def _register_partitions(self, data_frame, partition_values):
+        """ The data is already written, a catalog error is logged & the partitions tried again with the next batch """
+        try:
+            return self.catalog.register(partition_values, catalog_partitions.columns_of(
+                data_frame.schema, self.catalog.partition_keys))
+        except Exception as e:
+            logger.warning(json.dumps({"catalog_registration_failed": str(e)}))
+            return {"partitions_failed": len(partition_values)}
+
+    def _dedup_dropped(self, batch_id, rows_out, decoded_before):
+        """ Rows the dedup dropped, rows out are counted from the persisted batch(dedup forces persist_batch) """
+        _rows_in = self._decode_events.value - \
+            decoded_before[2] if self.cfg.py_decode else None
+        return self.dedup_counter.observe(self.spark, batch_id, rows_out, _rows_in)
+
+    def process_batch(self, data_frame, batch_id):
+        cfg = self.cfg
+        rec = self.batch_metrics.start(batch_id)
+        _decoded_before = (self._decode_bytes.value,
+                           self._decode_secs.value, self._decode_events.value)
+        _cached = None
+        if cfg.persist_batch:
+            data_frame = _cached = data_frame.persist(
+                StorageLevel.MEMORY_AND_DISK)
+        # take(1) stops at the first row, count() would read the whole batch just to skip the empty ones
+        if not data_frame.take(1):
+            if _cached is not None:
+                _cached.unpersist()
+            if cfg.dedup_watermark:
+                # A batch of nothing but duplicates is empty too
+                rec.update(self._dedup_dropped(batch_id, 0, _decoded_before))
+            self.batch_metrics.empty(rec)
+            return
+        # Catalog frames only get a row count when persisted, counting them otherwise means reading the batch twice
+        if cfg.persist_batch:
+            with rec.timed("parse_secs"):
+                if cfg.explicit_schema:
+                    rec.update(self._quarantine_stats(
+                        data_frame, rec.started_ms))
+                else:
+                    rec["row_count"] = data_frame.count()
+        try:
+            if rec.get("bad_rows"):
+                with rec.timed("quarantine_write_secs"):
+                    self._write_quarantine(data_frame.filter(
+                        F.col("quarantine_reasons") != ""))
+            if cfg.explicit_schema:
+                data_frame = data_frame.filter(
+                    F.col("quarantine_reasons") == "")
+            data_frame = data_frame.drop(*_WORK_COLS)
+            if self.rollup_watermark:
+                with rec.timed("rollup_secs"):
+                    rec.update(self._write_rollups(data_frame, batch_id))
+            if cfg.event_time_partitions:
+                data_frame = self._with_event_partitions(data_frame)
+                _path, _keys = cfg.etl_root, cfg.partition_cols
+            else:
+                _now = datetime.datetime.now()
+                _path, _keys = self.ingest_path(_now), None
+            with rec.timed("write_secs"):
+                self.writer(cfg.parquet_layout.sort(data_frame, _keys),
+                            _path, _keys, "datasink1")
+            _files, _parts = None, None
+            if not cfg.event_time_partitions:
+                _files = self._files_written(_path, rec.started_ms)
+                _parts = [catalog_partitions.ingest_values(_now)]
+            elif cfg.persist_batch:
+                # Listing the whole prefix gets slower every hour, only look in the partitions of this batch
+                _parts = self._partition_values(data_frame)
+                rec["partitions_written"] = len(_parts)
+                _files = [f for v in _parts for f in self._files_written(
+                    self._partition_path(v), rec.started_ms)]
+            if _files is not None:
+                rec["files_written"] = len(_files)
+            if self.manifest:
+                with rec.timed("commit_secs"):
+                    rec["manifest_version"] = self.manifest.commit(
+                        add=table_manifest.file_stats(
+                            self.spark, self.manifest.fs, _files, cfg.etl_root),
+                        batch_id=batch_id
+                    )
+            if self.catalog and _parts:
+                with rec.timed("catalog_secs"):
+                    rec.update(self._register_partitions(data_frame, _parts))
+        finally:
+            if _cached is not None:
+                _cached.unpersist()
+        if cfg.py_decode:
+            # Kinesis record bytes & executor decode time, summed over all the partitions
+            rec["input_bytes"] = self._decode_bytes.value - _decoded_before[0]
+            rec["parse_secs"] = round(
+                self._decode_secs.value - _decoded_before[1], 3)
+        if cfg.dedup_watermark:
+            rec.update(self._dedup_dropped(
+                batch_id, rec.get("row_count", 0), _decoded_before))
+            # Lags one batch, the progress of this one is only known once process_batch returns
+            rec.update(stream_dedup.state_metrics(self.spark))
+        self.batch_metrics.finish(rec)
+        if self.controller:
+            self.controller.observe(rec)
+        logger.info(f'{{"batch_process_successful":True}}')
+
+
+def rate_source(spark, rows_per_sec, partitions=1, dup_every=20, bad_every=10, store_count=5):
+    """
+    Synthetic events at a fixed rate, built in the JVM from the rate source. Every dup_every-th event repeats the
+    previous one(same request_id & evnt_time) & every bad_every-th one has no store_id, like a bad_msg
+    """
+    _src = (
+        spark.readStream.format("rate")
+        .option("rowsPerSecond", rows_per_sec)
+        .option("numPartitions", partitions)
+        .load()
+    )
+    _n = F.when((F.col("value") % dup_every == 0) & (F.col("value") > 0),
+                F.col("value") - 1).otherwise(F.col("value")) if dup_every else F.col("value")
+    _bad = (_n % bad_every == 0) if bad_every else F.lit(False)
+    _return = _n % 2 == 1
+    # Event time of the event number, not of the row, a repeat gets the evnt_time of the event it repeats
+    _evnt_ts = (F.lit(time.time()) + _n / rows_per_sec).cast("timestamp")
+    _evnt = F.struct(
+        F.concat(F.lit("req-"), _n.cast("string")).alias("request_id"),
+        F.lit("Gnome").alias("name"),
+        F.element_at(F.array(*[F.lit(c) for c in ["Books", "Games", "Laptops", "Shoes"]]),
+                     (_n % 4 + 1).cast("int")).alias("category"),
+        F.when(~_bad, F.concat(F.lit("store_"), (_n % store_count + 1).cast("string"))).alias("store_id"),
+        F.date_format(_evnt_ts, "yyyy-MM-dd'T'HH:mm:ss.SSSSSS").alias("evnt_time"),
+        F.when(_n % 3 == 0, F.lit("inventory-events")).otherwise(F.lit("sales-events")).alias("evnt_type"),
+        F.when(~_return, F.lit(True)).alias("new_order"),
+        F.when(_return, F.lit(True)).alias("is_return"),
+        F.round((_n % 10000) / 100.0, 2).alias("sales"),
+        F.when(_bad, F.lit(True)).alias("bad_msg"),
+        F.lit("github.com/miztiik").alias("contact_me"),
+    )
+    # to_json drops the null fields, the same shape as the producer events
+    return _src.select(F.to_json(_evnt).cast("binary").alias("data"), F.col("timestamp").alias(_ARRIVAL_COL))
+
+
+def file_source(spark, path, max_files_per_trigger=None):
+    """ JSON lines files dropped into path, one event per line """
+    _r = spark.readStream.format("text")
+    if max_files_per_trigger:
+        _r = _r.option("maxFilesPerTrigger", max_files_per_trigger)
+    return _r.load(path).select(
+        F.col("value").cast("binary").alias("data"),
+        F.col("_metadata.file_modification_time").alias(_ARRIVAL_COL)
+    )
+
+
+class FileFeeder(threading.Thread):
+    """ Writes one JSON lines file of rows_per_sec producer events(EventGenerator) into path every second """
+
+    def __init__(self, path, rows_per_sec, **gen_kwargs):
+        super().__init__(daemon=True)
+        # The producer's generator, on the PYTHONPATH locally, it is never shipped to glue
+        from event_generator import EventGenerator
+        self.path = path
+        self.rows_per_sec = rows_per_sec
+        self.gen = EventGenerator(**gen_kwargs)
+        self.rows = 0
+        self._stop_evt = threading.Event()
+        os.makedirs(path, exist_ok=True)
+
+    def run(self):
+        i = 0
+        while not self._stop_evt.is_set():
+            t = time.perf_counter()
+            _lines = "\n".join(json.dumps(e)
+                               for e in self.gen.gen_block(self.rows_per_sec))
+            # Written aside & renamed, the file source must never see a partial file
+            _tmp = os.path.join(self.path, f".evnts_{i:06d}.json")
+            with open(_tmp, "w") as f:
+                f.write(_lines + "\n")
+            os.rename(_tmp, os.path.join(self.path, f"evnts_{i:06d}.json"))
+            self.rows += self.rows_per_sec
+            i += 1
+            self._stop_evt.wait(max(0.0, 1.0 - (time.perf_counter() - t)))
+
+    def stop(self):
+        self._stop_evt.set()
+        self.join()
+
+
+def _start(etl, stream, checkpoint, window_secs):
+    return (
+        etl.prepare(stream).writeStream
+        .foreachBatch(etl.process_batch)
+        .option("checkpointLocation", checkpoint)
+        .trigger(processingTime=f"{window_secs} seconds")
+        .start()
+    )
+
+
+def _drain_stop(q):
+    """ stop() interrupts the batch in flight, let that one finish so every counted batch is complete """
+    _last = (q.lastProgress or {}).get("batchId")
+    while q.isActive and q.status["isTriggerActive"] and (q.lastProgress or {}).get("batchId") == _last:
+        time.sleep(0.2)
+    q.stop()
+
+
+def run_adaptive(etl, make_stream, checkpoint, run_secs=None, poll_secs=5):
+    """
+    The ETL query with the settings of etl.controller, restarted on the same checkpoint whenever the controller
+    changes them. make_stream(settings) builds the source with the fetch settings. Returns after run_secs, or
+    runs until the query fails
+    """
+    ctl = etl.controller
+    t = time.perf_counter()
+    while True:
+        applied = dict(ctl.settings)
+        etl.batch_metrics.window_secs = applied["window_secs"]
+        q = _start(etl, make_stream(applied), checkpoint,
+                   applied["window_secs"])
+        logger.info(json.dumps({"query_started": applied}))
+        while q.isActive and ctl.settings == applied and (run_secs is None or time.perf_counter() - t < run_secs):
+            q.awaitTermination(poll_secs)
+        if not q.isActive:
+            if q.exception():
+                raise q.exception()
+            return
+        _drain_stop(q)
+        if run_secs is not None and time.perf_counter() - t >= run_secs:
+            return
+
+
+def run_local(spark, cfg, make_stream, run_secs, controller=None, glue_client=None):
+    """ The ETL as a local streaming query for run_secs, returns the run summary of the batch metrics """
+    etl = StreamEtl(spark, cfg, controller=controller, glue_client=glue_client)
+    _ckpt = f"{cfg.etl_root}checkpoint"
+    t = time.perf_counter()
+    if controller:
+        run_adaptive(etl, make_stream, _ckpt, run_secs)
+    else:
+        q = _start(etl, make_stream(None), _ckpt, cfg.window_secs)
+        q.awaitTermination(run_secs)
+        _drain_stop(q)
+    summary = etl.batch_metrics.summary()
+    summary["run_secs"] = round(time.perf_counter() - t, 3)
+    if controller:
+        summary["controller"] = {"goal": controller.goal, "changes": controller.changes,
+                                 "settings": controller.settings}
+    if etl.catalog:
+        summary["catalog"] = {"partitions": len(etl.catalog.known), "calls": etl.catalog.calls}
+    return summary
+
+
+def _local_stream(spark, cli, workdir):
+    """ make_stream(settings) of the local source & the file feeder, if any """
+    if cli.source == "rate":
+        return lambda settings: rate_source(spark, cli.rows_per_sec, cli.source_partitions), None
+    feeder = FileFeeder(f"{workdir}/_src", cli.rows_per_sec)
+    feeder.start()
+    # Files of rows_per_sec events stand in for the records per fetch of kinesis
+    return lambda settings: file_source(
+        spark, f"{workdir}/_src",
+        max(1, settings["fetch_records"] // cli.rows_per_sec) if settings else None
+    ), feeder
+
+
+def _bench(spark, cli):
+    """ One run per window size & partition mode, on a clean output directory each """
+    res = []
+    for window_secs in cli.window_secs:
+        for mode in cli.partition_mode:
+            workdir = f"{cli.root}/w{window_secs}_{mode}"
+            shutil.rmtree(workdir, ignore_errors=True)
+            cfg = EtlConfig(f"{workdir}/out", partition_mode=mode, partition_cols=cli.partition_cols,
+                            dedup_watermark=cli.dedup_watermark, rollup_watermark=cli.rollup_watermark,
+                            window_secs=window_secs, table_manifest=cli.table_manifest,
+                            parquet_layout=ParquetLayout(cli.parquet_codec, sort_cols=_layout_cols(cli.sort_cols)))
+            make_stream, feeder = _local_stream(spark, cli, workdir)
+            try:
+                s = run_local(spark, cfg, make_stream, cli.run_secs)
+            finally:
+                if feeder:
+                    feeder.stop()
+            res.append({
+                "window_secs": window_secs,
+                "partition_mode": mode,
+                "partition_cols": cfg.partition_cols if cfg.event_time_partitions else "ingest_time",
+                "batches": s["batches"],
+                "rows": s["rows"],
+                # Over the whole run, idle time between triggers included
+                "rows_per_sec": int(s["rows"] / s["run_secs"]) if s["run_secs"] else 0,
+                "batch_secs": s["batch_secs"],
+                "batches_over_window": s["batches_over_window"],
+                "files_written": s["files_written"],
+                "files_per_batch": round(s["files_written"] / s["batches"], 1) if s["batches"] else 0,
+                "bad_rows": s["bad_rows"],
+            })
+            print(json.dumps(res[-1]))
+    return res
+
+
+if __name__ == "__main__":
+    from pyspark.sql import SparkSession
+
+    parser = argparse.ArgumentParser(
+        description="Run or benchmark the streaming ETL on a local SparkSession")
+    parser.add_argument("cmd", choices=["run", "bench"])
+    parser.add_argument("root", help="Local output directory")
+    parser.add_argument("--source", choices=["rate", "file"], default="rate",
+                        help="rate: events built in the JVM. file: producer events written as JSON lines files")
+    parser.add_argument("--rows-per-sec", type=int, default=1000)
+    parser.add_argument("--source-partitions", type=int, default=1)
+    parser.add_argument("--run-secs", type=int, default=60)
+    parser.add_argument("--window-secs", type=int, nargs="+", default=[5, 20])
+    parser.add_argument("--partition-mode", nargs="+", choices=["ingest_time", "event_time"],
+                        default=["ingest_time", "event_time"])
+    parser.add_argument("--partition-cols", default="evnt_type")
+    parser.add_argument("--dedup-watermark", default="off")
+    parser.add_argument("--rollup-watermark", default="off")
+    parser.add_argument("--table-manifest", action="store_true")
+    parser.add_argument("--parquet-codec", default="snappy")
+    parser.add_argument("--sort-cols", default="off")
+    parser.add_argument("--catalog", action="store_true",
+                        help="Register the partitions in a local catalog, <root>/catalog.json")
+    parser.add_argument("--shuffle-partitions", type=int, default=4)
+    parser.add_argument("--controller", choices=["off", "latency", "throughput"], default="off",
+                        help="run only, adapt the window & the fetch limits, decisions go to <root>/controller_audit.jsonl")
+    parser.add_argument("--latency-slo-secs", type=int, default=60)
+    parser.add_argument("--window-bounds-secs", default="5,120")
+    cli = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    spark = SparkSession.builder.master("local[*]").appName("stream_etl_local").config(
+        "spark.sql.shuffle.partitions", cli.shuffle_partitions).getOrCreate()
+    spark.sparkContext.setLogLevel("ERROR")
+    if cli.cmd == "bench":
+        print(json.dumps({"source": cli.source, "rows_per_sec": cli.rows_per_sec,
+                          "run_secs": cli.run_secs, "runs": _bench(spark, cli)}, indent=2))
+    else:
+        logging.getLogger(__name__).setLevel(logging.INFO)
+        logging.getLogger("batch_metrics").setLevel(logging.INFO)
+        _cfg = EtlConfig(f"{cli.root}/out", partition_mode=cli.partition_mode[0], partition_cols=cli.partition_cols,
+                         dedup_watermark=cli.dedup_watermark, rollup_watermark=cli.rollup_watermark,
+                         window_secs=cli.window_secs[0], table_manifest=cli.table_manifest,
+                         parquet_layout=ParquetLayout(cli.parquet_codec, sort_cols=_layout_cols(cli.sort_cols)),
+                         catalog_db="local_db", catalog_table="sales_txns_stream_etl_curated" if cli.catalog else "off")
+        _ctl = None
+        if cli.controller != "off":
+            from batch_controller import BatchController, _bounds
+
+            def _audit(txt):
+                # The controller hands over its recent history, only the newest decision is appended. Earlier
+                # runs & decisions past max_history stay in the file
+                with open(f"{cli.root}/controller_audit.jsonl", "a") as f:
+                    f.write(txt.rsplit("\n", 1)[-1] + "\n")
+            logging.getLogger("batch_controller").setLevel(logging.INFO)
+            _ctl = BatchController(goal=cli.controller, latency_slo_secs=cli.latency_slo_secs,
+                                   window_bounds_secs=_bounds(cli.window_bounds_secs),
+                                   window_secs=cli.window_secs[0], audit=_audit)
+        _make_stream, _feeder = _local_stream(spark, cli, cli.root)
+        try:
+            _glue = catalog_partitions.LocalCatalog(
+                f"{cli.root}/catalog.json") if cli.catalog else None
+            print(json.dumps(run_local(spark, _cfg, _make_stream,
+                                       cli.run_secs, _ctl, _glue), indent=2))
+        finally:
+            if _feeder:
+                _feeder.stop()
@@ -0,0 +1,536 @@
+"""
+Commit log of the stream-etl parquet table. Readers plan their scans from it, not by listing the prefix.
+
+Under <table root>/_manifest/, hidden from spark, athena & the crawler:
+
+    00000000000000000042.json               one commit, the files added & removed with their rows, bytes,
+                                            partition values & min/max/null counts of STATS_COLS
+    00000000000000000050.checkpoint.json    every live file as of that version, every checkpoint_every commits
+    _last_checkpoint.json                   version of the newest checkpoint, only a hint
+
+A commit is a single new object, created only if absent: on S3(S3Fs) a conditional put of the commit to a dynamodb
+table(DynamoDbCommits) or a conditional PUT(If-None-Match: *), an exclusive link or rename on a local or hadoop
+filesystem. Of two writers racing for a version(the streaming & the
+compaction job) exactly one creates it, the other gets FileExistsError, re-reads the log & retries on the next
+version. Object stores & filesystems make a file appear whole, so readers never see half a commit, nor the files
+of a batch that is still being written or that died before its commit. A replayed micro-batch(batch_id not above
+the last committed one) is not committed twice, its files stay out of the table.
+
+A snapshot is the newest checkpoint & the commits after it, found by probing version + 1, + 2.. with GET/HEAD
+requests, never a LIST.
+
+    python table_manifest.py /tmp/stream-etl-manifest --seed-demo 40 --filter store_id in store_3,store_5
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+import zlib
+from urllib.parse import unquote
+
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_DIR = "_manifest"
+STATS_COLS = ["evnt_time", "store_id", "sales"]
+_LAST_CHECKPOINT = "_last_checkpoint.json"
+_OPS = ("=", "!=", "<", "<=", ">", ">=", "in")
+
+
+class LocalFs:
+    """ Filesystem of the manifest on a local directory, plain & file: paths """
+
+    @staticmethod
+    def _local(p):
+        return re.sub(r"^file:(//)?", "", p)
+
+    def exists(self, p):
+        return os.path.exists(self._local(p))
+
+    def read_text(self, p):
+        with open(self._local(p)) as f:
+            return f.read()
+
+    def write_text(self, p, text, overwrite=True):
+        """ FileExistsError when p exists & overwrite is off """
+        p = self._local(p)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        _tmp = f"{p}.{uuid.uuid4().hex}.tmp"
+        with open(_tmp, "w") as f:
+            f.write(text)
+        if overwrite:
+            os.replace(_tmp, p)
+            return
+        # A hard link appears whole & fails when p exists, an open(p, "x") would show readers an empty file
+        try:
+            os.link(_tmp, p)
+        finally:
+            os.remove(_tmp)
+
+    def size(self, p):
+        return os.path.getsize(self._local(p))
+
+
+class DynamoDbCommits:
+    """
+    Put-if-absent of the commits in a dynamodb table, partition key `path`(string), for a boto3 without S3
+    conditional writes(glue 2.0, python 3.7). The item holds the commit, zlib compressed, so a writer that dies
+    between its put & its S3 PUT leaves a commit the next reader or writer finishes, never a hole in the versions
+    """
+
+    def __init__(self, table, client=None):
+        if client is None:
+            import boto3
+            client = boto3.client("dynamodb")
+        self.table = table
+        self.client = client
+
+    def put_if_absent(self, p, text):
+        """ FileExistsError when p is taken """
+        from botocore.exceptions import ClientError
+        try:
+            self.client.put_item(
+                TableName=self.table,
+                Item={"path": {"S": p}, "body": {
+                    "B": zlib.compress(text.encode("utf-8"))}},
+                ConditionExpression="attribute_not_exists(#p)",
+                ExpressionAttributeNames={"#p": "path"})
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+                raise FileExistsError(p)
+            raise
+
+    def get(self, p):
+        """ The commit put at p, None if none """
+        _item = self.client.get_item(
+            TableName=self.table, Key={"path": {"S": p}}, ConsistentRead=True).get("Item")
+        return zlib.decompress(_item["body"]["B"]).decode("utf-8") if _item else None
+
+
+class S3Fs:
+    """
+    Filesystem of the manifest on S3, with boto3. S3A & EMRFS have no atomic create, a create without overwrite
+    is a check then a PUT that two writers can both pass. With lock_table the commit is first put, if absent, to
+    that dynamodb table(DynamoDbCommits), else S3 conditional writes(boto3 1.35+, python 3.8+) make it put-if-absent
+    """
+
+    def __init__(self, client=None, lock_table=None, ddb_client=None):
+        if client is None:
+            import boto3
+            client = boto3.client("s3")
+        self.commits = DynamoDbCommits(
+            lock_table, ddb_client) if lock_table else None
+        # Ref: https://docs.aws.amazon.com/AmazonS3/latest/userguide/conditional-writes.html
+        if self.commits is None and "IfNoneMatch" not in client.meta.service_model.operation_model(
+                "PutObject").input_shape.members:
+            raise RuntimeError(
+                "The manifest needs a put-if-absent on S3: a dynamodb table(--manifest_lock_table) or S3 conditional "
+                "writes(boto3 1.35 or newer, python 3.8+, not glue 2.0), else set --table_manifest false")
+        self.client = client
+
+    @staticmethod
+    def _bkt_key(p):
+        bkt, _, key = re.sub(r"^s3[an]?://", "", p).partition("/")
+        return bkt, key
+
+    @staticmethod
+    def _code(e):
+        return e.response.get("Error", {}).get("Code")
+
+    def _put(self, p, text, **kwargs):
+        bkt, key = self._bkt_key(p)
+        self.client.put_object(
+            Bucket=bkt, Key=key, Body=text.encode("utf-8"), **kwargs)
+
+    def exists(self, p):
+        from botocore.exceptions import ClientError
+        bkt, key = self._bkt_key(p)
+        try:
+            self.client.head_object(Bucket=bkt, Key=key)
+            return True
+        except ClientError as e:
+            if self._code(e) not in ("404", "NoSuchKey", "NotFound"):
+                raise
+        _text = self.commits.get(p) if self.commits else None
+        if _text is None:
+            return False
+        # Taken in dynamodb, its writer died(or is about to) before the S3 PUT, rolled forward with the same body
+        self._put(p, _text)
+        return True
+
+    def read_text(self, p):
+        bkt, key = self._bkt_key(p)
+        return self.client.get_object(Bucket=bkt, Key=key)["Body"].read().decode("utf-8")
+
+    def write_text(self, p, text, overwrite=True):
+        """ FileExistsError when p exists & overwrite is off """
+        from botocore.exceptions import ClientError
+        if overwrite:
+            return self._put(p, text)
+        if self.commits:
+            self.commits.put_if_absent(p, text)
+            return self._put(p, text)
+        try:
+            self._put(p, text, IfNoneMatch="*")
+        except ClientError as e:
+            # 412 - It exists, 409 - A concurrent conditional PUT of the same key is in progress
+            if self._code(e) in ("PreconditionFailed", "412", "ConditionalRequestConflict", "409"):
+                raise FileExistsError(p)
+            raise
+
+    def size(self, p):
+        bkt, key = self._bkt_key(p)
+        return self.client.head_object(Bucket=bkt, Key=key)["ContentLength"]
+
+
+class HadoopFs:
+    """ Filesystem of the manifest on a hadoop filesystem with an atomic, non replacing rename, ex: hdfs """
+
+    def __init__(self, spark):
+        self._jvm = spark._jvm
+        self._conf = spark._jsc.hadoopConfiguration()
+
+    def _fs(self, p):
+        _path = self._jvm.org.apache.hadoop.fs.Path(p)
+        return _path, _path.getFileSystem(self._conf)
+
+    def exists(self, p):
+        _path, fs = self._fs(p)
+        return fs.exists(_path)
+
+    def read_text(self, p):
+        _path, fs = self._fs(p)
+        _in = fs.open(_path)
+        try:
+            return self._jvm.org.apache.commons.io.IOUtils.toString(_in, "UTF-8")
+        finally:
+            _in.close()
+
+    def write_text(self, p, text, overwrite=True):
+        """ FileExistsError when p exists & overwrite is off """
+        _path, fs = self._fs(p)
+        _tmp = _path if overwrite else self._jvm.org.apache.hadoop.fs.Path(
+            f"{p}.{uuid.uuid4().hex}.tmp")
+        out = fs.create(_tmp, True)
+        try:
+            out.write(bytearray(text.encode("utf-8")))
+        finally:
+            out.close()
+        # A rename on hdfs is atomic & does not replace an existing file
+        if not overwrite and not fs.rename(_tmp, _path):
+            fs.delete(_tmp, False)
+            raise FileExistsError(p)
+
+    def size(self, p):
+        _path, fs = self._fs(p)
+        return fs.getFileStatus(_path).getLen()
+
+
+def manifest_fs(spark, root, lock_table=None):
+    """ Filesystem with a put-if-absent for the manifest of root, lock_table: dynamodb table of the S3 commits """
+    if re.match(r"^s3[an]?://", root):
+        return S3Fs(lock_table=lock_table)
+    if not re.match(r"^[a-zA-Z][a-zA-Z0-9+.-]*:", root) or root.startswith("file:"):
+        # The hadoop local filesystem renames over an existing file
+        return LocalFs()
+    return HadoopFs(spark)
+
+
+def _partition_values(path, root):
+    """ key=value directories between root & the file """
+    _rel = path.split(root.rstrip("/").split("://")[-1], 1)[-1]
+    return dict(re.findall(r"/([^/=]+)=([^/]*)", _rel))
+
+
+def file_key(p):
+    """ Path without its scheme, file:/x, file:///x & /x are the same file """
+    return unquote(re.sub(r"^[a-zA-Z][a-zA-Z0-9+.-]*:/*", "", p)).lstrip("/")
+
+
+def file_stats(spark, fs, paths, root, cols=STATS_COLS):
+    """
+    Manifest entries of parquet files, rows & min/max/null count per column from one read of just those columns.
+    Columns that are partition keys of a file come from its path
+    """
+    from pyspark.sql import functions as F
+    if not paths:
+        return []
+    data_frame = spark.read.option("basePath", root).parquet(*paths)
+    _cols = [c for c in cols if c in data_frame.columns]
+    _aggs = [F.count(F.lit(1)).alias("rows")]
+    for c in _cols:
+        _aggs += [
+            F.min(c).alias(f"{c}__min"),
+            F.max(c).alias(f"{c}__max"),
+            F.sum(F.col(c).isNull().cast("long")).alias(f"{c}__nulls"),
+        ]
+    # input_file_name() is an escaped URI, the path as listed is the key of the manifest
+    _by_file = {
+        file_key(r["_file"]): r for r in
+        data_frame.withColumn("_file", F.input_file_name()).groupBy("_file").agg(*_aggs).collect()
+    }
+    entries = []
+    for p in paths:
+        r = _by_file.get(file_key(p))
+        entries.append({
+            "path": p,
+            "bytes": fs.size(p),
+            "rows": r["rows"] if r else 0,
+            "partition": _partition_values(p, root),
+            "stats": {
+                c: {"min": r[f"{c}__min"], "max": r[f"{c}__max"], "nulls": r[f"{c}__nulls"]}
+                for c in _cols
+            } if r else {},
+        })
+    return entries
+
+
+def parse_filter(col, op, val, cast=str):
+    """ (col, op, value) of a filter given as strings, the value of in is a comma separated list """
+    if op not in _OPS:
+        raise ValueError(f"Unsupported filter op {op}, one of {_OPS}")
+    if op == "in":
+        return col, op, tuple(cast(v) for v in val.split(","))
+    return col, op, cast(val)
+
+
+def column_filter(col, op, val):
+    """ The filter as a spark Column """
+    from pyspark.sql import functions as F
+    _c = F.col(col)
+    return {
+        "=": lambda: _c == val, "!=": lambda: _c != val, "<": lambda: _c < val, "<=": lambda: _c <= val,
+        ">": lambda: _c > val, ">=": lambda: _c >= val, "in": lambda: _c.isin(list(val)),
+    }[op]()
+
+
+def _may_match(entry, col, op, val):
+    """ False only when the file can not hold a row matching col op val """
+    if col in entry["partition"]:
+        _v = entry["partition"][col]
+        _vals = [str(x) for x in val] if op == "in" else [str(val)]
+        if op == "=" or op == "in":
+            return _v in _vals
+        if op == "!=":
+            return _v != _vals[0]
+        return True
+    s = entry["stats"].get(col)
+    if not s or s["min"] is None:
+        # No stats, or only nulls which match no comparison
+        return not s
+    lo, hi = s["min"], s["max"]
+    try:
+        if op == "=":
+            return lo <= val <= hi
+        if op == "in":
+            return any(lo <= v <= hi for v in val)
+        if op == "!=":
+            return not (lo == hi == val)
+        if op == "<":
+            return lo < val
+        if op == "<=":
+            return lo <= val
+        if op == ">":
+            return hi > val
+        if op == ">=":
+            return hi >= val
+    except TypeError:
+        return True
+    raise ValueError(f"Unsupported filter op {op}, one of {_OPS}")
+
+
+class Snapshot:
+    """ Live files of the table as of one version """
+
+    def __init__(self, version=-1, files=None, last_batch_id=None):
+        self.version = version
+        self.files = files or {}
+        self.last_batch_id = last_batch_id
+
+    def apply(self, commit):
+        for p in commit.get("remove", []):
+            self.files.pop(p, None)
+        for e in commit.get("add", []):
+            self.files[e["path"]] = e
+        if commit.get("batch_id") is not None:
+            self.last_batch_id = commit["batch_id"]
+        self.version = commit["version"]
+
+    def plan(self, filters=()):
+        """ Files that may hold rows matching all the filters [(col, op, value)] & the pruning stats """
+        t = time.perf_counter()
+        selected = [e for e in self.files.values() if all(
+            _may_match(e, *f) for f in filters)]
+        return selected, {
+            "version": self.version,
+            "files_total": len(self.files),
+            "files_selected": len(selected),
+            "bytes_total": sum(e["bytes"] for e in self.files.values()),
+            "bytes_selected": sum(e["bytes"] for e in selected),
+            "rows_selected": sum(e["rows"] for e in selected),
+            "plan_secs": round(time.perf_counter() - t, 6),
+        }
+
+    def to_json(self):
+        return json.dumps({"version": self.version, "last_batch_id": self.last_batch_id,
+                           "files": list(self.files.values())})
+
+
+class TableManifest:
+    def __init__(self, fs, root, checkpoint_every=50):
+        self.fs = fs
+        self.root = root.rstrip("/")
+        self.dir = f"{self.root}/{MANIFEST_DIR}"
+        self.checkpoint_every = checkpoint_every
+        # Writer side cache, refreshed on a commit conflict
+        self._snapshot = None
+
+    def _commit_path(self, version):
+        return f"{self.dir}/{version:020d}.json"
+
+    def _checkpoint_path(self, version):
+        return f"{self.dir}/{version:020d}.checkpoint.json"
+
+    def snapshot(self, version=None):
+        """ The newest snapshot, or the one of version """
+        snap = Snapshot()
+        _hint = f"{self.dir}/{_LAST_CHECKPOINT}"
+        if self.fs.exists(_hint):
+            _ckpt = json.loads(self.fs.read_text(_hint))["version"]
+            if version is not None and _ckpt > version:
+                # Time travel before the last checkpoint, the older checkpoints are kept
+                _ckpt = version - version % self.checkpoint_every
+            if _ckpt > 0 and self.fs.exists(self._checkpoint_path(_ckpt)):
+                d = json.loads(self.fs.read_text(self._checkpoint_path(_ckpt)))
+                snap = Snapshot(d["version"], {
+                                e["path"]: e for e in d["files"]}, d["last_batch_id"])
+        while version is None or snap.version < version:
+            _next = self._commit_path(snap.version + 1)
+            if not self.fs.exists(_next):
+                break
+            snap.apply(json.loads(self.fs.read_text(_next)))
+        return snap
+
+    def commit(self, add=(), remove=(), operation="append", batch_id=None, max_attempts=10):
+        """
+        Version of the new commit. None when batch_id was committed already, a replay of the micro-batch
+        """
+        for _ in range(max_attempts):
+            if self._snapshot is None:
+                self._snapshot = self.snapshot()
+            snap = self._snapshot
+            if batch_id is not None and snap.last_batch_id is not None and batch_id <= snap.last_batch_id:
+                logger.info(json.dumps(
+                    {"manifest_commit_skipped": batch_id, "last_batch_id": snap.last_batch_id}))
+                return None
+            version = snap.version + 1
+            commit = {
+                "version": version,
+                "txn_id": uuid.uuid4().hex,
+                "operation": operation,
+                "committed_at": datetime.datetime.utcnow().isoformat(),
+                "add": list(add),
+                "remove": list(remove),
+            }
+            if batch_id is not None:
+                commit["batch_id"] = batch_id
+            try:
+                # Put-if-absent, of the writers racing for this version only one gets it
+                self.fs.write_text(self._commit_path(
+                    version), json.dumps(commit), overwrite=False)
+            except FileExistsError:
+                logger.info(json.dumps({"manifest_commit_conflict": version}))
+                self._snapshot = None
+                continue
+            snap.apply(commit)
+            if version and version % self.checkpoint_every == 0:
+                self._checkpoint(snap)
+            return version
+        raise RuntimeError(
+            f"No manifest commit after {max_attempts} attempts, {self.dir}")
+
+    def _checkpoint(self, snap):
+        self.fs.write_text(self._checkpoint_path(snap.version), snap.to_json())
+        self.fs.write_text(f"{self.dir}/{_LAST_CHECKPOINT}",
+                           json.dumps({"version": snap.version}))
+
+
+def read(spark, root, filters=(), version=None, fs=None):
+    """ DataFrame of the table at a snapshot, only the files the manifest can not rule out are read """
+    files, stats = TableManifest(fs or manifest_fs(spark, root), root).snapshot(
+        version).plan(filters)
+    logger.info(json.dumps({"manifest_scan": stats}))
+    if not files:
+        return None, stats
+    data_frame = spark.read.option("mergeSchema", "true").option(
+        "basePath", root).parquet(*[e["path"] for e in files])
+    for f in filters:
+        data_frame = data_frame.filter(column_filter(*f))
+    return data_frame, stats
+
+
+def _seed_demo(spark, root, batches, rows=2000):
+    """ batches micro-batches of evnt_type partitioned files, committed like the streaming job does """
+    from pyspark.sql import functions as F
+    fs = LocalFs()
+    manifest = TableManifest(fs, root, checkpoint_every=10)
+    for b in range(batches):
+        t = time.time() * 1000
+        # Every batch covers a few stores & a minute of event time, like a real micro-batch
+        spark.range(rows).select(
+            F.concat(F.lit("req-"), F.lit(b), F.lit("-"),
+                     F.col("id").cast("string")).alias("request_id"),
+            F.concat(F.lit("store_"), (F.lit(b) % 7 + F.col("id") % 3 + 1).cast("string")).alias("store_id"),
+            F.date_format((F.lit(1616276342 + b * 60) + F.col("id") * 60 / rows).cast("timestamp"),
+                          "yyyy-MM-dd'T'HH:mm:ss.SSSSSS").alias("evnt_time"),
+            F.round(F.rand(b) * 100, 2).alias("sales"),
+            F.when(F.col("id") % 3 == 0, F.lit("inventory-events")).otherwise(
+                F.lit("sales-events")).alias("evnt_type"),
+        ).repartition(2, "store_id").write.mode("append").partitionBy("evnt_type").parquet(root)
+        _new = [
+            os.path.join(d, f) for d, _, names in os.walk(root) if MANIFEST_DIR not in d
+            for f in names if f.endswith(".parquet") and os.path.getmtime(os.path.join(d, f)) * 1000 >= t
+        ]
+        manifest.commit(add=file_stats(spark, fs, _new, root), batch_id=b)
+
+
+if __name__ == "__main__":
+    from pyspark.sql import SparkSession
+
+    parser = argparse.ArgumentParser(
+        description="Plan & read a manifest table on a local directory")
+    parser.add_argument("root")
+    parser.add_argument("--seed-demo", type=int, default=0, metavar="BATCHES",
+                        help="Write & commit this many micro-batches under a fresh root first")
+    parser.add_argument("--filter", nargs=3, action="append", default=[],
+                        metavar=("COL", "OP", "VALUE"))
+    parser.add_argument("--version", type=int)
+    cli = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    spark = SparkSession.builder.master("local[*]").appName(
+        "table_manifest").getOrCreate()
+    spark.sparkContext.setLogLevel("ERROR")
+    if cli.seed_demo:
+        shutil.rmtree(cli.root, ignore_errors=True)
+        _seed_demo(spark, cli.root, cli.seed_demo)
+    _filters = [parse_filter(c, op, v, float if c == "sales" else str)
+                for c, op, v in cli.filter]
+    t = time.perf_counter()
+    df, stats = read(spark, cli.root, _filters, cli.version, LocalFs())
+    stats["rows_matched"] = df.count() if df is not None else 0
+    stats["manifest_read_secs"] = round(time.perf_counter() - t, 3)
+    # The same query on a listing of the whole prefix, the rows must match
+    t = time.perf_counter()
+    _full = spark.read.parquet(cli.root)
+    for f in _filters:
+        _full = _full.filter(column_filter(*f))
+    stats["listing_rows_matched"] = _full.count()
+    stats["listing_read_secs"] = round(time.perf_counter() - t, 3)
+    print(json.dumps(stats, indent=2))
@@ -1,9 +1,12 @@
 from aws_cdk import aws_iam as _iam
+from aws_cdk import aws_dynamodb as _dynamodb
 from aws_cdk import aws_logs as _logs
 from aws_cdk import aws_glue as _glue
 from aws_cdk import aws_s3_assets as _s3_assets
 from aws_cdk import core as cdk
 from stacks.miztiik_global_args import GlobalArgs
+from stacks.back_end.glue_stacks.glue_job_scripts import sales_rollups
+from stacks.back_end.glue_stacks.glue_curated_table import GlueCuratedTable
 
 
 class GlueJobStack(cdk.Stack):
@@ -50,7 +53,8 @@ class GlueJobStack(cdk.Stack):
         self._glue_etl_role.add_to_policy(
             _iam.PolicyStatement(
                 actions=[
-                    "kinesis:DescribeStream"
+                    "kinesis:DescribeStream",
+                    "kinesis:DescribeStreamSummary"
                 ],
                 resources=[
                     f"{src_stream.stream_arn}"
@@ -60,6 +64,19 @@ class GlueJobStack(cdk.Stack):
 
         src_stream.grant_read(self._glue_etl_role)
 
+        # Put-if-absent of the table manifest commits, the boto3 of glue 2.0(python 3.7) has no S3 conditional writes
+        _manifest_lock_tbl = _dynamodb.Table(
+            self,
+            "manifestCommitsTable",
+            partition_key=_dynamodb.Attribute(
+                name="path",
+                type=_dynamodb.AttributeType.STRING
+            ),
+            billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=cdk.RemovalPolicy.DESTROY
+        )
+        _manifest_lock_tbl.grant_read_write_data(self._glue_etl_role)
+
         # Create the Glue job to convert incoming JSON to parquet
         # Read GlueSpark Code
         try:
@@ -79,7 +96,43 @@ class GlueJobStack(cdk.Stack):
             path="stacks/back_end/glue_stacks/glue_job_scripts/kinesis_streams_batch_to_s3_etl.py"
         )
 
+        # Wire format helpers shared with the producer & the job's own modules, shipped as --extra-py-files
+        _py_uris = {}
+        for _py in [
+            "serverless_kinesis_producer_stack/lambda_src/kpl_aggregation.py",
+            "serverless_kinesis_producer_stack/lambda_src/wire_serializers.py",
+            "serverless_kinesis_producer_stack/lambda_src/frame_codec.py",
+            "glue_stacks/glue_job_scripts/batch_metrics.py",
+            "glue_stacks/glue_job_scripts/schema_registry.py",
+            "glue_stacks/glue_job_scripts/stream_dedup.py",
+            "glue_stacks/glue_job_scripts/sales_rollups.py",
+            "glue_stacks/glue_job_scripts/stream_etl_core.py",
+            "glue_stacks/glue_job_scripts/batch_controller.py",
+            "glue_stacks/glue_job_scripts/table_manifest.py",
+            "glue_stacks/glue_job_scripts/parquet_layout.py",
+            "glue_stacks/glue_job_scripts/catalog_partitions.py",
+        ]:
+            _py_name = _py.split("/")[-1][:-3]
+            _py_asset = _s3_assets.Asset(
+                self,
+                f"{_py_name}Asset",
+                path=f"stacks/back_end/{_py}"
+            )
+            _py_uris[_py_name] = f"s3://{_py_asset.s3_bucket_name}/{_py_asset.s3_object_key}"
+
         self.etl_prefix = "stream-etl"
+        self.gold_prefix = f"{self.etl_prefix}-gold"
+        # Shared by the job & the curated table, the table partitions match the paths the job writes
+        _schema_version = "2"
+        _partition_mode = "ingest_time"
+        _partition_cols = "evnt_type"
+        # snappy | gzip | uncompressed. zstd needs glue 3.0+, the jobs run on glue 2.0
+        _parquet_codec = "snappy"
+        if _parquet_codec not in ("snappy", "gzip", "uncompressed"):
+            raise ValueError(
+                f"parquet_codec {_parquet_codec} is not supported by glue 2.0")
+        # Not the crawler table name(sales_txns_in_parquet_stream_etl), the crawler could create that one first
+        self.curated_table_name = "sales_txns_stream_etl_curated"
         _glue_etl_job = _glue.CfnJob(
             self,
             "glueJsonToParquetJob",
@@ -97,6 +150,36 @@ class GlueJobStack(cdk.Stack):
                 "--src_tbl_name": glue_table_name,
                 "--datalake_bkt_name": etl_bkt.bucket_name,
                 "--datalake_bkt_prefix": f"{self.etl_prefix}/",
+                "--src_stream_name": src_stream.stream_name,
+                "--src_stream_endpoint": f"https://kinesis.{cdk.Aws.REGION}.amazonaws.com",
+                "--kpl_aggregated": "false",
+                "--wire_format": "json",
+                "--compressed_frames": "false",
+                "--persist_batch": "false",
+                "--schema_version": _schema_version,
+                "--quarantine_prefix": f"{self.etl_prefix}-quarantine/",
+                "--dedup_watermark": "off",
+                "--gold_prefix": f"{self.gold_prefix}/",
+                "--rollup_watermark": "15 minutes",
+                "--partition_mode": _partition_mode,
+                "--partition_cols": _partition_cols,
+                "--metrics_namespace": "MiztiikAutomation/StreamEtl",
+                "--batch_controller": "off",
+                "--latency_slo_secs": "120",
+                "--window_bounds_secs": "10,300",
+                "--fetch_records_bounds": "10000,500000",
+                "--fetch_interval_ms_bounds": "200,5000",
+                "--table_manifest": "true",
+                "--manifest_lock_table": _manifest_lock_tbl.table_name,
+                "--parquet_codec": _parquet_codec,
+                "--parquet_row_group_mb": "128",
+                "--parquet_page_kb": "1024",
+                "--parquet_dictionary": "true",
+                "--sort_cols": "off",
+                "--catalog_db": glue_db_name,
+                "--catalog_table": self.curated_table_name,
+                "--additional-python-modules": "msgpack,fastavro,zstandard",
+                "--extra-py-files": ",".join(_py_uris.values()),
                 "--job-bookmark-option": "job-bookmark-enable"
             },
             allocated_capacity=1,
@@ -122,6 +205,128 @@ class GlueJobStack(cdk.Stack):
         )
         _glue_etl_job_trigger.add_depends_on(_glue_etl_job)
 
+        # Compact the small files of the closed partitions, the streaming job writes one or more every window
+        compaction_script_asset = _s3_assets.Asset(
+            self,
+            "compactionScriptAsset",
+            path="stacks/back_end/glue_stacks/glue_job_scripts/compact_stream_etl_parquet.py"
+        )
+        compaction_lib_asset = _s3_assets.Asset(
+            self,
+            "parquet_compactionAsset",
+            path="stacks/back_end/glue_stacks/glue_job_scripts/parquet_compaction.py"
+        )
+        _py_uris["parquet_compaction"] = f"s3://{compaction_lib_asset.s3_bucket_name}/{compaction_lib_asset.s3_object_key}"
+        _glue_compaction_job = _glue.CfnJob(
+            self,
+            "glueParquetCompactionJob",
+            name="stream-etl-compactor",
+            description="Glue Job to compact the small parquet files written by the streaming etl job",
+            role=self._glue_etl_role.role_arn,
+            glue_version="2.0",
+            command=_glue.CfnJob.JobCommandProperty(
+                name="glueetl",
+                script_location=f"s3://{compaction_script_asset.s3_bucket_name}/{compaction_script_asset.s3_object_key}",
+                python_version="3"
+            ),
+            default_arguments={
+                "--datalake_bkt_name": etl_bkt.bucket_name,
+                "--datalake_bkt_prefix": f"{self.etl_prefix}/",
+                "--target_file_mb": "128",
+                "--small_file_mb": "64",
+                "--min_small_files": "2",
+                # Listing readers see the old & new files of a swap at once, past the last writer & reader of a partition
+                "--closed_after_mins": "120",
+                "--gold_prefix": f"{self.gold_prefix}/",
+                "--dry_run": "false",
+                "--table_manifest": "true",
+                "--manifest_lock_table": _manifest_lock_tbl.table_name,
+                "--parquet_codec": _parquet_codec,
+                "--parquet_row_group_mb": "16",
+                "--parquet_page_kb": "1024",
+                "--parquet_dictionary": "true",
+                "--sort_cols": "store_id,category",
+                "--extra-py-files": ",".join([_py_uris["parquet_compaction"], _py_uris["sales_rollups"], _py_uris["table_manifest"], _py_uris["parquet_layout"]])
+            },
+            number_of_workers=2,
+            worker_type="G.1X",
+            max_retries=0,
+            execution_property=_glue.CfnJob.ExecutionPropertyProperty(
+                max_concurrent_runs=1)
+        )
+
+        # Configure a Trigger - Every hour, half past, away from the crawler
+        _glue_compaction_job_trigger = _glue.CfnTrigger(
+            self,
+            "glueCompactionJobtrigger",
+            type="SCHEDULED",
+            description="Miztiik Automation: Trigger parquet compaction glue job every hour",
+            schedule="cron(30 * * * ? *)",
+            start_on_creation=True,
+            actions=[_glue.CfnTrigger.ActionProperty(
+                job_name=f"{_glue_compaction_job.name}",
+                timeout=30
+            )
+            ]
+        )
+        _glue_compaction_job_trigger.add_depends_on(_glue_compaction_job)
+
+        # Gold table of the sales rollups. Partition projection, no crawler needed for the partitions
+        _gold_tbl = _glue.CfnTable(
+            self,
+            "glueSalesRollupsTable",
+            catalog_id=cdk.Aws.ACCOUNT_ID,
+            database_name=glue_db_name,
+            table_input=_glue.CfnTable.TableInputProperty(
+                description="Per minute & per hour sales rollups, sum the partial rows per window",
+                name="sales_rollups_gold",
+                table_type="EXTERNAL_TABLE",
+                parameters={
+                    "classification": "parquet",
+                    "projection.enabled": "true",
+                    "projection.grain.type": "enum",
+                    "projection.grain.values": ",".join(sales_rollups.GRAINS),
+                    "projection.window_date.type": "date",
+                    "projection.window_date.format": "yyyy-MM-dd",
+                    "projection.window_date.range": "2021-01-01,NOW",
+                    "projection.window_hour.type": "integer",
+                    "projection.window_hour.range": "0,23",
+                    "projection.window_hour.digits": "2",
+                    "storage.location.template": f"s3://{etl_bkt.bucket_name}/{self.gold_prefix}/grain=${{grain}}/window_date=${{window_date}}/window_hour=${{window_hour}}/"
+                },
+                partition_keys=[
+                    _glue.CfnTable.ColumnProperty(name=k, type="string")
+                    for k in sales_rollups.PARTITION_KEYS
+                ],
+                storage_descriptor=_glue.CfnTable.StorageDescriptorProperty(
+                    columns=[
+                        _glue.CfnTable.ColumnProperty(
+                            name=c["name"], type=c["type"])
+                        for c in sales_rollups.GOLD_COLUMNS
+                    ],
+                    location=f"s3://{etl_bkt.bucket_name}/{self.gold_prefix}/",
+                    input_format="org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
+                    output_format="org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
+                    serde_info=_glue.CfnTable.SerdeInfoProperty(
+                        serialization_library="org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe"
+                    )
+                )
+            )
+        )
+
+        # Curated table of the etl output. Partition projection for athena, the job still registers the
+        # partitions for the readers that go by the catalog, ex: spark
+        _curated_tbl = GlueCuratedTable(
+            self,
+            "curatedSalesTxnsTable",
+            glue_db_name=glue_db_name,
+            table_name=self.curated_table_name,
+            location=f"s3://{etl_bkt.bucket_name}/{self.etl_prefix}/",
+            partition_mode=_partition_mode,
+            partition_cols=_partition_cols,
+            schema_version=_schema_version
+        )
+
         ###########################################
         ################# OUTPUTS #################
         ###########################################
@@ -138,3 +343,17 @@ class GlueJobStack(cdk.Stack):
             value=f"https://console.aws.amazon.com/gluestudio/home?region={cdk.Aws.REGION}#/jobs",
             description="Glue ETL Job.",
         )
+
+        output_2 = cdk.CfnOutput(
+            self,
+            "ParquetCompactionGlueJob",
+            value=f"{_glue_compaction_job.name}",
+            description="Glue Job compacting the small parquet files.",
+        )
+
+        output_3 = cdk.CfnOutput(
+            self,
+            "SalesRollupsGoldTable",
+            value=f"{_gold_tbl.ref}",
+            description="Glue Table of the per minute & per hour sales rollups.",
+        )
@@ -1,6 +1,7 @@
 from aws_cdk import aws_glue as _glue
 from aws_cdk import core as cdk
 from stacks.miztiik_global_args import GlobalArgs
+from stacks.back_end.glue_stacks.glue_job_scripts import schema_registry
 
 
 class GlueTableStack(cdk.Stack):
@@ -69,12 +70,12 @@ class GlueTableStack(cdk.Stack):
                 # ],
                 table_type="EXTERNAL_TABLE",
                 storage_descriptor=_glue.CfnTable.StorageDescriptorProperty(
-                    # columns=[
-                    #     {
-                    #         "name": "marketplace",
-                    #         "type": "string"
-                    #     }
-                    # ],
+                    # Latest registered event schema, the etl job parses with the version it is pinned to
+                    columns=[
+                        _glue.CfnTable.ColumnProperty(
+                            name=c["name"], type=c["type"])
+                        for c in schema_registry.glue_columns()
+                    ],
                     location=f"{src_stream.stream_name}",
                     parameters={
                         "endpointUrl": f"https://kinesis.{cdk.Aws.REGION}.amazonaws.com",
@@ -0,0 +1,147 @@
+"""
+In memory metrics for lambda functions, flushed once per invocation as CloudWatch Embedded Metric Format(EMF).
+Ref: https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+"""
+
+import json
+import math
+import random
+import threading
+import time
+
+
+# Histogram values are folded into log spaced buckets, each 25% wider than the previous.
+# EMF allows 100 distinct values per metric, this covers 0.01 - 1,000,000 in ~83 buckets
+_BUCKET_RATIO = 1.25
+_LOG_RATIO = math.log(_BUCKET_RATIO)
+EMF_MAX_VALUES = 100
+
+
+def _bucket(v):
+    if v <= 0:
+        return 0
+    return round(_BUCKET_RATIO ** math.ceil(math.log(v) / _LOG_RATIO), 4)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = {}
+        self.n = 0
+        self.tot = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, v):
+        b = _bucket(v)
+        self.counts[b] = self.counts.get(b, 0) + 1
+        self.n += 1
+        self.tot += v
+        self.min = v if self.min is None else min(self.min, v)
+        self.max = v if self.max is None else max(self.max, v)
+
+    def percentile(self, p):
+        """ Upper bound of the bucket holding the p-th percentile """
+        if not self.n:
+            return 0
+        _rank = p / 100 * self.n
+        _seen = 0
+        for b in sorted(self.counts):
+            _seen += self.counts[b]
+            if _seen >= _rank:
+                return b
+        return self.max
+
+    def emf_value(self):
+        _vals = sorted(self.counts)[:EMF_MAX_VALUES]
+        return {"Values": _vals, "Counts": [self.counts[v] for v in _vals]}
+
+    def summary(self):
+        return {
+            "count": self.n,
+            "avg": round(self.tot / self.n, 3) if self.n else 0,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+        }
+
+
+class Metrics:
+    """
+    Counters & latency histograms, keyed by metric name and optional extra dimensions(ex: evnt_type).
+    Every dimension set is flushed as its own EMF log line. Safe to update from many threads.
+    """
+
+    def __init__(self, namespace, dimensions=None, log_sample_rate=0.0, emit=print):
+        self.namespace = namespace
+        self.dimensions = dict(dimensions or {})
+        self.log_sample_rate = log_sample_rate
+        self.emit = emit
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._counters = {}
+        self._hists = {}
+        self._units = {}
+
+    @staticmethod
+    def _key(dims):
+        return tuple(sorted(dims.items())) if dims else ()
+
+    def incr(self, name, value=1, unit="Count", dims=None):
+        _k = self._key(dims)
+        with self._lock:
+            _c = self._counters.setdefault(_k, {})
+            _c[name] = _c.get(name, 0) + value
+            self._units[name] = unit
+
+    def observe(self, name, value, unit="Milliseconds", dims=None):
+        _k = self._key(dims)
+        with self._lock:
+            self._hists.setdefault(_k, {}).setdefault(
+                name, Histogram()).observe(value)
+            self._units[name] = unit
+
+    def sample_record(self):
+        """ True for the share of records that should still be logged in full """
+        return self.log_sample_rate > 0 and random.random() < self.log_sample_rate
+
+    def summary(self):
+        with self._lock:
+            out = {}
+            for _k in set(self._counters) | set(self._hists):
+                _label = ",".join(f"{k}={v}" for k, v in _k) or "all"
+                _s = dict(self._counters.get(_k, {}))
+                for name, h in self._hists.get(_k, {}).items():
+                    _s[name] = h.summary()
+                out[_label] = _s
+            return out
+
+    def flush(self):
+        """ Write one EMF document per dimension set & start over """
+        with self._lock:
+            _ts = int(time.time() * 1000)
+            for _k in set(self._counters) | set(self._hists):
+                _dims = dict(self.dimensions)
+                _dims.update(dict(_k))
+                doc = {
+                    "_aws": {
+                        "Timestamp": _ts,
+                        "CloudWatchMetrics": [{
+                            "Namespace": self.namespace,
+                            "Dimensions": [list(_dims)],
+                            "Metrics": [],
+                        }],
+                    },
+                }
+                doc.update(_dims)
+                _metrics = doc["_aws"]["CloudWatchMetrics"][0]["Metrics"]
+                for name, v in self._counters.get(_k, {}).items():
+                    _metrics.append({"Name": name, "Unit": self._units[name]})
+                    doc[name] = v
+                for name, h in self._hists.get(_k, {}).items():
+                    _metrics.append({"Name": name, "Unit": self._units[name]})
+                    doc[name] = h.emf_value()
+                self.emit(json.dumps(doc))
+            self._reset()
@@ -7,6 +7,9 @@ import random
 import boto3
 from botocore.exceptions import ClientError
 
+# From the common lambda layer
+from lambda_metrics import Metrics
+
 
 """
 .. module: eventbridge_data_consumer
@@ -29,6 +32,10 @@ class GlobalArgs:
     MODULE_NAME = "eventbridge_data_consumer"
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
     RELIABLE_QUEUE_NAME = os.getenv("RELIABLE_QUEUE_NAME")
+    METRICS_NAMESPACE = os.getenv(
+        "METRICS_NAMESPACE", "MiztiikAutomation/EventsConsumer")
+    # Share of the events that are still logged in full, 0 - None, 1 - All
+    LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.01))
 
 
 def set_logging(lv=GlobalArgs.LOG_LEVEL):
@@ -41,6 +48,12 @@ def set_logging(lv=GlobalArgs.LOG_LEVEL):
 
 LOG = set_logging()
 sqs_client = boto3.client("sqs")
+metrics = Metrics(
+    GlobalArgs.METRICS_NAMESPACE,
+    dimensions={"function_name": os.getenv(
+        "AWS_LAMBDA_FUNCTION_NAME", GlobalArgs.MODULE_NAME)},
+    log_sample_rate=GlobalArgs.LOG_SAMPLE_RATE,
+)
 
 
 def _rand_coin_flip():
@@ -51,15 +64,46 @@ def _rand_coin_flip():
     return r
 
 
+def _consume(evnt):
+    if metrics.sample_record():
+        LOG.info(f"Event: {json.dumps(evnt)}")
+    metrics.incr("events_received", dims={
+                 "detail_type": evnt.get("detail-type", "unknown")})
+
+
 def lambda_handler(event, context):
-    resp = {"status": False}
-    LOG.info(f"Event: {json.dumps(event)}")
-    resp["status"] = True
-    LOG.info(f'{{"resp":{json.dumps(resp)}}}')
+    """
+    A batch of the sqs queue the eventbridge rule delivers to, or a single eventbridge event. A message that is
+    not an event is counted & dropped, a retry would not fix it. Only the messages that failed to process are
+    reported in batchItemFailures, sqs delivers those again
+    """
+    resp = {"status": False, "events": 0, "bad_messages": 0}
+    failures = []
+    for rec in event.get("Records", [event]):
+        try:
+            evnt = json.loads(rec["body"]) if "body" in rec else rec
+        except ValueError:
+            resp["bad_messages"] += 1
+            if metrics.sample_record():
+                LOG.info(json.dumps(
+                    {"undecodable_message": rec["body"][:512]}))
+            continue
+        try:
+            _consume(evnt)
+            resp["events"] += 1
+        except Exception as e:
+            LOG.error(f'{{"message_failed":{json.dumps(str(e))}}}')
+            if "messageId" in rec:
+                failures.append({"itemIdentifier": rec["messageId"]})
+    metrics.incr("bad_messages", resp["bad_messages"])
+    resp["status"] = not failures
+    LOG.debug(f'{{"resp":{json.dumps(resp)}}}')
+    metrics.flush()
 
     return {
         "statusCode": 200,
         "body": json.dumps({
             "message": resp
-        })
+        }),
+        "batchItemFailures": failures,
     }
@@ -1,8 +1,8 @@
-from aws_cdk import aws_iam as _iam
 from aws_cdk import aws_lambda as _lambda
 from aws_cdk import aws_events as _evnts
 from aws_cdk import aws_events_targets as _evnts_tgt
 from aws_cdk import aws_logs as _logs
+from aws_cdk import aws_sqs as _sqs
 from aws_cdk import core
 
 
@@ -33,30 +33,31 @@ class ServerlessEventBridgeConsumerStack(core.Stack):
 
         # Add your stack resources below)
 
-        # Read Lambda Code
-        try:
-            with open("stacks/back_end/serverless_eventbridge_consumer_stack/lambda_src/eventbridge_data_consumer.py",
-                      encoding="utf-8",
-                      mode="r"
-                      ) as f:
-                msg_consumer_fn_code = f.read()
-        except OSError:
-            print("Unable to read Lambda Function Code")
-            raise
+        # Helper modules shared by our functions, ex: lambda_metrics
+        common_layer = _lambda.LayerVersion(
+            self,
+            "commonLambdaLayer",
+            code=_lambda.Code.from_asset(
+                "stacks/back_end/lambda_layers/common"),
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_7],
+            description="Miztiik Automation: Common helpers for lambda functions"
+        )
+
         msg_consumer_fn = _lambda.Function(
             self,
             "msgConsumerFn",
             function_name=f"events_consumer_fn",
             description="Process messages in EventBridge queue",
             runtime=_lambda.Runtime.PYTHON_3_7,
-            code=_lambda.InlineCode(
-                msg_consumer_fn_code),
-            handler="index.lambda_handler",
-            timeout=core.Duration.seconds(3),
-            reserved_concurrent_executions=1,
+            code=_lambda.Code.from_asset(
+                "stacks/back_end/serverless_eventbridge_consumer_stack/lambda_src"),
+            handler="eventbridge_data_consumer.lambda_handler",
+            layers=[common_layer],
+            timeout=core.Duration.seconds(30),
             environment={
                 "LOG_LEVEL": f"{stack_log_level}",
-                "APP_ENV": "Production"
+                "APP_ENV": "Production",
+                "LOG_SAMPLE_RATE": "0.01"
             }
         )
 
@@ -77,14 +78,35 @@ class ServerlessEventBridgeConsumerStack(core.Stack):
             retention=_logs.RetentionDays.ONE_DAY
         )
 
-        # Restrict Produce Lambda to be invoked only from the stack owner account
-        msg_consumer_fn.add_permission(
-            "restrictLambdaInvocationToOwnAccount",
-            principal=_iam.AccountRootPrincipal(),
-            action="lambda:InvokeFunction",
-            source_account=core.Aws.ACCOUNT_ID,
-            source_arn=orders_bus.event_bus_arn
+        # The rule delivers to a queue, the consumer takes it in batches. A lambda target would be invoked once
+        # per event, at thousands of events per second
+        msg_consumer_dlq = _sqs.Queue(
+            self,
+            "msgConsumerDeadLetterQueue",
+            retention_period=core.Duration.days(14),
+        )
+        self.msg_consumer_q = _sqs.Queue(
+            self,
+            "msgConsumerQueue",
+            # At least 6x the function timeout, a batch in flight is not delivered twice
+            visibility_timeout=core.Duration.seconds(180),
+            retention_period=core.Duration.days(4),
+            dead_letter_queue=_sqs.DeadLetterQueue(
+                max_receive_count=5, queue=msg_consumer_dlq),
         )
+        self.msg_consumer_q.grant_consume_messages(msg_consumer_fn)
+
+        msg_consumer_esm = _lambda.EventSourceMapping(
+            self,
+            "msgConsumerEventSource",
+            target=msg_consumer_fn,
+            event_source_arn=self.msg_consumer_q.queue_arn,
+            batch_size=1000,
+            max_batching_window=core.Duration.seconds(1),
+        )
+        # Set on the resource itself, portable to the older cdk releases that do not know this prop
+        msg_consumer_esm.node.default_child.add_property_override(
+            "FunctionResponseTypes", ["ReportBatchItemFailures"])
 
         # Event Pattern
         self.orders_pattern = _evnts.EventPattern(
@@ -100,21 +122,13 @@ class ServerlessEventBridgeConsumerStack(core.Stack):
             event_bus=orders_bus,
             event_pattern=self.orders_pattern,
             rule_name="orders_routing_to_consumer",
-            targets=[_evnts_tgt.LambdaFunction(handler=msg_consumer_fn)]
+            targets=[_evnts_tgt.SqsQueue(self.msg_consumer_q)]
         )
 
         self.orders_routing.apply_removal_policy(
             core.RemovalPolicy.DESTROY
         )
 
-        # Restrict Produce Lambda to be invoked only from the stack owner account
-        data_producer_fn.add_permission(
-            "restrictLambdaInvocationToFhInOwnAccount",
-            principal=_iam.AccountRootPrincipal(),
-            action="lambda:InvokeFunction",
-            source_account=core.Aws.ACCOUNT_ID
-        )
-
         ###########################################
         ################# OUTPUTS #################
         ###########################################
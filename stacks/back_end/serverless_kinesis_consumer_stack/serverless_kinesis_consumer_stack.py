@@ -0,0 +1,261 @@
+from aws_cdk import aws_events as _evnts
+from aws_cdk import aws_iam as _iam
+from aws_cdk import aws_kinesis as _kinesis
+from aws_cdk import aws_lambda as _lambda
+from aws_cdk import aws_logs as _logs
+from aws_cdk import aws_sqs as _sqs
+from aws_cdk import core as cdk
+from stacks.miztiik_global_args import GlobalArgs
+
+
+class ServerlessKinesisConsumerStack(cdk.Stack):
+    def __init__(
+        self,
+        scope: cdk.Construct,
+        construct_id: str,
+        stack_log_level: str,
+        src_stream,
+        batch_size: int = 10000,
+        batching_window_secs: int = 5,
+        parallelization_factor: int = 2,
+        **kwargs
+    ) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+
+        # Add your stack resources below):
+
+        ########################################
+        #######                          #######
+        #######   Stream Batch Consumer  #######
+        #######                          #######
+        ########################################
+
+        # Helper modules shared by our functions, ex: lambda_metrics
+        common_layer = _lambda.LayerVersion(
+            self,
+            "commonLambdaLayer",
+            code=_lambda.Code.from_asset(
+                "stacks/back_end/lambda_layers/common"),
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_7],
+            description="Miztiik Automation: Common helpers for lambda functions",
+        )
+
+        # The consumer decodes with the producer's codecs, ship the same lambda_src
+        stream_consumer_fn = _lambda.Function(
+            self,
+            "streamBatchConsumerFn",
+            function_name=f"stream_consumer_{construct_id}",
+            description="Decode, validate & aggregate batches of kinesis records",
+            runtime=_lambda.Runtime.PYTHON_3_7,
+            code=_lambda.Code.from_asset(
+                "stacks/back_end/serverless_kinesis_producer_stack/lambda_src"),
+            handler="kinesis_batch_consumer.lambda_handler",
+            layers=[common_layer],
+            # A 10k record batch of up to 6MB, decoding is cpu bound & cpu comes with memory
+            memory_size=1024,
+            timeout=cdk.Duration.seconds(60),
+            environment={
+                "LOG_LEVEL": f"{stack_log_level}",
+                "APP_ENV": "Production",
+                "LOG_SAMPLE_RATE": "0.01",
+                "DEADLINE_MARGIN_MS": "5000",
+            },
+        )
+
+        # Grant our Lambda Consumer privileges to read from the Kinesis Data Stream
+        src_stream.grant_read(stream_consumer_fn)
+
+        # Enhanced fan-out, a pipe of 2MB/s per shard of its own. The shared GetRecords limit(5 reads/s, 2MB/s
+        # per shard) is left to the glue job, else the three readers throttle each other
+        stream_consumer_efo = _kinesis.CfnStreamConsumer(
+            self,
+            "streamBatchConsumerEfo",
+            consumer_name=f"stream_consumer_{construct_id}",
+            stream_arn=src_stream.stream_arn,
+        )
+        stream_consumer_fn.add_to_role_policy(
+            _iam.PolicyStatement(
+                actions=[
+                    "kinesis:SubscribeToShard",
+                    "kinesis:DescribeStreamConsumer"
+                ],
+                resources=[
+                    f"{stream_consumer_efo.attr_consumer_arn}"
+                ]
+            )
+        )
+
+        # Batches that still fail after the retries, as pointers to the shard & sequence numbers
+        consumer_failures_q = _sqs.Queue(
+            self,
+            "streamConsumerFailuresQueue",
+            retention_period=cdk.Duration.days(14),
+        )
+        consumer_failures_q.grant_send_messages(stream_consumer_fn)
+
+        stream_consumer_esm = _lambda.EventSourceMapping(
+            self,
+            "streamConsumerEventSource",
+            target=stream_consumer_fn,
+            event_source_arn=stream_consumer_efo.attr_consumer_arn,
+            starting_position=_lambda.StartingPosition.LATEST,
+            batch_size=batch_size,
+            max_batching_window=cdk.Duration.seconds(batching_window_secs),
+            # Concurrent batches per shard, the records of a partition key stay in order
+            parallelization_factor=parallelization_factor,
+            # Retries start from the reported record, bisecting isolates the rest
+            bisect_batch_on_error=True,
+            retry_attempts=5,
+            max_record_age=cdk.Duration.hours(1),
+        )
+        # Set on the resource itself, portable to the older cdk releases that do not know these props
+        stream_consumer_esm.node.default_child.add_property_override(
+            "FunctionResponseTypes", ["ReportBatchItemFailures"])
+        stream_consumer_esm.node.default_child.add_property_override(
+            "DestinationConfig.OnFailure.Destination", consumer_failures_q.queue_arn)
+
+        stream_consumer_lg = _logs.LogGroup(
+            self,
+            "streamBatchConsumerFnLogGroup",
+            log_group_name=f"/aws/lambda/{stream_consumer_fn.function_name}",
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+            retention=_logs.RetentionDays.ONE_DAY,
+        )
+
+        # Restrict Consumer Lambda to be invoked only from the stack owner account
+        stream_consumer_fn.add_permission(
+            "restrictLambdaInvocationToOwnAccount",
+            principal=_iam.AccountRootPrincipal(),
+            action="lambda:InvokeFunction",
+            source_account=cdk.Aws.ACCOUNT_ID,
+        )
+
+        ########################################
+        #######                          #######
+        #######  Stream To EventBridge   #######
+        #######                          #######
+        ########################################
+
+        # Stream events for the eventbridge rules, ex: detail_type sales-events
+        self.orders_bus = _evnts.EventBus(
+            self,
+            "ordersEventBus",
+            event_bus_name=f"orders_bus_{construct_id}",
+        )
+
+        events_bridge_fn = _lambda.Function(
+            self,
+            "streamToEventBridgeFn",
+            function_name=f"stream_to_eventbridge_{construct_id}",
+            description="Publish the kinesis stream events to the eventbridge bus, in batches",
+            runtime=_lambda.Runtime.PYTHON_3_7,
+            code=_lambda.Code.from_asset(
+                "stacks/back_end/serverless_kinesis_producer_stack/lambda_src"),
+            handler="kinesis_to_eventbridge_fn.lambda_handler",
+            layers=[common_layer],
+            memory_size=512,
+            timeout=cdk.Duration.seconds(60),
+            environment={
+                "LOG_LEVEL": f"{stack_log_level}",
+                "APP_ENV": "Production",
+                "EVENT_BUS_NAME": f"{self.orders_bus.event_bus_name}",
+                "EVNT_SOURCE": "miztiik.stream_etl",
+                "ROUTED_EVNT_TYPES": "sales-events",
+                "PUBLISH_WORKERS": "8",
+                "MAX_SEND_RETRIES": "5",
+                "LOG_SAMPLE_RATE": "0.01",
+                "DEADLINE_MARGIN_MS": "5000",
+            },
+        )
+        src_stream.grant_read(events_bridge_fn)
+        events_bridge_efo = _kinesis.CfnStreamConsumer(
+            self,
+            "streamToEventBridgeEfo",
+            consumer_name=f"stream_to_eventbridge_{construct_id}",
+            stream_arn=src_stream.stream_arn,
+        )
+        events_bridge_fn.add_to_role_policy(
+            _iam.PolicyStatement(
+                actions=[
+                    "kinesis:SubscribeToShard",
+                    "kinesis:DescribeStreamConsumer"
+                ],
+                resources=[
+                    f"{events_bridge_efo.attr_consumer_arn}"
+                ]
+            )
+        )
+        events_bridge_fn.add_to_role_policy(
+            _iam.PolicyStatement(
+                actions=[
+                    "events:PutEvents"
+                ],
+                resources=[
+                    f"{self.orders_bus.event_bus_arn}"
+                ]
+            )
+        )
+
+        # Small batches & a short window, the rules see the events in near real time
+        events_bridge_esm = _lambda.EventSourceMapping(
+            self,
+            "streamToEventBridgeEventSource",
+            target=events_bridge_fn,
+            event_source_arn=events_bridge_efo.attr_consumer_arn,
+            starting_position=_lambda.StartingPosition.LATEST,
+            batch_size=1000,
+            max_batching_window=cdk.Duration.seconds(1),
+            parallelization_factor=parallelization_factor,
+            bisect_batch_on_error=True,
+            retry_attempts=5,
+            max_record_age=cdk.Duration.hours(1),
+        )
+        events_bridge_esm.node.default_child.add_property_override(
+            "FunctionResponseTypes", ["ReportBatchItemFailures"])
+        events_bridge_esm.node.default_child.add_property_override(
+            "DestinationConfig.OnFailure.Destination", consumer_failures_q.queue_arn)
+        consumer_failures_q.grant_send_messages(events_bridge_fn)
+
+        events_bridge_lg = _logs.LogGroup(
+            self,
+            "streamToEventBridgeFnLogGroup",
+            log_group_name=f"/aws/lambda/{events_bridge_fn.function_name}",
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+            retention=_logs.RetentionDays.ONE_DAY,
+        )
+
+        ###########################################
+        ################# OUTPUTS #################
+        ###########################################
+        output_0 = cdk.CfnOutput(
+            self,
+            "AutomationFrom",
+            value=f"{GlobalArgs.SOURCE_INFO}",
+            description="To know more about this automation stack, check out our github page.",
+        )
+
+        output_1 = cdk.CfnOutput(
+            self,
+            "StreamBatchConsumer",
+            value=f"https://console.aws.amazon.com/lambda/home?region={cdk.Aws.REGION}#/functions/{stream_consumer_fn.function_name}",
+            description="Decode, validate & aggregate batches of kinesis records.",
+        )
+
+        output_2 = cdk.CfnOutput(
+            self,
+            "StreamConsumerFailuresQueue",
+            value=f"{consumer_failures_q.queue_url}",
+            description="Kinesis batches the consumer could not process, after the retries.",
+        )
+
+        output_3 = cdk.CfnOutput(
+            self,
+            "StreamToEventBridge",
+            value=f"https://console.aws.amazon.com/lambda/home?region={cdk.Aws.REGION}#/functions/{events_bridge_fn.function_name}",
+            description="Publish the kinesis stream events to the eventbridge bus, in batches.",
+        )
+
+    # properties to share with other stacks
+    @property
+    def get_orders_bus(self):
+        return self.orders_bus
@@ -0,0 +1,152 @@
+"""
+Feed synthetic kinesis event payloads, the shape the event source mapping invokes with, to the batch consumer
+on a laptop & report the records/s of every invocation as JSON.
+
+--fail-at breaks the consumer on that record of the first invocation, like a downstream error would. The batch
+is then retried the way lambda does it, from the reported record on or, with --no-partial, from the start.
+
+    python consumer_load_test.py --batch-size 100 1000 10000 --wire msgpack --aggregate
+    python consumer_load_test.py --batch-size 10000 --fail-at 5000 --corrupt-every 1000
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+from producer_load_test import FakeContext
+
+
+def kinesis_event(batch_size, wire="json", aggregate=False, frame_codec="off", corrupt_every=0, shard_seq=0):
+    """ {"Records": [..]} of batch_size kinesis records of one shard, with the payloads the producer writes """
+    from event_generator import EventGenerator
+    from frame_codec import FrameBuilder
+    from kpl_aggregation import RecordAggregator
+    from wire_serializers import get_serializer
+
+    ser = get_serializer(wire)
+    gen = EventGenerator(seed=7)
+    packer = RecordAggregator() if aggregate else (
+        FrameBuilder(frame_codec) if frame_codec != "off" else None)
+    blobs = []
+    while len(blobs) < batch_size:
+        for evnt in gen.gen_block(500):
+            _d = ser.dumps(evnt)
+            if packer is None:
+                blobs.append(_d)
+                continue
+            _packed = packer.add(evnt["request_id"], _d)
+            if _packed:
+                blobs.append(_packed[1])
+    _now = time.time()
+    records = []
+    for i, blob in enumerate(blobs[:batch_size]):
+        if corrupt_every and i % corrupt_every == corrupt_every - 1:
+            blob = blob[:len(blob) // 2] if packer else b"\x00\x09not an event"
+        _seq = f"{shard_seq + i:056d}"
+        records.append({
+            "kinesis": {
+                "kinesisSchemaVersion": "1.0",
+                "partitionKey": str(i),
+                "sequenceNumber": _seq,
+                "data": base64.b64encode(blob).decode("ascii"),
+                "approximateArrivalTimestamp": _now - 1,
+            },
+            "eventSource": "aws:kinesis",
+            "eventVersion": "1.0",
+            "eventID": f"shardId-000000000000:{_seq}",
+            "eventName": "aws:kinesis:record",
+            "eventSourceARN": "arn:aws:kinesis:us-east-1:111122223333:stream/local_stream",
+        })
+    return {"Records": records}
+
+
+def _invoke(consumer, event, budget_ms):
+    t = time.perf_counter()
+    resp = consumer.lambda_handler(event, FakeContext(budget_ms))
+    _secs = time.perf_counter() - t
+    return resp, _secs
+
+
+def run_batch(consumer, cli, batch_size):
+    event = kinesis_event(batch_size, cli.wire, cli.aggregate,
+                          cli.frame_codec, cli.corrupt_every)
+    _process = consumer.process_records
+    _bad_seq = event["Records"][cli.fail_at]["kinesis"]["sequenceNumber"] if (
+        cli.fail_at is not None and cli.fail_at < batch_size) else None
+    _events = []
+
+    def _counting(records, *args, **kwargs):
+        nonlocal _bad_seq
+        retry_from = None
+        if _bad_seq is not None and records[0]["kinesis"]["sequenceNumber"] <= _bad_seq:
+            # A downstream error on one record of the first invocation only
+            records = [r for r in records if r["kinesis"]
+                       ["sequenceNumber"] < _bad_seq]
+            retry_from, _bad_seq = _bad_seq, None
+        sums, stats, _retry = _process(records, *args, **kwargs)
+        _events.append(stats["events"])
+        return sums, stats, retry_from or _retry
+    consumer.process_records = _counting
+    invocations = []
+    pending = event["Records"]
+    processed = 0
+    while pending:
+        resp, _secs = _invoke(consumer, {"Records": pending}, cli.budget_ms)
+        processed += len(pending)
+        _failed = [f["itemIdentifier"] for f in resp["batchItemFailures"]]
+        invocations.append({"records": len(pending), "events": _events[-1], "secs": round(_secs, 4),
+                            "records_per_sec": int(len(pending) / _secs),
+                            "events_per_sec": int(_events[-1] / _secs),
+                            "retry_from": _failed[0] if _failed else None})
+        if not _failed:
+            break
+        # Lambda retries from the lowest reported record, or the whole batch without a partial report
+        pending = pending if cli.no_partial else [
+            r for r in pending if r["kinesis"]["sequenceNumber"] >= min(_failed)]
+    consumer.process_records = _process
+    return {
+        "batch_size": batch_size,
+        "invocations": invocations,
+        "records_per_sec_first": invocations[0]["records_per_sec"],
+        "events_per_sec_first": invocations[0]["events_per_sec"],
+        "records_handled": processed,
+        "records_retried": processed - batch_size,
+    }
+
+
+if __name__ == "__main__":
+    # Import the producer, consumer & common layer modules, wherever we are run from
+    _here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(
+        _here, "..", "..", "lambda_layers", "common", "python"))
+    sys.path.insert(0, _here)
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the kinesis batch consumer with synthetic event source mapping payloads")
+    parser.add_argument("--batch-size", type=int, nargs="+",
+                        default=[100, 1000, 10000])
+    parser.add_argument("--wire", default="json",
+                        choices=["json", "msgpack", "avro"])
+    parser.add_argument("--aggregate", action="store_true",
+                        help="KPL aggregated records")
+    parser.add_argument("--frame-codec", default="off",
+                        choices=["off", "gzip", "zstd"])
+    parser.add_argument("--corrupt-every", type=int, default=0,
+                        help="Break every n-th kinesis record")
+    parser.add_argument("--fail-at", type=int,
+                        help="Fail the consumer on this record once")
+    parser.add_argument("--no-partial", action="store_true",
+                        help="Retry whole batches, like a consumer without batchItemFailures")
+    parser.add_argument("--budget-ms", type=int, default=60000,
+                        help="Invocation time budget, like the lambda timeout")
+    cli = parser.parse_args()
+
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    import kinesis_batch_consumer
+    # Keep stdout for the report
+    kinesis_batch_consumer.metrics.emit = lambda doc: None
+    print(json.dumps([run_batch(kinesis_batch_consumer, cli, n)
+                      for n in cli.batch_size], indent=2))
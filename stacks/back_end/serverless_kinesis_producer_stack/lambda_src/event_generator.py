@@ -0,0 +1,126 @@
+import datetime
+import os
+import random
+
+# NumPy is optional, the Lambda python runtime does not ship it unless a layer is attached
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+_usr_names = ["Aarakocra", "Aasimar", "Beholder", "Bugbear", "Centaur", "Changeling", "Deep Gnome", "Deva", "Dragonborn", "Drow", "Dwarf", "Eladrin", "Elf", "Firbolg", "Genasi", "Githzerai", "Gnoll", "Gnome", "Goblin", "Goliath", "Hag", "Half-Elf",
+              "Half-Orc", "Halfling"]
+
+_categories = ["Books", "Games", "Mobiles", "Groceries", "Shoes", "Stationaries", "Laptops",
+               "Tablets", "Notebooks", "Camera", "Printers", "Monitors", "Speakers", "Projectors", "Cables", "Furniture"]
+
+_evnt_types = ["sales-events", "inventory-events"]
+
+
+def _store_weights(store_count, skew):
+    # Bounded Zipf, store_1 is the hottest key. skew=0 is uniform
+    w = [1.0 / (k ** skew) for k in range(1, store_count + 1)]
+    tot = sum(w)
+    return [x / tot for x in w]
+
+
+def _bulk_uuid4(n):
+    """ UUID4 strings carved out of one block of random bytes """
+    b = bytearray(os.urandom(16 * n))
+    for i in range(0, 16 * n, 16):
+        b[i + 6] = (b[i + 6] & 0x0F) | 0x40
+        b[i + 8] = (b[i + 8] & 0x3F) | 0x80
+    h = b.hex()
+    return [
+        f"{h[i:i + 8]}-{h[i + 8:i + 12]}-{h[i + 12:i + 16]}-{h[i + 16:i + 20]}-{h[i + 20:i + 32]}"
+        for i in range(0, 32 * n, 32)
+    ]
+
+
+class EventGenerator:
+    """
+    Produce blocks of synthetic store events, in the same shape as sample_records/producer_event.json.
+    Event times of a block are spread evenly between the previous block and now.
+    """
+
+    def __init__(
+        self,
+        store_count=5,
+        store_skew=0.0,
+        bad_msg_rate=0.1,
+        return_rate=0.5,
+        seed=None,
+    ):
+        self.store_ids = [f"store_{i}" for i in range(1, store_count + 1)]
+        self.store_p = _store_weights(store_count, store_skew)
+        self.bad_msg_rate = bad_msg_rate
+        self.return_rate = return_rate
+        self._rng = np.random.default_rng(seed) if np is not None else random.Random(seed)
+        self._last_ts = datetime.datetime.now()
+
+    def _evnt_times(self, n):
+        now = datetime.datetime.now()
+        span_us = max(int((now - self._last_ts).total_seconds() * 1_000_000), n)
+        base = self._last_ts
+        self._last_ts = now
+        if np is not None:
+            offsets = np.linspace(span_us / n, span_us, n).astype("timedelta64[us]")
+            return np.datetime_as_string(np.datetime64(base, "us") + offsets, unit="us").tolist()
+        step = span_us / n
+        return [
+            (base + datetime.timedelta(microseconds=int(step * (i + 1)))
+             ).strftime("%Y-%m-%dT%H:%M:%S.%f")
+            for i in range(n)
+        ]
+
+    def _columns(self, n):
+        if np is not None:
+            rng = self._rng
+            return (
+                rng.choice(_usr_names, size=n).tolist(),
+                rng.choice(_categories, size=n).tolist(),
+                rng.choice(self.store_ids, size=n, p=self.store_p).tolist(),
+                rng.choice(_evnt_types, size=n).tolist(),
+                np.round(rng.random(n) * 100, 2).tolist(),
+                (rng.random(n) < self.return_rate).tolist(),
+                (rng.random(n) < self.bad_msg_rate).tolist(),
+            )
+        rng = self._rng
+        return (
+            rng.choices(_usr_names, k=n),
+            rng.choices(_categories, k=n),
+            rng.choices(self.store_ids, weights=self.store_p, k=n),
+            rng.choices(_evnt_types, k=n),
+            [round(rng.random() * 100, 2) for _ in range(n)],
+            [rng.random() < self.return_rate for _ in range(n)],
+            [rng.random() < self.bad_msg_rate for _ in range(n)],
+        )
+
+    def gen_block(self, n):
+        names, categories, store_ids, evnt_types, sales, is_return, bad_msg = self._columns(n)
+        req_ids = _bulk_uuid4(n)
+        evnt_times = self._evnt_times(n)
+        evnts = []
+        for i in range(n):
+            evnt_body = {
+                "request_id": req_ids[i],
+                "name": names[i],
+                "category": categories[i],
+                "store_id": store_ids[i],
+                "evnt_time": evnt_times[i],
+                "evnt_type": evnt_types[i],
+                "new_order": True,
+                "sales": sales[i],
+                "contact_me": "github.com/miztiik"
+            }
+            # Make the return type order
+            if is_return[i]:
+                del evnt_body["new_order"]
+                evnt_body["is_return"] = True
+            # Remove store_id from message
+            if bad_msg[i]:
+                del evnt_body["store_id"]
+                evnt_body["bad_msg"] = True
+            evnts.append(evnt_body)
+        return evnts
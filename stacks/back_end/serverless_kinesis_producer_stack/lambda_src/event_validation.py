@@ -0,0 +1,15 @@
+"""
+Validation of the store events, shared by the stream consumers. Import only, no logging or metrics set up here.
+"""
+
+REQUIRED_FIELDS = ("request_id", "store_id", "evnt_time", "evnt_type")
+
+
+def invalid_reasons(evnt):
+    """ Why an event can not be used, the same reasons the glue etl quarantines with """
+    reasons = [f"missing_{f}" for f in REQUIRED_FIELDS if not evnt.get(f)]
+    if not isinstance(evnt.get("sales"), (int, float)) or isinstance(evnt.get("sales"), bool):
+        reasons.append("invalid_sales")
+    if evnt.get("bad_msg"):
+        reasons.append("flagged_bad_msg")
+    return reasons
@@ -0,0 +1,361 @@
+"""
+Batched PutEvents for the stream to eventbridge bridge, with a local eventbridge stand-in. To compare one
+PutEvents call per event with batches of 10, sequential & concurrent, from lambda_src,
+
+    python eventbridge_publisher.py --events 5000 --put-latency-ms 20 --fail-rate 0.01 --workers 1 8
+"""
+
+import json
+import logging
+import queue
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+
+logger = logging.getLogger()
+
+# Ref: https://docs.aws.amazon.com/eventbridge/latest/APIReference/API_PutEvents.html
+PUT_EVENTS_MAX_ENTRIES = 10
+PUT_EVENTS_MAX_BYTES = 256 * 1024
+# Errors a retry can fix, of the call or of an entry. An entry failing with any other(MalformedDetail,
+# InvalidArgument..) fails again, it is skipped. A call failing with any other(AccessDenied, ResourceNotFound..)
+# is not retried here, its refs are dropped
+RETRIABLE_ERRORS = {"ThrottlingException", "InternalFailure",
+                    "InternalException", "ServiceUnavailable"}
+
+
+def entry_size(entry):
+    """ Size of a PutEvents entry, the way eventbridge counts it against the request limit """
+    # Ref: https://docs.aws.amazon.com/eventbridge/latest/userguide/eb-putevent-size.html
+    size = 14 if entry.get("Time") is not None else 0
+    size += len(entry["Source"].encode("utf-8"))
+    size += len(entry["DetailType"].encode("utf-8"))
+    size += len(entry.get("Detail", "").encode("utf-8"))
+    size += sum(len(r.encode("utf-8")) for r in entry.get("Resources", []))
+    return size
+
+
+class EventBridgeBatchPublisher:
+    """
+    Buffer entries and ship them with PutEvents, up to 10 entries & 256KB per call.
+    Only the entries that failed in a call are re-sent, with jittered exponential backoff.
+    Every entry carries a ref(ex: the kinesis sequence number), the refs of the dropped entries are kept.
+    Entries no retry can publish, too large or rejected by eventbridge, are counted & skipped, their refs are not kept.
+    """
+
+    def __init__(
+        self,
+        client,
+        event_bus_name,
+        get_remaining_time_in_millis,
+        max_retries=5,
+        backoff_base_ms=50,
+        backoff_cap_ms=1000,
+        min_remaining_ms=100,
+        max_entries=PUT_EVENTS_MAX_ENTRIES,
+        metrics=None,
+    ):
+        self.client = client
+        self.event_bus_name = event_bus_name
+        self.get_remaining_time_in_millis = get_remaining_time_in_millis
+        self.max_retries = max_retries
+        self.backoff_base_ms = backoff_base_ms
+        self.backoff_cap_ms = backoff_cap_ms
+        self.min_remaining_ms = min_remaining_ms
+        self.max_entries = max_entries
+        self.metrics = metrics
+        self._buf = []
+        self._buf_bytes = 0
+        self._stats_lock = threading.Lock()
+        self.dropped_refs = []
+        # epoch second: entries published in it
+        self.published_per_sec = {}
+        self.failed_by_code = {}
+        self.stats = {
+            "batches_sent": 0,
+            "entries_sent": 0,
+            "bytes_sent": 0,
+            "retries": 0,
+            "retried_entries": 0,
+            "dropped_entries": 0,
+            "skipped_entries": 0,
+        }
+
+    def add(self, source, detail_type, detail, ref=None):
+        entry = {"Source": source, "DetailType": detail_type, "Detail": detail,
+                 "EventBusName": self.event_bus_name}
+        _bytes = entry_size(entry)
+        if _bytes > PUT_EVENTS_MAX_BYTES:
+            logger.error(
+                f'{{"entry_too_large":{_bytes},"detail_type":"{detail_type}"}}')
+            self._failed({"EntryTooLarge": 1})
+            self._bump(skipped_entries=1)
+            return
+        if len(self._buf) >= self.max_entries or self._buf_bytes + _bytes > PUT_EVENTS_MAX_BYTES:
+            self.flush()
+        self._buf.append((entry, ref))
+        self._buf_bytes += _bytes
+
+    def flush(self):
+        if not self._buf:
+            return
+        batch = self._buf
+        self._buf = []
+        self._buf_bytes = 0
+        self._dispatch(batch)
+
+    def close(self):
+        self.flush()
+
+    def _dispatch(self, batch):
+        self._send_batch(batch)
+
+    def _bump(self, **counts):
+        with self._stats_lock:
+            for k, v in counts.items():
+                self.stats[k] += v
+
+    def _dropped(self, batch):
+        with self._stats_lock:
+            self.dropped_refs.extend(ref for _, ref in batch if ref is not None)
+
+    def _backoff_ms(self, attempt):
+        # Full jitter, Ref: https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+        return random.uniform(0, min(self.backoff_cap_ms, self.backoff_base_ms * (2 ** attempt)))
+
+    def _put_events(self, batch):
+        """ Returns the entries of the batch to re-send, to skip & to drop """
+        t = time.perf_counter()
+        try:
+            resp = self.client.put_events(Entries=[e for e, _ in batch])
+        except ClientError as e:
+            _code = e.response["Error"]["Code"]
+            logger.warning(
+                f'{{"put_events_failed":"{_code}","entries":{len(batch)}}}')
+            self._failed({_code: len(batch)})
+            return (batch, [], []) if _code in RETRIABLE_ERRORS else ([], [], batch)
+        except (ConnectionError, HTTPClientError) as e:
+            # Connection & read timeouts, the entries may have been published. Rules see them at least once anyway
+            logger.warning(
+                f'{{"put_events_failed":"{type(e).__name__}","entries":{len(batch)}}}')
+            self._failed({type(e).__name__: len(batch)})
+            return batch, [], []
+        finally:
+            if self.metrics:
+                self.metrics.observe(
+                    "put_events_latency", (time.perf_counter() - t) * 1000)
+        _ok = len(batch) - resp.get("FailedEntryCount", 0)
+        with self._stats_lock:
+            _sec = int(time.time())
+            self.published_per_sec[_sec] = self.published_per_sec.get(
+                _sec, 0) + _ok
+        if not resp.get("FailedEntryCount"):
+            return [], [], []
+        failed, skipped = [], []
+        err_codes = {}
+        for item, res in zip(batch, resp["Entries"]):
+            if "ErrorCode" in res:
+                (failed if res["ErrorCode"] in RETRIABLE_ERRORS else skipped).append(item)
+                err_codes[res["ErrorCode"]] = err_codes.get(
+                    res["ErrorCode"], 0) + 1
+        self._failed(err_codes)
+        logger.debug(f'{{"failed_entries":{json.dumps(err_codes)}}}')
+        if skipped:
+            logger.error(
+                f'{{"not_retriable":{json.dumps(err_codes)},"skipped_entries":{len(skipped)}}}')
+        return failed, skipped, []
+
+    def _failed(self, err_codes):
+        with self._stats_lock:
+            for k, v in err_codes.items():
+                self.failed_by_code[k] = self.failed_by_code.get(k, 0) + v
+
+    @staticmethod
+    def _batch_bytes(batch):
+        return sum(entry_size(e) for e, _ in batch)
+
+    def _send_batch(self, batch):
+        tot_entries = len(batch)
+        tot_bytes = self._batch_bytes(batch)
+        skipped, dropped = [], []
+        attempt = 0
+        while True:
+            batch, _skipped, _dropped = self._put_events(batch)
+            skipped += _skipped
+            dropped += _dropped
+            if not batch:
+                break
+            if attempt >= self.max_retries:
+                logger.error(
+                    f'{{"retries_exhausted":true,"dropped_entries":{len(batch)}}}')
+                break
+            _sleep_ms = self._backoff_ms(attempt)
+            if self.get_remaining_time_in_millis() - _sleep_ms < self.min_remaining_ms:
+                logger.error(
+                    f'{{"out_of_time":true,"dropped_entries":{len(batch)}}}')
+                break
+            time.sleep(_sleep_ms / 1000)
+            attempt += 1
+            self._bump(retries=1, retried_entries=len(batch))
+        dropped += batch
+        self._dropped(dropped)
+        self._bump(
+            batches_sent=1,
+            entries_sent=tot_entries - len(dropped) - len(skipped),
+            bytes_sent=tot_bytes - self._batch_bytes(dropped) - self._batch_bytes(skipped),
+            dropped_entries=len(dropped),
+            skipped_entries=len(skipped)
+        )
+
+    def rate_summary(self):
+        """ Entries published per second, over the seconds anything was published """
+        with self._stats_lock:
+            _vals = sorted(self.published_per_sec.values())
+        if not _vals:
+            return {"secs": 0, "avg": 0, "max": 0}
+        return {"secs": len(_vals), "avg": round(sum(_vals) / len(_vals), 1), "max": _vals[-1]}
+
+
+class ConcurrentEventBridgeBatchPublisher(EventBridgeBatchPublisher):
+    """
+    Keep several PutEvents batches in flight from a pool of worker threads sharing one client.
+    The bounded queue applies back pressure, the caller waits when all the workers are busy.
+    """
+
+    def __init__(self, client, event_bus_name, get_remaining_time_in_millis, workers=8, max_queued_batches=None, **kwargs):
+        super().__init__(client, event_bus_name,
+                         get_remaining_time_in_millis, **kwargs)
+        self._q = queue.Queue(maxsize=max_queued_batches or workers * 2)
+        self._workers = [
+            threading.Thread(target=self._worker, name=f"eventbridge_publisher_{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for t in self._workers:
+            t.start()
+
+    def _dispatch(self, batch):
+        self._q.put(batch)
+
+    def _worker(self):
+        while True:
+            batch = self._q.get()
+            if batch is None:
+                break
+            try:
+                self._send_batch(batch)
+            except Exception as e:
+                logger.error(
+                    f'{{"publisher_worker_error":"{str(e)}","dropped_entries":{len(batch)}}}')
+                self._dropped(batch)
+                self._bump(dropped_entries=len(batch))
+
+    def close(self):
+        self.flush()
+        for _ in self._workers:
+            self._q.put(None)
+        for t in self._workers:
+            t.join()
+
+
+class LocalEventBridge:
+    """
+    In process stand-in for the put_events call of the eventbridge client. Accepts max_entries_per_sec
+    in every one second window & fails the rest with ThrottlingException, fails fail_rate of the entries
+    with InternalFailure. Accepted entries are counted per DetailType, like rules matching on detail_type see them.
+    """
+
+    def __init__(self, max_entries_per_sec=10000, put_latency_ms=0, fail_rate=0.0, seed=None):
+        self.max_entries_per_sec = max_entries_per_sec
+        self.put_latency_ms = put_latency_ms
+        self.fail_rate = fail_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window = [0, 0]
+        self.put_calls = 0
+        self.entries = 0
+        self.by_detail_type = {}
+        self.failed = 0
+
+    def put_events(self, Entries):
+        if len(Entries) > PUT_EVENTS_MAX_ENTRIES or sum(entry_size(e) for e in Entries) > PUT_EVENTS_MAX_BYTES:
+            raise ClientError(
+                {"Error": {"Code": "ValidationException", "Message": "PutEvents request over limits"}}, "PutEvents")
+        if self.put_latency_ms:
+            time.sleep(self.put_latency_ms / 1000)
+        res = []
+        failed = 0
+        _now = int(time.time())
+        with self._lock:
+            if self._window[0] != _now:
+                self._window = [_now, 0]
+            for e in Entries:
+                if self._window[1] >= self.max_entries_per_sec:
+                    res.append({"ErrorCode": "ThrottlingException",
+                                "ErrorMessage": "Rate exceeded in local stand-in"})
+                    failed += 1
+                    continue
+                if self.fail_rate and self._rng.random() < self.fail_rate:
+                    res.append({"ErrorCode": "InternalFailure",
+                                "ErrorMessage": "Injected failure in local stand-in"})
+                    failed += 1
+                    continue
+                self._window[1] += 1
+                self.by_detail_type[e["DetailType"]] = self.by_detail_type.get(
+                    e["DetailType"], 0) + 1
+                res.append({"EventId": f"local-{self.put_calls}-{len(res)}"})
+            self.put_calls += 1
+            self.entries += len(Entries) - failed
+            self.failed += failed
+        return {"FailedEntryCount": failed, "Entries": res}
+
+
+def _bench(events, put_latency_ms, fail_rate, max_entries_per_sec, max_entries, workers):
+    from event_generator import EventGenerator
+
+    evnts = EventGenerator(seed=7, bad_msg_rate=0).gen_block(events)
+    stand_in = LocalEventBridge(max_entries_per_sec=max_entries_per_sec,
+                                put_latency_ms=put_latency_ms, fail_rate=fail_rate, seed=7)
+    _args = dict(max_entries=max_entries)
+    pub = ConcurrentEventBridgeBatchPublisher(stand_in, "local_bus", lambda: 60000, workers=workers, **_args) if workers > 1 \
+        else EventBridgeBatchPublisher(stand_in, "local_bus", lambda: 60000, **_args)
+    t = time.perf_counter()
+    for i, e in enumerate(evnts):
+        pub.add("miztiik.stream_etl", e["evnt_type"], json.dumps(e), ref=i)
+    pub.close()
+    _secs = time.perf_counter() - t
+    return {
+        "events": events,
+        "max_entries_per_call": max_entries,
+        "workers": workers,
+        "secs": round(_secs, 3),
+        "entries_per_sec": int(stand_in.entries / _secs),
+        "put_calls": stand_in.put_calls,
+        "published_per_sec": pub.rate_summary(),
+        "failed_by_code": pub.failed_by_code,
+        "by_detail_type": stand_in.by_detail_type,
+        **pub.stats,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark batched PutEvents against a local eventbridge stand-in")
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--put-latency-ms", type=float, default=20,
+                        help="Simulated round trip of every PutEvents call")
+    parser.add_argument("--fail-rate", type=float, default=0.01,
+                        help="Share of the entries failed with InternalFailure")
+    parser.add_argument("--max-entries-per-sec", type=int, default=10000,
+                        help="PutEvents quota of the account & region")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8])
+    cli = parser.parse_args()
+
+    res = [_bench(min(cli.events, 1000), cli.put_latency_ms, cli.fail_rate, cli.max_entries_per_sec, 1, 1)]
+    res += [_bench(cli.events, cli.put_latency_ms, cli.fail_rate, cli.max_entries_per_sec, PUT_EVENTS_MAX_ENTRIES, w)
+            for w in cli.workers]
+    print(json.dumps(res, indent=2))
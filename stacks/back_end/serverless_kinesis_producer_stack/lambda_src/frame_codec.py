@@ -0,0 +1,131 @@
+"""
+Compressed micro-batch frames, many newline delimited JSON events in one kinesis record.
+
+    0x00 0x03 | codec(1 byte) | record count(uint32, big endian) | compressed payload
+
+The 0x00 marker is shared with wire_serializers, 0x03 is the frame format id.
+"""
+
+import gzip
+import struct
+import time
+
+
+FRAME_MARKER = b"\x00\x03"
+_HDR = struct.Struct(">BI")
+_HDR_SIZE = len(FRAME_MARKER) + _HDR.size
+
+_CODEC_IDS = {"gzip": 1, "zstd": 2}
+_CODEC_NAMES = {v: k for k, v in _CODEC_IDS.items()}
+
+# Keep the raw frame under the kinesis record limit, even if it would not compress at all
+FRAME_MAX_RAW_BYTES = 1024 * 1024 - 1024
+FRAME_MAX_RECORDS = 500
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError(
+            "zstd frames need the zstandard package, it is not in the lambda assets. "
+            "Add it to a layer or use FRAME_CODEC=gzip") from e
+    return zstandard
+
+
+def _compressor(codec, level=None):
+    if codec == "gzip":
+        _lvl = 6 if level is None else level
+        return lambda b: gzip.compress(b, compresslevel=_lvl)
+    if codec == "zstd":
+        _c = _zstandard().ZstdCompressor(level=3 if level is None else level)
+        return _c.compress
+    raise ValueError(f"Unknown frame codec:{codec}")
+
+
+def _decompress(codec_id, payload):
+    if codec_id == _CODEC_IDS["gzip"]:
+        return gzip.decompress(payload)
+    if codec_id == _CODEC_IDS["zstd"]:
+        return _zstandard().ZstdDecompressor().decompress(payload)
+    raise ValueError(f"Unknown frame codec id:{codec_id}")
+
+
+def is_frame(blob):
+    return len(blob) > _HDR_SIZE and blob[:len(FRAME_MARKER)] == FRAME_MARKER
+
+
+def expand(blob):
+    """ Events(payloads) in a frame. Anything that is not a frame is returned as is """
+    blob = bytes(blob)
+    if not is_frame(blob):
+        return [blob]
+    codec_id, rec_cnt = _HDR.unpack_from(blob, len(FRAME_MARKER))
+    recs = _decompress(codec_id, blob[_HDR_SIZE:]).split(b"\n")
+    if len(recs) != rec_cnt:
+        raise ValueError(
+            f"Frame says {rec_cnt} records, but holds {len(recs)}")
+    return recs
+
+
+class FrameBuilder:
+    """
+    Collect events into a frame until it holds max_records, or the next one would take it over max_raw_bytes.
+    The kinesis record takes the partition key of the first event in the frame.
+    """
+
+    def __init__(self, codec="gzip", level=None, max_records=FRAME_MAX_RECORDS, max_raw_bytes=FRAME_MAX_RAW_BYTES):
+        self.codec = codec
+        self._compress = _compressor(codec, level)
+        self.max_records = max_records
+        self.max_raw_bytes = max_raw_bytes
+        self.frames = 0
+        # Events in the frame returned last
+        self.last_events = 0
+        self.raw_bytes = 0
+        self.frame_bytes = 0
+        self.compress_secs = 0.0
+        self._reset()
+
+    def _reset(self):
+        self._recs = []
+        self._size = 0
+        self._key = None
+
+    def add(self, partition_key, payload):
+        """ Returns a completed (partition_key, frame) kinesis record, if any """
+        if b"\n" in payload:
+            raise ValueError("Framed events must not hold a newline")
+        done = None
+        if self._recs and (len(self._recs) >= self.max_records or self._size + len(payload) + 1 > self.max_raw_bytes):
+            done = self.flush()
+        if self._key is None:
+            self._key = partition_key
+        self._recs.append(payload)
+        self._size += len(payload) + 1
+        return done
+
+    def flush(self):
+        if not self._recs:
+            return None
+        raw = b"\n".join(self._recs)
+        t = time.perf_counter()
+        body = self._compress(raw)
+        self.compress_secs += time.perf_counter() - t
+        frame = FRAME_MARKER + \
+            _HDR.pack(_CODEC_IDS[self.codec], len(self._recs)) + body
+        self.frames += 1
+        self.last_events = len(self._recs)
+        self.raw_bytes += len(raw)
+        self.frame_bytes += len(frame)
+        key = self._key
+        self._reset()
+        return (key, frame)
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "frame_codec": self.codec,
+            "compression_ratio": round(self.raw_bytes / self.frame_bytes, 2) if self.frame_bytes else 0,
+            "compress_ms_per_frame": round(self.compress_secs * 1000 / self.frames, 3) if self.frames else 0,
+        }
@@ -0,0 +1,148 @@
+"""
+Consumer of the producer stream behind a lambda event source mapping, up to 10k kinesis records per invocation.
+
+Every record is decoded(KPL aggregates, compressed frames & any wire format), its events validated & the valid
+ones summed per evnt_type & store_id. The sums go out once per invocation as metrics.
+
+An event that does not decode or validate is quarantined: counted & sample logged, never retried, it would fail
+again. Only a record the consumer could not process, an unexpected error or the invocation running out of time,
+is reported in batchItemFailures. Lambda then retries the batch from that record on, the records before it were
+summed & are not seen twice. Without the partial report every failure retries the whole batch.
+
+    python consumer_load_test.py --batch-size 100 1000 10000 --fail-at 5000
+"""
+
+import base64
+import json
+import logging
+import os
+import time
+
+from event_validation import invalid_reasons
+from frame_codec import expand
+from kpl_aggregation import deaggregate
+# From the common lambda layer
+from lambda_metrics import Metrics
+from wire_serializers import decode
+
+
+class GlobalArgs:
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    METRICS_NAMESPACE = os.getenv(
+        "METRICS_NAMESPACE", "MiztiikAutomation/StreamConsumer")
+    # Share of the quarantined events that are still logged in full, 0 - None, 1 - All
+    LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.01))
+    # Stop early & report the rest of the batch for a retry, rather than time out on it
+    DEADLINE_MARGIN_MS = int(os.getenv("DEADLINE_MARGIN_MS", 2000))
+
+
+def set_logging(lv=GlobalArgs.LOG_LEVEL):
+    logging.basicConfig(level=lv)
+    logger = logging.getLogger()
+    logger.setLevel(lv)
+    return logger
+
+
+logger = set_logging()
+metrics = Metrics(
+    GlobalArgs.METRICS_NAMESPACE,
+    dimensions={"function_name": os.getenv(
+        "AWS_LAMBDA_FUNCTION_NAME", "kinesis_batch_consumer_local")},
+    log_sample_rate=GlobalArgs.LOG_SAMPLE_RATE,
+)
+
+def _quarantine(stats, reasons, raw):
+    for r in reasons:
+        stats["bad_reasons"][r] = stats["bad_reasons"].get(r, 0) + 1
+    stats["bad_events"] += 1
+    if metrics.sample_record():
+        logger.info(json.dumps({"quarantined": {"reasons": reasons, "raw": raw[:512].decode(
+            "utf-8", errors="replace")}}))
+
+
+def process_records(records, remaining_ms=None, margin_ms=GlobalArgs.DEADLINE_MARGIN_MS):
+    """
+    Sums of the valid events of the kinesis records of one invocation, in order. Returns the sums, the stats &
+    the sequence number to retry from, None when the whole batch is done
+    """
+    sums = {}
+    stats = {"records": 0, "events": 0, "bytes": 0, "bad_events": 0, "bad_records": 0,
+             "bad_reasons": {}, "max_age_ms": 0}
+    retry_from = None
+    _now_ms = time.time() * 1000
+    for rec in records:
+        k = rec["kinesis"]
+        if remaining_ms and remaining_ms() < margin_ms:
+            retry_from = k["sequenceNumber"]
+            stats["stopped_at_deadline"] = True
+            break
+        try:
+            blob = base64.b64decode(k["data"])
+            try:
+                payloads = [p for b in deaggregate(blob) for p in expand(b)]
+            except ImportError:
+                raise
+            except Exception:
+                # A broken aggregate or frame, the whole record is unusable
+                stats["bad_records"] += 1
+                _quarantine(stats, ["undecodable_record"], blob)
+                payloads = []
+            for p in payloads:
+                try:
+                    evnt = decode(p)
+                except ImportError:
+                    # A package missing from the function, not a bad event. The record is retried, not quarantined
+                    raise
+                except Exception:
+                    _quarantine(stats, ["undecodable_event"], p)
+                    continue
+                reasons = invalid_reasons(evnt)
+                if reasons:
+                    _quarantine(stats, reasons, p)
+                    continue
+                _s = sums.get((evnt["evnt_type"], evnt["store_id"]))
+                if _s is None:
+                    _s = sums[(evnt["evnt_type"], evnt["store_id"])] = [
+                        0, 0.0, 0]
+                _s[0] += 1
+                _s[1] += evnt["sales"]
+                _s[2] += 1 if evnt.get("is_return") else 0
+            stats["events"] += len(payloads)
+            stats["bytes"] += len(blob)
+            stats["max_age_ms"] = max(stats["max_age_ms"], int(
+                _now_ms - k.get("approximateArrivalTimestamp", _now_ms / 1000) * 1000))
+        except Exception as e:
+            # Not the data, the consumer. Retry from this record, the sums so far stand
+            logger.error(json.dumps({"record_failed": {
+                "sequence_number": k["sequenceNumber"], "error": str(e)}}))
+            retry_from = k["sequenceNumber"]
+            break
+        stats["records"] += 1
+    return sums, stats, retry_from
+
+
+def lambda_handler(event, context):
+    t = time.perf_counter()
+    records = event.get("Records", [])
+    sums, stats, retry_from = process_records(
+        records, context.get_remaining_time_in_millis if context else None)
+    stats["batch_records"] = len(records)
+    stats["process_ms"] = round((time.perf_counter() - t) * 1000, 1)
+    stats["records_per_sec"] = int(
+        stats["records"] / max(stats["process_ms"], 0.001) * 1000)
+    metrics.incr("kinesis_records", stats["records"])
+    metrics.incr("events", stats["events"])
+    metrics.incr("bytes", stats["bytes"], unit="Bytes")
+    metrics.incr("bad_events", stats["bad_events"])
+    metrics.incr("retried_records", len(records) - stats["records"])
+    metrics.observe("batch_process_ms", stats["process_ms"])
+    metrics.observe("iterator_age_ms", stats["max_age_ms"])
+    for (_evnt_type, _store_id), (_cnt, _sales, _returns) in sums.items():
+        _dims = {"evnt_type": _evnt_type}
+        metrics.incr("valid_events", _cnt, dims=_dims)
+        metrics.incr("tot_sales", round(_sales, 2), unit="None", dims=_dims)
+        metrics.incr("returns", _returns, dims=_dims)
+    metrics.flush()
+    logger.info(json.dumps({"batch": stats}))
+    # Lambda retries from the lowest reported sequence number, the records of a batch are all of one shard
+    return {"batchItemFailures": [{"itemIdentifier": retry_from}] if retry_from else []}
@@ -0,0 +1,246 @@
+import json
+import logging
+import queue
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+
+logger = logging.getLogger()
+
+# Ref: https://docs.aws.amazon.com/kinesis/latest/APIReference/API_PutRecords.html
+PUT_RECORDS_MAX_RECORDS = 500
+PUT_RECORDS_MAX_BYTES = 5 * 1024 * 1024
+PUT_RECORD_MAX_BYTES = 1024 * 1024
+_THROTTLED = "ProvisionedThroughputExceededException"
+# Errors a retry can fix, of the call or of a record. Any other(AccessDenied, ResourceNotFound, KMS access..) fails again
+RETRIABLE_ERRORS = {_THROTTLED, "InternalFailure",
+                    "ServiceUnavailable", "KMSThrottlingException"}
+
+
+class KinesisBatchSender:
+    """
+    Buffer records and ship them with PutRecords, filling each call up to the API limits.
+    Only the entries that failed in a call are re-sent, with jittered exponential backoff.
+    """
+
+    def __init__(
+        self,
+        client,
+        stream_name,
+        get_remaining_time_in_millis,
+        max_retries=5,
+        backoff_base_ms=50,
+        backoff_cap_ms=1000,
+        min_remaining_ms=100,
+        on_throttle=None,
+        pace=None,
+        max_batch_records=PUT_RECORDS_MAX_RECORDS,
+        max_batch_bytes=PUT_RECORDS_MAX_BYTES,
+        metrics=None,
+    ):
+        self.client = client
+        self.stream_name = stream_name
+        self.get_remaining_time_in_millis = get_remaining_time_in_millis
+        self.max_retries = max_retries
+        self.backoff_base_ms = backoff_base_ms
+        self.backoff_cap_ms = backoff_cap_ms
+        self.min_remaining_ms = min_remaining_ms
+        self.on_throttle = on_throttle
+        # Called with every batch right before it is sent, ex: ShardScheduler.pace. False drops the batch, out of time
+        self.pace = pace
+        self.max_batch_records = min(max_batch_records, PUT_RECORDS_MAX_RECORDS)
+        self.max_batch_bytes = min(max_batch_bytes, PUT_RECORDS_MAX_BYTES)
+        self.metrics = metrics
+        self._buf = []
+        self._buf_bytes = 0
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            "batches_sent": 0,
+            "records_sent": 0,
+            "bytes_sent": 0,
+            "retries": 0,
+            "retried_records": 0,
+            "throttled_records": 0,
+            "dropped_records": 0,
+            "dropped_events": 0,
+        }
+
+    def add(self, data, partition_key, explicit_hash_key=None, events=1):
+        """ events: the events packed into data, ex: a KPL aggregated record or a compressed frame """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        rec_bytes = len(data) + len(partition_key.encode("utf-8"))
+        if rec_bytes > PUT_RECORD_MAX_BYTES:
+            logger.error(
+                f'{{"record_too_large":{rec_bytes},"partition_key":"{partition_key}"}}')
+            self._bump(dropped_records=1, dropped_events=events)
+            return
+        if (len(self._buf) >= self.max_batch_records
+                or self._buf_bytes + rec_bytes > self.max_batch_bytes):
+            self.flush()
+        rec = {"Data": data, "PartitionKey": partition_key}
+        if explicit_hash_key is not None:
+            rec["ExplicitHashKey"] = explicit_hash_key
+        if events != 1:
+            # Not a PutRecords field, left out of the call
+            rec["_events"] = events
+        self._buf.append(rec)
+        self._buf_bytes += rec_bytes
+
+    def flush(self):
+        if not self._buf:
+            return
+        batch = self._buf
+        self._buf = []
+        self._buf_bytes = 0
+        self._dispatch(batch)
+
+    def close(self):
+        self.flush()
+
+    def _dispatch(self, batch):
+        self._send_batch(batch)
+
+    def _bump(self, **counts):
+        with self._stats_lock:
+            for k, v in counts.items():
+                self.stats[k] += v
+
+    def _backoff_ms(self, attempt):
+        # Full jitter, Ref: https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+        return random.uniform(0, min(self.backoff_cap_ms, self.backoff_base_ms * (2 ** attempt)))
+
+    @staticmethod
+    def _events(records):
+        return sum(r.get("_events", 1) for r in records)
+
+    def _throttled(self, records):
+        self._bump(throttled_records=len(records))
+        if self.on_throttle:
+            for rec in records:
+                self.on_throttle(rec)
+
+    def _put_records(self, records):
+        """ Returns the records to re-send & the records to drop, their error will not go away with a retry """
+        if self.pace and self.pace(records) is False:
+            logger.error(
+                f'{{"out_of_time":true,"paced":false,"dropped_records":{len(records)}}}')
+            return [], records
+        t = time.perf_counter()
+        try:
+            resp = self.client.put_records(
+                Records=[{k: v for k, v in r.items() if k != "_events"} if "_events" in r else r for r in records],
+                StreamName=self.stream_name)
+        except ClientError as e:
+            _code = e.response["Error"]["Code"]
+            logger.warning(
+                f'{{"put_records_failed":"{_code}","records":{len(records)}}}')
+            if _code == _THROTTLED:
+                self._throttled(records)
+            return (records, []) if _code in RETRIABLE_ERRORS else ([], records)
+        except (ConnectionError, HTTPClientError) as e:
+            # Connection & read timeouts, the records may or may not have made it. Kinesis is at least once anyway
+            logger.warning(
+                f'{{"put_records_failed":"{type(e).__name__}","records":{len(records)}}}')
+            return records, []
+        finally:
+            if self.metrics:
+                self.metrics.observe(
+                    "put_latency", (time.perf_counter() - t) * 1000)
+        if not resp.get("FailedRecordCount"):
+            return [], []
+        failed, dropped = [], []
+        err_codes = {}
+        for rec, res in zip(records, resp["Records"]):
+            if "ErrorCode" in res:
+                (failed if res["ErrorCode"] in RETRIABLE_ERRORS else dropped).append(rec)
+                err_codes[res["ErrorCode"]] = err_codes.get(
+                    res["ErrorCode"], 0) + 1
+                if res["ErrorCode"] == _THROTTLED and self.on_throttle:
+                    self.on_throttle(rec)
+        self._bump(throttled_records=err_codes.get(_THROTTLED, 0))
+        logger.debug(f'{{"failed_records":{json.dumps(err_codes)}}}')
+        if dropped:
+            logger.error(
+                f'{{"not_retriable":{json.dumps(err_codes)},"dropped_records":{len(dropped)}}}')
+        return failed, dropped
+
+    @staticmethod
+    def _batch_bytes(records):
+        return sum(len(r["Data"]) + len(r["PartitionKey"]) for r in records)
+
+    def _send_batch(self, records):
+        tot_records = len(records)
+        tot_bytes = self._batch_bytes(records)
+        dropped = []
+        attempt = 0
+        while True:
+            records, _dropped = self._put_records(records)
+            dropped += _dropped
+            if not records:
+                break
+            if attempt >= self.max_retries:
+                logger.error(
+                    f'{{"retries_exhausted":true,"dropped_records":{len(records)}}}')
+                break
+            _sleep_ms = self._backoff_ms(attempt)
+            if self.get_remaining_time_in_millis() - _sleep_ms < self.min_remaining_ms:
+                logger.error(
+                    f'{{"out_of_time":true,"dropped_records":{len(records)}}}')
+                break
+            time.sleep(_sleep_ms / 1000)
+            attempt += 1
+            self._bump(retries=1, retried_records=len(records))
+        dropped += records
+        self._bump(
+            batches_sent=1,
+            records_sent=tot_records - len(dropped),
+            bytes_sent=tot_bytes - self._batch_bytes(dropped),
+            dropped_records=len(dropped),
+            dropped_events=self._events(dropped)
+        )
+
+
+class ConcurrentKinesisBatchSender(KinesisBatchSender):
+    """
+    Keep several PutRecords batches in flight from a pool of worker threads sharing one client.
+    The caller keeps generating records while the workers send; the bounded queue
+    applies back pressure so only a few batches are ever held in memory.
+    """
+
+    def __init__(self, client, stream_name, get_remaining_time_in_millis, workers=4, max_queued_batches=None, **kwargs):
+        super().__init__(client, stream_name,
+                         get_remaining_time_in_millis, **kwargs)
+        self._q = queue.Queue(maxsize=max_queued_batches or workers * 2)
+        self._workers = [
+            threading.Thread(target=self._worker, name=f"kinesis_sender_{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for t in self._workers:
+            t.start()
+
+    def _dispatch(self, batch):
+        self._q.put(batch)
+
+    def _worker(self):
+        while True:
+            batch = self._q.get()
+            if batch is None:
+                break
+            try:
+                self._send_batch(batch)
+            except Exception as e:
+                logger.error(
+                    f'{{"sender_worker_error":"{str(e)}","dropped_records":{len(batch)}}}')
+                self._bump(dropped_records=len(batch),
+                           dropped_events=self._events(batch))
+
+    def close(self):
+        self.flush()
+        for _ in self._workers:
+            self._q.put(None)
+        for t in self._workers:
+            t.join()
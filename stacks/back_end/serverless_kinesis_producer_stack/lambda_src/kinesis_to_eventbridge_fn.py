@@ -0,0 +1,156 @@
+"""
+Bridge from the producer stream to an eventbridge bus, behind a lambda event source mapping. The valid events
+of the routed evnt_types go on the bus with their evnt_type as the DetailType, for rules like detail_type
+sales-events. Entries are published 10 per PutEvents call, several calls in flight, only the failed ones retried.
+
+A record with an entry that could not be published is reported in batchItemFailures, lambda retries the batch
+from that record on. Its events & the ones after it may reach the bus twice, consumers see them at least once.
+An entry no retry can publish(over 256KB, rejected by eventbridge) is counted & skipped, it does not block the shard.
+
+    python eventbridge_publisher.py --events 5000 --put-latency-ms 20 --workers 1 8
+"""
+
+import base64
+import json
+import logging
+import os
+import time
+
+import boto3
+
+from event_validation import invalid_reasons
+from eventbridge_publisher import ConcurrentEventBridgeBatchPublisher
+from frame_codec import expand
+from kpl_aggregation import deaggregate
+# From the common lambda layer
+from lambda_metrics import Metrics
+from wire_serializers import decode
+
+
+class GlobalArgs:
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    EVENT_BUS_NAME = os.getenv("EVENT_BUS_NAME", "default")
+    EVNT_SOURCE = os.getenv("EVNT_SOURCE", "miztiik.stream_etl")
+    # Comma separated evnt_types to put on the bus, all - Every evnt_type
+    ROUTED_EVNT_TYPES = os.getenv("ROUTED_EVNT_TYPES", "sales-events")
+    # PutEvents calls in flight
+    PUBLISH_WORKERS = int(os.getenv("PUBLISH_WORKERS", 8))
+    MAX_SEND_RETRIES = int(os.getenv("MAX_SEND_RETRIES", 5))
+    METRICS_NAMESPACE = os.getenv(
+        "METRICS_NAMESPACE", "MiztiikAutomation/EventsBridge")
+    # Share of the skipped events that are still logged in full, 0 - None, 1 - All
+    LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.01))
+    # Stop early & report the rest of the batch for a retry, rather than time out on it
+    DEADLINE_MARGIN_MS = int(os.getenv("DEADLINE_MARGIN_MS", 2000))
+
+
+def set_logging(lv=GlobalArgs.LOG_LEVEL):
+    logging.basicConfig(level=lv)
+    logger = logging.getLogger()
+    logger.setLevel(lv)
+    return logger
+
+
+logger = set_logging()
+metrics = Metrics(
+    GlobalArgs.METRICS_NAMESPACE,
+    dimensions={"event_bus_name": GlobalArgs.EVENT_BUS_NAME},
+    log_sample_rate=GlobalArgs.LOG_SAMPLE_RATE,
+)
+client = boto3.client("events")
+_routed = None if GlobalArgs.ROUTED_EVNT_TYPES == "all" else set(
+    GlobalArgs.ROUTED_EVNT_TYPES.split(","))
+
+
+def to_entries(evnts):
+    """ (detail_type, detail) of the events to publish & the counts of the ones skipped """
+    out = []
+    skipped = {"invalid": 0, "not_routed": 0}
+    for evnt in evnts:
+        if invalid_reasons(evnt):
+            skipped["invalid"] += 1
+            continue
+        if _routed is not None and evnt["evnt_type"] not in _routed:
+            skipped["not_routed"] += 1
+            continue
+        out.append((evnt["evnt_type"], json.dumps(evnt)))
+    return out, skipped
+
+
+def _evnts(blob):
+    evnts = []
+    for p in (p for b in deaggregate(blob) for p in expand(b)):
+        try:
+            evnts.append(decode(p))
+        except ImportError:
+            # A package missing from the function, not a bad event. Fails the batch, the records are retried
+            raise
+        except Exception:
+            if metrics.sample_record():
+                logger.info(json.dumps({"undecodable_event": p[:512].decode(
+                    "utf-8", errors="replace")}))
+    return evnts
+
+
+def lambda_handler(event, context):
+    t = time.perf_counter()
+    records = event.get("Records", [])
+    pub = ConcurrentEventBridgeBatchPublisher(
+        client,
+        GlobalArgs.EVENT_BUS_NAME,
+        context.get_remaining_time_in_millis,
+        workers=GlobalArgs.PUBLISH_WORKERS,
+        max_retries=GlobalArgs.MAX_SEND_RETRIES,
+        min_remaining_ms=GlobalArgs.DEADLINE_MARGIN_MS // 2,
+        metrics=metrics,
+    )
+    stats = {"records": 0, "evnts": 0, "invalid": 0,
+             "not_routed": 0, "bad_records": 0}
+    retry_from = None
+    try:
+        for i, rec in enumerate(records):
+            if context.get_remaining_time_in_millis() < GlobalArgs.DEADLINE_MARGIN_MS:
+                retry_from = i
+                break
+            try:
+                evnts = _evnts(base64.b64decode(rec["kinesis"]["data"]))
+            except ImportError:
+                raise
+            except Exception:
+                # A broken aggregate or frame, a retry would not fix it
+                stats["bad_records"] += 1
+                evnts = []
+            entries, skipped = to_entries(evnts)
+            for _detail_type, _detail in entries:
+                pub.add(GlobalArgs.EVNT_SOURCE,
+                        _detail_type, _detail, ref=i)
+            stats["records"] += 1
+            stats["evnts"] += len(evnts)
+            stats["invalid"] += skipped["invalid"]
+            stats["not_routed"] += skipped["not_routed"]
+    finally:
+        pub.close()
+    if pub.dropped_refs:
+        retry_from = min(pub.dropped_refs + [len(records) if retry_from is None else retry_from])
+
+    metrics.incr("kinesis_records", stats["records"])
+    metrics.incr("events_published", pub.stats["entries_sent"])
+    metrics.incr("events_dropped", pub.stats["dropped_entries"])
+    metrics.incr("events_skipped", stats["invalid"], dims={"reason": "invalid"})
+    metrics.incr("events_skipped", stats["not_routed"], dims={"reason": "not_routed"})
+    # Too large or rejected by eventbridge, a retry of the record would not publish them
+    metrics.incr("events_skipped", pub.stats["skipped_entries"], dims={"reason": "unpublishable"})
+    metrics.incr("put_events_retries", pub.stats["retries"])
+    for _code, _cnt in pub.failed_by_code.items():
+        metrics.incr("failed_entries", _cnt, dims={"error_code": _code})
+    for _cnt in pub.published_per_sec.values():
+        metrics.observe("published_per_sec", _cnt, unit="Count")
+    metrics.flush()
+    stats.update(pub.stats)
+    stats["failed_by_code"] = pub.failed_by_code
+    stats["published_per_sec"] = pub.rate_summary()
+    stats["process_ms"] = round((time.perf_counter() - t) * 1000, 1)
+    logger.info(json.dumps({"batch": stats}))
+    if retry_from is None:
+        return {"batchItemFailures": []}
+    return {"batchItemFailures": [{"itemIdentifier": records[retry_from]["kinesis"]["sequenceNumber"]}]}
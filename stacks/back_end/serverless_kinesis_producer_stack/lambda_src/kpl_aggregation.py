@@ -0,0 +1,251 @@
+"""
+KPL compatible record aggregation, without the protobuf runtime.
+
+    MAGIC(4 bytes) + AggregatedRecord(protobuf) + MD5(AggregatedRecord)
+
+    message AggregatedRecord {
+        repeated string partition_key_table = 1;
+        repeated string explicit_hash_key_table = 2;
+        repeated Record records = 3;
+    }
+    message Record {
+        required uint64 partition_key_index = 1;
+        optional uint64 explicit_hash_key_index = 2;
+        required bytes data = 3;
+        repeated Tag tags = 4;
+    }
+
+Ref: https://github.com/awslabs/amazon-kinesis-producer/blob/master/aggregation-format.md
+"""
+
+import hashlib
+import json
+import time
+
+
+KPL_MAGIC = b"\xf3\x89\x9a\xc2"
+_DIGEST_SIZE = 16
+
+# KPL default AggregationMaxSize
+AGG_MAX_BYTES = 51200
+
+
+def _varint(n):
+    out = bytearray()
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _read_varint(buf, pos):
+    shift = 0
+    n = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return n, pos
+        shift += 7
+
+
+def _len_field(tag, payload):
+    return tag + _varint(len(payload)) + payload
+
+
+def _record_msg(pk_idx, ehk_idx, data):
+    msg = b"\x08" + _varint(pk_idx)
+    if ehk_idx is not None:
+        msg += b"\x10" + _varint(ehk_idx)
+    return msg + _len_field(b"\x1a", data)
+
+
+def is_aggregated(blob):
+    return len(blob) > len(KPL_MAGIC) + _DIGEST_SIZE and blob[:len(KPL_MAGIC)] == KPL_MAGIC
+
+
+def _iter_fields(buf):
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        field_no, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            val, pos = _read_varint(buf, pos)
+        elif wire_type == 2:
+            _l, pos = _read_varint(buf, pos)
+            val = buf[pos:pos + _l]
+            pos += _l
+        elif wire_type == 1:
+            val = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            val = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type:{wire_type}")
+        yield field_no, val
+
+
+def encode(records):
+    """
+    Pack a list of (partition_key, data, explicit_hash_key) tuples into one aggregated record
+    """
+    pk_tbl, ehk_tbl = {}, {}
+    body = bytearray()
+    for pk, data, ehk in records:
+        if pk not in pk_tbl:
+            pk_tbl[pk] = len(pk_tbl)
+        ehk_idx = None
+        if ehk is not None:
+            if ehk not in ehk_tbl:
+                ehk_tbl[ehk] = len(ehk_tbl)
+            ehk_idx = ehk_tbl[ehk]
+        body += _len_field(b"\x1a", _record_msg(pk_tbl[pk], ehk_idx, data))
+    hdr = bytearray()
+    for pk in pk_tbl:
+        hdr += _len_field(b"\x0a", pk.encode("utf-8"))
+    for ehk in ehk_tbl:
+        hdr += _len_field(b"\x12", ehk.encode("utf-8"))
+    msg = bytes(hdr + body)
+    return KPL_MAGIC + msg + hashlib.md5(msg).digest()
+
+
+def decode(blob):
+    """
+    Expand a kinesis record into a list of (partition_key, data, explicit_hash_key) tuples.
+    Records that are not aggregated, or fail the checksum, are returned as is, like the KCL does.
+    """
+    blob = bytes(blob)
+    if not is_aggregated(blob):
+        return [(None, blob, None)]
+    msg = blob[len(KPL_MAGIC):-_DIGEST_SIZE]
+    if hashlib.md5(msg).digest() != blob[-_DIGEST_SIZE:]:
+        return [(None, blob, None)]
+    pk_tbl, ehk_tbl, recs = [], [], []
+    for field_no, val in _iter_fields(msg):
+        if field_no == 1:
+            pk_tbl.append(val.decode("utf-8"))
+        elif field_no == 2:
+            ehk_tbl.append(val.decode("utf-8"))
+        elif field_no == 3:
+            pk_idx, ehk_idx, data = 0, None, b""
+            for r_field_no, r_val in _iter_fields(val):
+                if r_field_no == 1:
+                    pk_idx = r_val
+                elif r_field_no == 2:
+                    ehk_idx = r_val
+                elif r_field_no == 3:
+                    data = r_val
+            recs.append(
+                (pk_tbl[pk_idx], data, ehk_tbl[ehk_idx] if ehk_idx is not None else None))
+    return recs
+
+
+def deaggregate(blob):
+    """ Only the user record payloads of a kinesis record """
+    return [data for _, data, _ in decode(blob)]
+
+
+class RecordAggregator:
+    """
+    Collect user records until the next one would push the aggregated record over max_bytes.
+    The kinesis record takes the partition & explicit hash key of its first user record, as the KPL does.
+    """
+
+    def __init__(self, max_bytes=AGG_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.agg_records = 0
+        self.user_records = 0
+        # User records in the aggregated record returned last
+        self.last_events = 0
+        self._reset()
+
+    def _reset(self):
+        self._recs = []
+        self._pks = set()
+        self._ehks = set()
+        self._size = len(KPL_MAGIC) + _DIGEST_SIZE
+
+    def _added_size(self, pk, data, ehk):
+        # Upper bound, the table indexes are sized as if they were the next new entry
+        _ehk_idx = len(self._ehks) + 1 if ehk is not None else None
+        _sz = len(_len_field(b"\x1a", _record_msg(len(self._pks) + 1, _ehk_idx, data)))
+        if pk not in self._pks:
+            _sz += len(_len_field(b"\x0a", pk.encode("utf-8")))
+        if ehk is not None and ehk not in self._ehks:
+            _sz += len(_len_field(b"\x12", ehk.encode("utf-8")))
+        return _sz
+
+    def add(self, partition_key, data, explicit_hash_key=None):
+        """ Returns a completed (partition_key, data, explicit_hash_key) kinesis record, if any """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        done = None
+        _sz = self._added_size(partition_key, data, explicit_hash_key)
+        if self._recs and self._size + _sz > self.max_bytes:
+            done = self.flush()
+            _sz = self._added_size(partition_key, data, explicit_hash_key)
+        self._recs.append((partition_key, data, explicit_hash_key))
+        self._pks.add(partition_key)
+        if explicit_hash_key is not None:
+            self._ehks.add(explicit_hash_key)
+        self._size += _sz
+        return done
+
+    def flush(self):
+        if not self._recs:
+            return None
+        pk, _, ehk = self._recs[0]
+        blob = encode(self._recs)
+        self.agg_records += 1
+        self.user_records += len(self._recs)
+        self.last_events = len(self._recs)
+        self._reset()
+        return (pk, blob, ehk)
+
+
+# Kinesis shard write limits
+_SHARD_MAX_RECORDS_PER_SEC = 1000
+_SHARD_MAX_BYTES_PER_SEC = 1024 * 1024
+
+
+def _bench(n=20000, rec_bytes=300):
+    """ Round trip check and the records/s a single shard can take with & without aggregation """
+    recs = [(f"store_{i % 5}", json.dumps({"request_id": i, "pad": "x" * (rec_bytes - 30)}).encode(), None)
+            for i in range(n)]
+    agg = RecordAggregator()
+    blobs = [b for b in (agg.add(pk, d) for pk, d, _ in recs) if b]
+    blobs.append(agg.flush())
+
+    t = time.perf_counter()
+    for pk, blob, _ in blobs:
+        decode(blob)
+    decode_secs = time.perf_counter() - t
+    t = time.perf_counter()
+    agg = RecordAggregator()
+    for pk, d, _ in recs:
+        agg.add(pk, d)
+    agg.flush()
+    encode_secs = time.perf_counter() - t
+
+    assert [r for _, blob, _ in blobs for r in decode(blob)] == recs
+
+    _avg_user = sum(len(d) + len(pk) for pk, d, _ in recs) / n
+    _avg_agg = sum(len(b) + len(pk) for pk, b, _ in blobs) / len(blobs)
+    _per_agg = n / len(blobs)
+    return {
+        "user_records": n,
+        "agg_records": len(blobs),
+        "user_records_per_agg": round(_per_agg, 1),
+        "encode_records_per_sec": int(n / encode_secs),
+        "decode_records_per_sec": int(n / decode_secs),
+        "shard_records_per_sec_plain": int(min(_SHARD_MAX_RECORDS_PER_SEC, _SHARD_MAX_BYTES_PER_SEC / _avg_user)),
+        "shard_records_per_sec_aggregated": int(min(_SHARD_MAX_RECORDS_PER_SEC, _SHARD_MAX_BYTES_PER_SEC / _avg_agg) * _per_agg),
+    }
+
+
+if __name__ == "__main__":
+    print(json.dumps(_bench(), indent=2))
@@ -0,0 +1,142 @@
+import base64
+import hashlib
+import json
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from kinesis_batch_sender import PUT_RECORDS_MAX_BYTES, PUT_RECORDS_MAX_RECORDS
+from shard_scheduler import SHARD_MAX_BYTES_PER_SEC, SHARD_MAX_RECORDS_PER_SEC
+
+
+_MAX_HASH_KEY = 2 ** 128 - 1
+
+
+def percentile(vals, p):
+    if not vals:
+        return 0
+    vals = sorted(vals)
+    return vals[int(round(p / 100 * (len(vals) - 1)))]
+
+
+class LocalKinesis:
+    """
+    In process stand-in for the kinesis client calls the producer makes(list_shards, put_records).
+    Every shard accepts max_bytes_per_sec/max_records_per_sec in each one second window,
+    anything over that is failed with ProvisionedThroughputExceededException, like the service does.
+    Accepted records are counted, and optionally appended to sink_path as base64 JSON lines.
+    """
+
+    def __init__(
+        self,
+        shard_count=1,
+        max_bytes_per_sec=SHARD_MAX_BYTES_PER_SEC,
+        max_records_per_sec=SHARD_MAX_RECORDS_PER_SEC,
+        put_latency_ms=0,
+        sink_path=None,
+    ):
+        step = (_MAX_HASH_KEY + 1) // shard_count
+        self.shards = [
+            {
+                "ShardId": f"shardId-{i:012d}",
+                "HashKeyRange": {
+                    "StartingHashKey": str(i * step),
+                    "EndingHashKey": str(_MAX_HASH_KEY if i == shard_count - 1 else (i + 1) * step - 1),
+                },
+                "SequenceNumberRange": {"StartingSequenceNumber": "0"},
+            }
+            for i in range(shard_count)
+        ]
+        self._step = step
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self.max_records_per_sec = max_records_per_sec
+        self.put_latency_ms = put_latency_ms
+        self._lock = threading.Lock()
+        # shard index: [window second, records, bytes]
+        self._windows = [[0, 0, 0] for _ in range(shard_count)]
+        self._seq = 0
+        self._sink = open(sink_path, "a", encoding="utf-8") if sink_path else None
+        self.put_calls = 0
+        self.records = 0
+        self.bytes = 0
+        self.throttled = 0
+        self.latencies_ms = []
+
+    def _shard_idx(self, rec):
+        if rec.get("ExplicitHashKey") is not None:
+            hash_key = int(rec["ExplicitHashKey"])
+        else:
+            hash_key = int.from_bytes(hashlib.md5(
+                rec["PartitionKey"].encode("utf-8")).digest(), "big")
+        return min(hash_key // self._step, len(self.shards) - 1)
+
+    def list_shards(self, **kwargs):
+        return {"Shards": self.shards}
+
+    def put_records(self, Records, StreamName):
+        t = time.perf_counter()
+        _bytes = sum(len(r["Data"]) + len(r["PartitionKey"]) for r in Records)
+        if len(Records) > PUT_RECORDS_MAX_RECORDS or _bytes > PUT_RECORDS_MAX_BYTES:
+            raise ClientError(
+                {"Error": {"Code": "ValidationException", "Message": "PutRecords request over limits"}}, "PutRecords")
+        if self.put_latency_ms:
+            time.sleep(self.put_latency_ms / 1000)
+        res = []
+        failed = 0
+        _ok_bytes = 0
+        _now = int(time.time())
+        with self._lock:
+            for rec in Records:
+                _idx = self._shard_idx(rec)
+                _w = self._windows[_idx]
+                if _w[0] != _now:
+                    _w[:] = [_now, 0, 0]
+                _rec_bytes = len(rec["Data"]) + len(rec["PartitionKey"])
+                if _w[1] + 1 > self.max_records_per_sec or _w[2] + _rec_bytes > self.max_bytes_per_sec:
+                    failed += 1
+                    res.append({
+                        "ErrorCode": "ProvisionedThroughputExceededException",
+                        "ErrorMessage": "Rate exceeded for shard in local stand-in",
+                    })
+                    continue
+                _w[1] += 1
+                _w[2] += _rec_bytes
+                _ok_bytes += _rec_bytes
+                self._seq += 1
+                res.append({"SequenceNumber": str(self._seq),
+                            "ShardId": self.shards[_idx]["ShardId"]})
+                if self._sink:
+                    _data = rec["Data"] if isinstance(
+                        rec["Data"], bytes) else rec["Data"].encode("utf-8")
+                    self._sink.write(json.dumps({
+                        "shard_id": self.shards[_idx]["ShardId"],
+                        "partition_key": rec["PartitionKey"],
+                        "data": base64.b64encode(_data).decode("ascii"),
+                    }) + "\n")
+            self.put_calls += 1
+            self.records += len(Records) - failed
+            self.bytes += _ok_bytes
+            self.throttled += failed
+            self.latencies_ms.append((time.perf_counter() - t) * 1000)
+        return {"FailedRecordCount": failed, "Records": res}
+
+    def close(self):
+        if self._sink:
+            self._sink.close()
+
+    def report(self, elapsed_secs):
+        _attempts = self.records + self.throttled
+        return {
+            "kinesis_records": self.records,
+            "kinesis_records_per_sec": round(self.records / elapsed_secs, 1),
+            "bytes_per_sec": round(self.bytes / elapsed_secs, 1),
+            "put_calls": self.put_calls,
+            "put_latency_ms": {
+                "p50": round(percentile(self.latencies_ms, 50), 3),
+                "p95": round(percentile(self.latencies_ms, 95), 3),
+                "p99": round(percentile(self.latencies_ms, 99), 3),
+            },
+            "throttled_records": self.throttled,
+            "throttle_rate": round(self.throttled / _attempts, 4) if _attempts else 0,
+        }
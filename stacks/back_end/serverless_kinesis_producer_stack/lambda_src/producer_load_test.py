@@ -0,0 +1,108 @@
+"""
+Run the producer lambda_handler on a laptop against a local kinesis stand-in & report the throughput as JSON.
+
+    python producer_load_test.py --budget-ms 10000 --shards 4 --set PRODUCER_WORKERS=4 --set SHARD_SCHEDULER=balance
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+
+class FakeContext:
+    """ Just enough of the lambda context for the producer """
+
+    function_name = "data_producer_local"
+    aws_request_id = "local"
+
+    def __init__(self, budget_ms):
+        self._deadline = time.monotonic() + budget_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the kinesis producer against a local stand-in")
+    parser.add_argument("--budget-ms", type=int, default=10000,
+                        help="Invocation time budget, like the lambda timeout")
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--shard-max-bytes-per-sec", type=int)
+    parser.add_argument("--shard-max-records-per-sec", type=int)
+    parser.add_argument("--put-latency-ms", type=float, default=0,
+                        help="Simulated round trip of every PutRecords call")
+    parser.add_argument("--sink", choices=["memory", "file"], default="memory")
+    parser.add_argument("--sink-path", default="local_kinesis_records.jsonl")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="Producer environment variable, ex: PRODUCER_WORKERS=4")
+    parser.add_argument("--event", default="{}",
+                        help="Invocation event as JSON, ex: {\"replay_offset\": 1024}")
+    parser.add_argument("--label", help="Tag the report, ex: the git commit")
+    parser.add_argument("--out", help="Write the report to this file as well")
+    return parser.parse_args(argv)
+
+
+def run(argv=None):
+    args = _parse_args(argv)
+    # The producer reads its configuration at import time
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("STREAM_NAME", "local_stream")
+    os.environ.setdefault("AWS_REGION", "us-east-1")
+    for kv in args.set:
+        k, _, v = kv.partition("=")
+        os.environ[k] = v
+
+    import stream_data_producer
+    from local_kinesis import LocalKinesis
+
+    _limits = {}
+    if args.shard_max_bytes_per_sec:
+        _limits["max_bytes_per_sec"] = args.shard_max_bytes_per_sec
+    if args.shard_max_records_per_sec:
+        _limits["max_records_per_sec"] = args.shard_max_records_per_sec
+    stand_in = LocalKinesis(
+        shard_count=args.shards,
+        put_latency_ms=args.put_latency_ms,
+        sink_path=args.sink_path if args.sink == "file" else None,
+        **_limits
+    )
+    stream_data_producer.client = stand_in
+    # Keep stdout for the report
+    stream_data_producer.metrics.emit = lambda doc: print(doc, file=sys.stderr)
+
+    t = time.monotonic()
+    resp = stream_data_producer.lambda_handler(
+        json.loads(args.event), FakeContext(args.budget_ms))
+    elapsed_secs = time.monotonic() - t
+    stand_in.close()
+
+    handler_resp = json.loads(resp["body"])["message"]
+    report = {
+        "label": args.label,
+        "budget_ms": args.budget_ms,
+        "shards": args.shards,
+        "producer_env": dict(kv.partition("=")[::2] for kv in args.set),
+        "elapsed_secs": round(elapsed_secs, 3),
+        "events": handler_resp.get("msg_cnt", 0),
+        "events_per_sec": round(handler_resp.get("msg_cnt", 0) / elapsed_secs, 1),
+    }
+    report.update(stand_in.report(elapsed_secs))
+    report["handler"] = handler_resp
+    _out = json.dumps(report, indent=2)
+    print(_out)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(_out)
+    return report
+
+
+if __name__ == "__main__":
+    # Import the producer & common layer modules, wherever we are run from
+    _here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(
+        _here, "..", "..", "lambda_layers", "common", "python"))
+    sys.path.insert(0, _here)
+    run()
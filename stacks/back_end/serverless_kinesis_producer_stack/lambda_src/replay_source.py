@@ -0,0 +1,153 @@
+import datetime
+import json
+import logging
+import mmap
+import os
+import time
+import uuid
+
+logger = logging.getLogger()
+# Bad lines logged in full without a sample_record, the rest are only counted
+_LOG_BAD_LINES = 10
+
+
+class ReplaySource:
+    """
+    Re-emit the events of a newline delimited JSON file, at their original inter-arrival times(from time_field)
+    scaled by speed. speed=0 replays as fast as possible. The file is memory mapped & walked lazily,
+    so multi GB files are never loaded into memory. Events without a usable time_field are not paced.
+
+    Pick up a replay where the last one stopped with start_offset=<resume_offset of that run>
+
+    A line that is not a JSON object(truncated, corrupt) is skipped & counted in replay_bad_lines, a sample of
+    them is logged: the ones sample_record() picks, or the first few
+    """
+
+    def __init__(
+        self,
+        path,
+        speed=1.0,
+        keep_request_ids=True,
+        start_offset=0,
+        time_field="evnt_time",
+        max_wait_secs=0.1,
+        sample_record=None,
+    ):
+        self.path = path
+        self.speed = speed
+        self.keep_request_ids = keep_request_ids
+        self.time_field = time_field
+        self.max_wait_secs = max_wait_secs
+        self.sample_record = sample_record
+        self._f = open(path, "rb")
+        # mmap can not map an empty file
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(
+            path) else b""
+        self._offset = start_offset
+        # Not on a line boundary, skip to the next full line
+        if 0 < start_offset < len(self._mm) and self._mm[start_offset - 1:start_offset] != b"\n":
+            _nl = self._mm.find(b"\n", start_offset)
+            self._offset = len(self._mm) if _nl == -1 else _nl + 1
+        self._pending = None
+        self._pending_offset = None
+        self._first_evnt_ts = None
+        self._start_wall = None
+        self.exhausted = False
+        self.replayed = 0
+        self.bad_lines = 0
+
+    @property
+    def resume_offset(self):
+        return self._pending_offset if self._pending is not None else self._offset
+
+    def _next_line(self):
+        _size = len(self._mm)
+        while self._offset < _size:
+            _start = self._offset
+            _end = self._mm.find(b"\n", _start)
+            if _end == -1:
+                _end = _size
+            self._offset = _end + 1
+            line = self._mm[_start:_end].strip()
+            if line:
+                return _start, line
+        return None, None
+
+    def _parse(self, offset, line):
+        """ The event of a line, None for a bad line """
+        try:
+            evnt = json.loads(line)
+            if isinstance(evnt, dict):
+                return evnt
+        except ValueError:
+            pass
+        self.bad_lines += 1
+        if self.sample_record() if self.sample_record else self.bad_lines <= _LOG_BAD_LINES:
+            logger.info(json.dumps({"bad_replay_line": {"offset": offset, "line": line[:512].decode(
+                "utf-8", errors="replace")}}))
+        return None
+
+    def _evnt_ts(self, evnt):
+        try:
+            _ts = evnt[self.time_field]
+            # fromisoformat of python 3.7 takes no "Z" suffix, only an offset
+            if _ts[-1:] in ("Z", "z"):
+                _ts = _ts[:-1] + "+00:00"
+            return datetime.datetime.fromisoformat(_ts).timestamp()
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _due_in_secs(self, evnt):
+        if not self.speed:
+            return 0
+        _ts = self._evnt_ts(evnt)
+        if _ts is None:
+            return 0
+        if self._first_evnt_ts is None:
+            self._first_evnt_ts = _ts
+            self._start_wall = time.monotonic()
+        return self._start_wall + (_ts - self._first_evnt_ts) / self.speed - time.monotonic()
+
+    def gen_block(self, n):
+        """
+        Up to n events that are due. Returns early(maybe empty) when the next event is not due yet,
+        after waiting at most max_wait_secs, so the caller can keep an eye on its time budget.
+        """
+        evnts = []
+        while len(evnts) < n:
+            if self._pending is None:
+                self._pending_offset, line = self._next_line()
+                if line is None:
+                    self.exhausted = True
+                    break
+                self._pending = self._parse(self._pending_offset, line)
+                if self._pending is None:
+                    continue
+            _wait = self._due_in_secs(self._pending)
+            if _wait > 0:
+                if evnts:
+                    break
+                time.sleep(min(_wait, self.max_wait_secs))
+                if _wait > self.max_wait_secs:
+                    break
+            evnt = self._pending
+            self._pending = None
+            if not self.keep_request_ids:
+                evnt["request_id"] = str(uuid.uuid4())
+            evnts.append(evnt)
+        self.replayed += len(evnts)
+        return evnts
+
+    def close(self):
+        if self._mm:
+            self._mm.close()
+        self._f.close()
+
+    def stats(self):
+        return {
+            "replay_source": self.path,
+            "replayed": self.replayed,
+            "replay_offset": self.resume_offset,
+            "replay_exhausted": self.exhausted,
+            "replay_bad_lines": self.bad_lines,
+        }
@@ -0,0 +1,357 @@
+"""
+Shard count of the producer stream from its write throughput.
+
+ShardAutoscaler.decide() is pure: the open shard count, the per minute sums of IncomingBytes, IncomingRecords &
+WriteProvisionedThroughputExceeded & the times of the recent changes in, a decision out.
+
+    scale out   the peak minute of the last scale_out_mins over scale_out_util of the shards, or any write
+                throttled. Throttled records are demand the Incoming metrics never saw, they are added back
+    scale in    every minute of the last scale_in_mins under scale_in_util
+
+Both size the stream for target_util of the peak minute. The gap between the thresholds & target_util is the
+hysteresis: a stream that was just resized lands on target_util, well clear of both. While the traffic is still
+rising(the peak of the scale out window above the peak of the window before it) a scale out sizes for the peak
+scale_out_lookahead_mins ahead at the current slope instead. A step sized for the current peak is outgrown soon
+after, a morning ramp took 5+ changes of the daily 10 & left none to scale in with. A scale in also waits
+for scale_in_cooldown_secs since the last change & a scale out for scale_out_cooldown_secs. UpdateShardCount
+can at most double or halve the shards & runs at most 10 times per rolling 24 hours per stream. A scale in
+leaves reserve_changes of them for the scale outs.
+
+autoscale() runs one decision against a kinesis & a cloudwatch client, shard_autoscaler_fn.py is the lambda.
+LocalStream stands in for both. To replay a traffic curve against static shard counts & the autoscaler,
+
+    python shard_autoscaler.py --curve diurnal --peak-records-per-sec 6000
+    python shard_autoscaler.py --curve recorded_minutes.json
+"""
+
+import argparse
+import datetime
+import json
+import math
+
+from shard_scheduler import SHARD_MAX_BYTES_PER_SEC, SHARD_MAX_RECORDS_PER_SEC
+
+
+MAX_CHANGES_PER_DAY = 10
+# Stream tag holding the epoch seconds of the changes of the last 24 hours, the lambda keeps no state
+CHANGES_TAG = "shard_autoscaler_changes"
+_DAY_SECS = 86400
+_ZERO = {"bytes": 0, "records": 0, "throttled": 0}
+
+
+class ShardAutoscaler:
+    def __init__(
+        self,
+        min_shards=1,
+        max_shards=64,
+        target_util=0.6,
+        scale_out_util=0.8,
+        scale_in_util=0.3,
+        scale_out_mins=3,
+        scale_in_mins=30,
+        scale_out_cooldown_secs=300,
+        scale_in_cooldown_secs=1800,
+        metric_delay_mins=2,
+        reserve_changes=1,
+        scale_out_lookahead_mins=120,
+        shard_bytes_per_sec=SHARD_MAX_BYTES_PER_SEC,
+        shard_records_per_sec=SHARD_MAX_RECORDS_PER_SEC,
+    ):
+        if not scale_in_util < target_util < scale_out_util:
+            raise ValueError(
+                "scale_in_util < target_util < scale_out_util, or the stream flaps")
+        self.min_shards = min_shards
+        self.max_shards = max_shards
+        self.target_util = target_util
+        self.scale_out_util = scale_out_util
+        self.scale_in_util = scale_in_util
+        self.scale_out_mins = scale_out_mins
+        self.scale_in_mins = scale_in_mins
+        self.scale_out_cooldown_secs = scale_out_cooldown_secs
+        self.scale_in_cooldown_secs = scale_in_cooldown_secs
+        self.metric_delay_mins = metric_delay_mins
+        self.reserve_changes = reserve_changes
+        self.scale_out_lookahead_mins = scale_out_lookahead_mins
+        self.shard_bytes_per_sec = shard_bytes_per_sec
+        self.shard_records_per_sec = shard_records_per_sec
+
+    def demand(self, p):
+        """ Shards a minute of traffic needs at 100%, throttled records counted at the average record size """
+        _records = p["records"] + p["throttled"]
+        _bytes = p["bytes"] * _records / \
+            p["records"] if p["records"] else p["bytes"]
+        return max(_bytes / 60 / self.shard_bytes_per_sec, _records / 60 / self.shard_records_per_sec)
+
+    def _window(self, by_min, end, mins):
+        # No datapoint, no writes in that minute
+        return [by_min.get(m, _ZERO) for m in range(end - mins + 1, end + 1)]
+
+    def decide(self, shards, series, now, changes=()):
+        """
+        shards: open shards. series: [{"ts": epoch secs, "bytes", "records", "throttled"}] per minute sums.
+        changes: epoch secs of the previous changes
+        """
+        by_min = {int(p["ts"] // 60): p for p in series}
+        # Latest minute cloudwatch has complete
+        end = int(now // 60) - self.metric_delay_mins
+        out_w = self._window(by_min, end, self.scale_out_mins)
+        in_w = self._window(by_min, end, self.scale_in_mins)
+        peak_out = max(self.demand(p) for p in out_w)
+        # Demand growth per minute, from the peak of the window before
+        slope = (peak_out - max(self.demand(p) for p in self._window(
+            by_min, end - self.scale_out_mins, self.scale_out_mins))) / self.scale_out_mins
+        peak_in = max(self.demand(p) for p in in_w)
+        throttled = sum(p["throttled"] for p in out_w)
+        recent = [c for c in changes if now - c < _DAY_SECS]
+        since = now - max(recent) if recent else None
+        decision = {
+            "shards": shards,
+            "target": shards,
+            "action": "hold",
+            "util": round(peak_out / shards, 3),
+            "util_scale_in_window": round(peak_in / shards, 3),
+            "throttled": throttled,
+            "rising": slope > 0,
+            "changes_24h": len(recent),
+        }
+        if throttled or peak_out / shards >= self.scale_out_util:
+            target = math.ceil(
+                (peak_out + max(slope, 0) * self.scale_out_lookahead_mins) / self.target_util)
+            if throttled:
+                target = max(target, shards + 1)
+            target = min(target, shards * 2, self.max_shards)
+            _hold = (target <= shards and "at_max_shards") or \
+                (since is not None and since < self.scale_out_cooldown_secs and "scale_out_cooldown") or \
+                (len(recent) >= MAX_CHANGES_PER_DAY and "daily_limit")
+            action, reason = "scale_out", "throttled" if throttled else "high_util"
+        elif peak_in / shards < self.scale_in_util:
+            target = max(math.ceil(peak_in / self.target_util),
+                         math.ceil(shards / 2), self.min_shards)
+            _hold = (target >= shards and "at_min_shards") or \
+                (since is not None and since < self.scale_in_cooldown_secs and "scale_in_cooldown") or \
+                (len(recent) >= MAX_CHANGES_PER_DAY -
+                 self.reserve_changes and "daily_limit")
+            action, reason = "scale_in", "low_util"
+        else:
+            target, _hold, action, reason = shards, "on_target", "hold", "on_target"
+        if _hold:
+            decision["reason"] = _hold
+        else:
+            decision.update({"action": action, "reason": reason, "target": target})
+        return decision
+
+
+def _epoch(ts):
+    return ts.timestamp() if isinstance(ts, datetime.datetime) else float(ts)
+
+
+def read_series(cw_client, stream_name, now, mins):
+    """ Per minute sums of the write metrics of the stream, the last mins minutes """
+    _queries = [
+        {
+            "Id": _id,
+            "MetricStat": {
+                "Metric": {
+                    "Namespace": "AWS/Kinesis",
+                    "MetricName": name,
+                    "Dimensions": [{"Name": "StreamName", "Value": stream_name}],
+                },
+                "Period": 60,
+                "Stat": "Sum",
+            },
+            "ReturnData": True,
+        }
+        for _id, name in (("bytes", "IncomingBytes"), ("records", "IncomingRecords"),
+                          ("throttled", "WriteProvisionedThroughputExceeded"))
+    ]
+    _kwargs = {
+        "MetricDataQueries": _queries,
+        "StartTime": datetime.datetime.fromtimestamp(now - mins * 60, datetime.timezone.utc),
+        "EndTime": datetime.datetime.fromtimestamp(now, datetime.timezone.utc),
+        "ScanBy": "TimestampAscending",
+    }
+    by_ts = {}
+    while True:
+        resp = cw_client.get_metric_data(**_kwargs)
+        for res in resp["MetricDataResults"]:
+            for ts, val in zip(res["Timestamps"], res["Values"]):
+                _ts = _epoch(ts)
+                by_ts.setdefault(_ts, dict(_ZERO, ts=_ts))[res["Id"]] = val
+        if not resp.get("NextToken"):
+            break
+        _kwargs["NextToken"] = resp["NextToken"]
+    return [by_ts[ts] for ts in sorted(by_ts)]
+
+
+def autoscale(kinesis_client, cw_client, policy, stream_name, now, dry_run=False):
+    """ One decision for the stream, applied unless dry_run. The change history lives in a stream tag """
+    summary = kinesis_client.describe_stream_summary(
+        StreamName=stream_name)["StreamDescriptionSummary"]
+    shards = summary["OpenShardCount"]
+    _tags = {t["Key"]: t["Value"] for t in kinesis_client.list_tags_for_stream(
+        StreamName=stream_name)["Tags"]}
+    changes = [int(c) for c in _tags.get(CHANGES_TAG, "").split()]
+    if summary["StreamStatus"] != "ACTIVE":
+        # A resharding is still running, the metrics are of the old shard count
+        return {"shards": shards, "target": shards, "action": "hold", "reason": "stream_updating",
+                "stream_status": summary["StreamStatus"]}
+    series = read_series(cw_client, stream_name, now,
+                         max(policy.scale_out_mins, policy.scale_in_mins) + policy.metric_delay_mins + 1)
+    decision = policy.decide(shards, series, now, changes)
+    decision["dry_run"] = dry_run
+    if decision["action"] != "hold" and not dry_run:
+        kinesis_client.update_shard_count(
+            StreamName=stream_name, TargetShardCount=decision["target"], ScalingType="UNIFORM_SCALING")
+        _recent = [c for c in changes if now - c < _DAY_SECS] + [int(now)]
+        kinesis_client.add_tags_to_stream(
+            StreamName=stream_name, Tags={CHANGES_TAG: " ".join(str(c) for c in _recent)})
+    return decision
+
+
+class LocalStream:
+    """
+    A stream with a traffic curve, standing in for the kinesis(describe_stream_summary, update_shard_count,
+    tags) & the cloudwatch(get_metric_data) calls of autoscale(). A minute takes what the open shards can take,
+    the rest is throttled. A resharding keeps the old count for resharding_secs
+    """
+
+    def __init__(self, curve, shards=1, resharding_secs=120,
+                 shard_bytes_per_sec=SHARD_MAX_BYTES_PER_SEC, shard_records_per_sec=SHARD_MAX_RECORDS_PER_SEC):
+        self.curve = curve
+        self.shards = shards
+        self.resharding_secs = resharding_secs
+        self.shard_bytes_per_sec = shard_bytes_per_sec
+        self.shard_records_per_sec = shard_records_per_sec
+        self.tags = {}
+        self.minutes = []
+        self._pending = None  # (effective at, shards)
+        self.now = 0
+
+    def tick(self, now):
+        """ Take in the traffic of the minute that ends at now """
+        self.now = now
+        if self._pending and now >= self._pending[0]:
+            self.shards = self._pending[1]
+            self._pending = None
+        d = self.curve[len(self.minutes)]
+        _ok = min(1.0, self.shards * self.shard_records_per_sec * 60 / max(d["records"], 1),
+                  self.shards * self.shard_bytes_per_sec * 60 / max(d["bytes"], 1))
+        self.minutes.append({"ts": now - 60, "records": int(d["records"] * _ok), "bytes": int(d["bytes"] * _ok),
+                             "throttled": d["records"] - int(d["records"] * _ok), "shards": self.shards})
+
+    def describe_stream_summary(self, StreamName):
+        return {"StreamDescriptionSummary": {"StreamName": StreamName, "OpenShardCount": self.shards,
+                                             "StreamStatus": "UPDATING" if self._pending else "ACTIVE"}}
+
+    def update_shard_count(self, StreamName, TargetShardCount, ScalingType):
+        if not self.shards / 2 <= TargetShardCount <= self.shards * 2:
+            raise ValueError(
+                "UpdateShardCount can at most double or halve the shards")
+        self._pending = (self.now + self.resharding_secs, TargetShardCount)
+        return {"StreamName": StreamName, "CurrentShardCount": self.shards, "TargetShardCount": TargetShardCount}
+
+    def list_tags_for_stream(self, StreamName):
+        return {"Tags": [{"Key": k, "Value": v} for k, v in self.tags.items()], "HasMoreTags": False}
+
+    def add_tags_to_stream(self, StreamName, Tags):
+        self.tags.update(Tags)
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, ScanBy, NextToken=None, metric_delay_secs=60):
+        # Cloudwatch has the sums of a minute a little after it ends
+        _pts = [p for p in self.minutes if StartTime.timestamp() <= p["ts"] < EndTime.timestamp()
+                and p["ts"] + 60 + metric_delay_secs <= self.now]
+        return {"MetricDataResults": [
+            {"Id": q["Id"], "Timestamps": [datetime.datetime.fromtimestamp(p["ts"], datetime.timezone.utc) for p in _pts
+                                           if p[q["Id"]]],
+             "Values": [p[q["Id"]] for p in _pts if p[q["Id"]]]}
+            for q in MetricDataQueries
+        ]}
+
+
+def simulate(curve, policy=None, shards=1, every_mins=1, resharding_secs=120):
+    """ The curve minute by minute, autoscale() every every_mins when there is a policy, else static shards """
+    stream = LocalStream(curve, shards, resharding_secs)
+    decisions = []
+    for m in range(len(curve)):
+        now = (m + 1) * 60
+        stream.tick(now)
+        if policy and m % every_mins == 0:
+            d = autoscale(stream, stream, policy, "local", now)
+            if d["action"] != "hold":
+                decisions.append(dict(d, minute=m))
+    _demand = sum(d["records"] for d in curve)
+    _throttled = sum(p["throttled"] for p in stream.minutes)
+    _changes = [d["minute"] for d in decisions]
+    return {
+        "shard_hours": round(sum(p["shards"] for p in stream.minutes) / 60, 1),
+        "max_shards": max(p["shards"] for p in stream.minutes),
+        "throttled_pct": round(100 * _throttled / _demand, 3) if _demand else 0,
+        "minutes_throttled": sum(1 for p in stream.minutes if p["throttled"]),
+        "changes": len(decisions),
+        "max_changes_24h": max((sum(1 for c in _changes if m - 1440 < c <= m) for m in _changes), default=0),
+        "decisions": [{k: d[k] for k in ("minute", "action", "reason", "shards", "target", "util", "rising")}
+                      for d in decisions],
+    }
+
+
+def diurnal_curve(peak_records_per_sec, swing=20, days=2, record_bytes=250, spike_at_min=None):
+    """ Per minute traffic, lowest at 04:00 & peak_records_per_sec at 16:00, optionally a 30 minute 2x spike """
+    res = []
+    for m in range(days * 1440):
+        _phase = math.cos(2 * math.pi * ((m % 1440) / 1440 - 16 / 24))
+        _rps = peak_records_per_sec * \
+            (1 / swing + (1 - 1 / swing) * (_phase + 1) / 2)
+        if spike_at_min is not None and spike_at_min <= m % 1440 < spike_at_min + 30:
+            _rps *= 2
+        res.append({"records": int(_rps * 60),
+                   "bytes": int(_rps * 60 * record_bytes)})
+    return res
+
+
+def _load_curve(path):
+    """ Recorded per minute sums, a JSON list of {"records", "bytes"} or of records per second """
+    with open(path) as f:
+        _pts = json.load(f)
+    return [p if isinstance(p, dict) else {"records": int(p * 60), "bytes": int(p * 60 * 250)} for p in _pts]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay a traffic curve against static shard counts & the autoscaler")
+    parser.add_argument("--curve", default="diurnal",
+                        help="diurnal, diurnal_spike or the path of a recorded curve")
+    parser.add_argument("--peak-records-per-sec", type=int, default=6000)
+    parser.add_argument("--swing", type=float, default=20)
+    parser.add_argument("--days", type=int, default=2)
+    parser.add_argument("--static-shards", type=int, nargs="+")
+    parser.add_argument("--every-mins", type=int, default=1,
+                        help="Schedule of the autoscaler lambda")
+    parser.add_argument("--decisions", action="store_true")
+    cli = parser.parse_args()
+
+    if cli.curve in ("diurnal", "diurnal_spike"):
+        _curve = diurnal_curve(cli.peak_records_per_sec, cli.swing, cli.days,
+                               spike_at_min=10 * 60 if cli.curve == "diurnal_spike" else None)
+    else:
+        _curve = _load_curve(cli.curve)
+    _peak = max(math.ceil(ShardAutoscaler().demand(dict(p, throttled=0)))
+                for p in _curve)
+    res = {"minutes": len(_curve), "peak_shards_needed": _peak}
+    # Today's single shard, just enough for the peak & the peak with the headroom the autoscaler keeps
+    _headroom = math.ceil(_peak / ShardAutoscaler().target_util)
+    for n in cli.static_shards or sorted({1, _peak, _headroom}):
+        res[f"static_{n}"] = simulate(_curve, None, n)
+        res[f"static_{n}"].pop("decisions")
+    res["autoscaled"] = simulate(
+        _curve, ShardAutoscaler(), 1, cli.every_mins)
+    # The baseline to beat: static shards for the peak, never throttled
+    _base = simulate(_curve, None, _peak)
+    res["autoscaled"]["vs_static_peak"] = {
+        "static_shards": _peak,
+        "shard_hours": _base["shard_hours"],
+        "throttled_pct": _base["throttled_pct"],
+        "shard_hours_saved_pct": round(100 * (1 - res["autoscaled"]["shard_hours"] / _base["shard_hours"]), 1),
+    }
+    if not cli.decisions:
+        res["autoscaled"].pop("decisions")
+    print(json.dumps(res, indent=2))
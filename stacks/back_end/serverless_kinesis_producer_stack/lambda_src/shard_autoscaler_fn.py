@@ -0,0 +1,87 @@
+import json
+import logging
+import os
+import time
+
+import boto3
+
+# From the common lambda layer
+from lambda_metrics import Metrics
+from shard_autoscaler import ShardAutoscaler, autoscale
+
+
+class GlobalArgs:
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    STREAM_NAME = os.getenv("STREAM_NAME")
+    MIN_SHARDS = int(os.getenv("MIN_SHARDS", 1))
+    MAX_SHARDS = int(os.getenv("MAX_SHARDS", 64))
+    TARGET_UTIL = float(os.getenv("TARGET_UTIL", 0.6))
+    SCALE_OUT_UTIL = float(os.getenv("SCALE_OUT_UTIL", 0.8))
+    SCALE_IN_UTIL = float(os.getenv("SCALE_IN_UTIL", 0.3))
+    SCALE_OUT_COOLDOWN_SECS = int(os.getenv("SCALE_OUT_COOLDOWN_SECS", 300))
+    SCALE_IN_COOLDOWN_SECS = int(os.getenv("SCALE_IN_COOLDOWN_SECS", 1800))
+    # A scale out on rising traffic sizes for the peak this far ahead, 0 - Size for the current peak only
+    SCALE_OUT_LOOKAHEAD_MINS = int(os.getenv("SCALE_OUT_LOOKAHEAD_MINS", 120))
+    # Of the 10 changes per day, kept for the scale outs
+    RESERVE_CHANGES = int(os.getenv("RESERVE_CHANGES", 1))
+    # true - Log & emit the decisions, leave the shard count alone
+    DRY_RUN = os.getenv("DRY_RUN", "false").lower() == "true"
+    METRICS_NAMESPACE = os.getenv(
+        "METRICS_NAMESPACE", "MiztiikAutomation/StreamProducer")
+
+
+def set_logging(lv=GlobalArgs.LOG_LEVEL):
+    logging.basicConfig(level=lv)
+    logger = logging.getLogger()
+    logger.setLevel(lv)
+    return logger
+
+
+logger = set_logging()
+metrics = Metrics(
+    GlobalArgs.METRICS_NAMESPACE,
+    dimensions={"stream_name": f"{GlobalArgs.STREAM_NAME}"},
+)
+kinesis_client = boto3.client("kinesis")
+cw_client = boto3.client("cloudwatch")
+policy = ShardAutoscaler(
+    min_shards=GlobalArgs.MIN_SHARDS,
+    max_shards=GlobalArgs.MAX_SHARDS,
+    target_util=GlobalArgs.TARGET_UTIL,
+    scale_out_util=GlobalArgs.SCALE_OUT_UTIL,
+    scale_in_util=GlobalArgs.SCALE_IN_UTIL,
+    scale_out_cooldown_secs=GlobalArgs.SCALE_OUT_COOLDOWN_SECS,
+    scale_in_cooldown_secs=GlobalArgs.SCALE_IN_COOLDOWN_SECS,
+    scale_out_lookahead_mins=GlobalArgs.SCALE_OUT_LOOKAHEAD_MINS,
+    reserve_changes=GlobalArgs.RESERVE_CHANGES,
+)
+
+
+def lambda_handler(event, context):
+    resp = {"status": False}
+    try:
+        decision = autoscale(kinesis_client, cw_client, policy,
+                             GlobalArgs.STREAM_NAME, time.time(), GlobalArgs.DRY_RUN)
+        logger.info(json.dumps({"shard_autoscaler": decision}))
+        metrics.observe("open_shards", decision["shards"], unit="Count")
+        metrics.observe("target_shards", decision["target"], unit="Count")
+        if "util" in decision:
+            metrics.observe("write_util_pct", round(
+                100 * decision["util"], 1), unit="Percent")
+        if decision["action"] != "hold":
+            metrics.incr("shard_changes", dims={"action": decision["action"]})
+        resp["decision"] = decision
+        resp["status"] = True
+    except Exception as e:
+        logger.error(f"ERROR:{str(e)}")
+        resp["error_message"] = str(e)
+        metrics.incr("errors")
+
+    metrics.flush()
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "message": resp
+        })
+    }
@@ -0,0 +1,182 @@
+import bisect
+import hashlib
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger()
+
+# Ref: https://docs.aws.amazon.com/streams/latest/dev/service-sizes-and-limits.html
+SHARD_MAX_BYTES_PER_SEC = 1024 * 1024
+SHARD_MAX_RECORDS_PER_SEC = 1000
+
+_SHARDS_CACHE = {}
+_SHARDS_CACHE_TTL_SECS = 60
+
+
+def list_open_shards(client, stream_name):
+    """ Open shards of the stream with their hash key ranges, cached for _SHARDS_CACHE_TTL_SECS, re-shards show up """
+    _cached = _SHARDS_CACHE.get(stream_name)
+    if _cached and time.monotonic() - _cached[0] < _SHARDS_CACHE_TTL_SECS:
+        return _cached[1]
+    shards = []
+    _kwargs = {"StreamName": stream_name}
+    while True:
+        resp = client.list_shards(**_kwargs)
+        for s in resp["Shards"]:
+            # Closed shards(after a re-shard) have an ending sequence number
+            if "EndingSequenceNumber" in s["SequenceNumberRange"]:
+                continue
+            shards.append({
+                "shard_id": s["ShardId"],
+                "start": int(s["HashKeyRange"]["StartingHashKey"]),
+                "end": int(s["HashKeyRange"]["EndingHashKey"]),
+            })
+        if not resp.get("NextToken"):
+            break
+        _kwargs = {"NextToken": resp["NextToken"]}
+    shards.sort(key=lambda s: s["start"])
+    _SHARDS_CACHE[stream_name] = (time.monotonic(), shards)
+    return shards
+
+
+class TokenBucket:
+    """
+    rate tokens a second, up to capacity. A take larger than the capacity waits for a full bucket & leaves the
+    bucket in debt, so the next take waits for it to be paid back
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self._ts = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self._ts) * self.rate)
+        self._ts = now
+
+    def wait_secs(self, n):
+        self._refill()
+        _n = min(n, self.capacity)
+        return 0 if self.tokens >= _n else (_n - self.tokens) / self.rate
+
+    def take(self, n):
+        self._refill()
+        self.tokens -= n
+
+
+class ShardScheduler:
+    """
+    Place kinesis records on shards & pace every shard to its write limits.
+        balance - Spread records over the shards with an ExplicitHashKey, to the shard with the fewest bytes so far
+        pin     - Keep the partition key placement(ex: store_id), so per key ordering holds. Only the pacing applies
+    Placement happens when a record is buffered(assign), pacing when a batch is sent(pace). The sender calls
+    pace right before every PutRecords, so batches in flight from several workers share the same per shard budget.
+    A batch that would have to wait past get_remaining_time_in_millis, less min_remaining_ms, is not paced & takes
+    nothing, pace returns False & the sender drops it. Sent anyway it would only be throttled.
+    A shard may send burst_secs of its limit at once & is paced to the rest of the limit, so no one second
+    window sees more than the limit. Batches are capped(batch_limits) so a shard's share of one fits in its burst.
+    """
+
+    def __init__(
+        self,
+        shards,
+        mode="balance",
+        max_bytes_per_sec=SHARD_MAX_BYTES_PER_SEC,
+        max_records_per_sec=SHARD_MAX_RECORDS_PER_SEC,
+        burst_secs=0.2,
+        get_remaining_time_in_millis=None,
+        min_remaining_ms=500,
+    ):
+        if mode not in ("balance", "pin"):
+            raise ValueError(f"Unknown shard scheduler mode:{mode}")
+        self.mode = mode
+        self.shards = shards
+        self._starts = [s["start"] for s in shards]
+        # A burst plus a second of refill stays within the limit, in any one second window
+        self._burst_bytes = int(max_bytes_per_sec * burst_secs)
+        self._burst_records = int(max_records_per_sec * burst_secs)
+        self._buckets = {
+            s["shard_id"]: (TokenBucket(max_bytes_per_sec - self._burst_bytes, self._burst_bytes),
+                            TokenBucket(max_records_per_sec - self._burst_records, self._burst_records))
+            for s in shards
+        }
+        # Midpoint of the range, so the key stays on the shard
+        self._ehks = {s["shard_id"]: str((s["start"] + s["end"]) // 2)
+                      for s in shards}
+        self._assigned_bytes = {s["shard_id"]: 0 for s in shards}
+        self.get_remaining_time_in_millis = get_remaining_time_in_millis
+        self.min_remaining_ms = min_remaining_ms
+        # A batch was dropped, the shards can not take more before the deadline
+        self.out_of_time = False
+        self._lock = threading.Lock()
+        self.shard_stats = {
+            s["shard_id"]: {"records": 0, "bytes": 0, "paced_ms": 0, "throttles": 0}
+            for s in shards
+        }
+
+    def _shard_for_hash(self, hash_key):
+        return self.shards[bisect.bisect_right(self._starts, hash_key) - 1]["shard_id"]
+
+    def shard_for(self, partition_key, explicit_hash_key=None):
+        if explicit_hash_key is not None:
+            return self._shard_for_hash(int(explicit_hash_key))
+        # Kinesis maps the partition key to a 128 bit hash key with MD5
+        return self._shard_for_hash(int.from_bytes(hashlib.md5(partition_key.encode("utf-8")).digest(), "big"))
+
+    def shard_for_record(self, rec):
+        return self.shard_for(rec["PartitionKey"], rec.get("ExplicitHashKey"))
+
+    def batch_limits(self):
+        """ (records, bytes) of a PutRecords batch that no shard's burst is exceeded by """
+        _n = len(self.shards) if self.mode == "balance" else 1
+        return self._burst_records * _n, self._burst_bytes * _n
+
+    def assign(self, partition_key, rec_bytes):
+        """ Returns the ExplicitHashKey to send the record with, None to keep the partition key placement """
+        if self.mode == "pin":
+            return None
+        shard_id = min(self._assigned_bytes, key=self._assigned_bytes.get)
+        self._assigned_bytes[shard_id] += rec_bytes
+        return self._ehks[shard_id]
+
+    def pace(self, records):
+        """
+        Take every shard's share of the batch, then block until the shards had capacity for it. False, without
+        waiting, when that is past the deadline
+        """
+        _load = {}
+        for rec in records:
+            _l = _load.setdefault(self.shard_for_record(rec), [0, 0])
+            _l[0] += 1
+            _l[1] += len(rec["Data"]) + len(rec["PartitionKey"])
+        # Reserved under the lock, so concurrent workers can not both spend the same tokens. The buckets go into
+        # debt, the next batch waits for this one's wait as well. The sleep is outside, workers & throttles go on
+        with self._lock:
+            _wait = max(max(self._buckets[s][0].wait_secs(b), self._buckets[s][1].wait_secs(n))
+                        for s, (n, b) in _load.items())
+            if _wait > 0 and self.get_remaining_time_in_millis and (
+                    _wait * 1000 > self.get_remaining_time_in_millis() - self.min_remaining_ms):
+                self.out_of_time = True
+                return False
+            for s, (n, b) in _load.items():
+                b_bucket, r_bucket = self._buckets[s]
+                b_bucket.take(b)
+                r_bucket.take(n)
+                _st = self.shard_stats[s]
+                _st["records"] += n
+                _st["bytes"] += b
+                if _wait > 0:
+                    _st["paced_ms"] = round(_st["paced_ms"] + _wait * 1000, 3)
+        if _wait > 0:
+            time.sleep(_wait)
+        return True
+
+    def record_throttle(self, rec):
+        # Called from the sender workers
+        with self._lock:
+            self.shard_stats[self.shard_for_record(rec)]["throttles"] += 1
@@ -1,18 +1,68 @@
 import json
 import logging
-import datetime
 import os
-import random
 import uuid
 
 import boto3
+from botocore.config import Config
+
+from event_generator import EventGenerator
+from frame_codec import FRAME_MAX_RECORDS, FrameBuilder
+# From the common lambda layer
+from lambda_metrics import Metrics
+from replay_source import ReplaySource
+from kinesis_batch_sender import ConcurrentKinesisBatchSender, KinesisBatchSender
+from kpl_aggregation import AGG_MAX_BYTES, RecordAggregator
+from shard_scheduler import SHARD_MAX_BYTES_PER_SEC, SHARD_MAX_RECORDS_PER_SEC, ShardScheduler, list_open_shards
+from wire_serializers import get_serializer
 
 
 class GlobalArgs:
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
-    MAX_MSGS_TO_PRODUCE = int(os.getenv("MAX_MSGS_TO_PRODUCE", 5))
+    # 0 - Keep producing until the invocation runs out of time
+    MAX_MSGS_TO_PRODUCE = int(os.getenv("MAX_MSGS_TO_PRODUCE", 0))
+    # 1 - Send from the handler thread, >1 - Send from a pool of workers
+    PRODUCER_WORKERS = int(os.getenv("PRODUCER_WORKERS", 1))
     STREAM_NAME = os.getenv("STREAM_NAME")
     STREAM_AWS_REGION = os.getenv("AWS_REGION")
+    MAX_SEND_RETRIES = int(os.getenv("MAX_SEND_RETRIES", 5))
+    BACKOFF_BASE_MS = int(os.getenv("BACKOFF_BASE_MS", 50))
+    BACKOFF_CAP_MS = int(os.getenv("BACKOFF_CAP_MS", 1000))
+    FLUSH_MARGIN_MS = int(os.getenv("FLUSH_MARGIN_MS", 1500))
+    GEN_BLOCK_SIZE = int(os.getenv("GEN_BLOCK_SIZE", 500))
+    STORE_COUNT = int(os.getenv("STORE_COUNT", 5))
+    # 0 - Uniform, >0 - Zipf skewed towards store_1
+    STORE_ID_SKEW = float(os.getenv("STORE_ID_SKEW", 0))
+    BAD_MSG_RATE = float(os.getenv("BAD_MSG_RATE", 0.1))
+    RETURN_RATE = float(os.getenv("RETURN_RATE", 0.5))
+    # Pack many events into one kinesis record, in the KPL aggregated format
+    AGGREGATE_RECORDS = os.getenv("AGGREGATE_RECORDS", "false").lower() == "true"
+    AGG_MAX_BYTES = int(os.getenv("AGG_MAX_BYTES", AGG_MAX_BYTES))
+    # off - Random placement by request_id, balance - Even load with ExplicitHashKey, pin - Partition by PIN_KEY_FIELD
+    # Several workers without pacing throttle the shards themselves, off becomes balance when PRODUCER_WORKERS > 1
+    SHARD_SCHEDULER = os.getenv("SHARD_SCHEDULER", "off").lower()
+    if SHARD_SCHEDULER == "off" and PRODUCER_WORKERS > 1:
+        SHARD_SCHEDULER = "balance"
+    PIN_KEY_FIELD = os.getenv("PIN_KEY_FIELD", "store_id")
+    SHARD_MAX_BYTES_PER_SEC = int(
+        os.getenv("SHARD_MAX_BYTES_PER_SEC", SHARD_MAX_BYTES_PER_SEC))
+    SHARD_MAX_RECORDS_PER_SEC = int(
+        os.getenv("SHARD_MAX_RECORDS_PER_SEC", SHARD_MAX_RECORDS_PER_SEC))
+    # json, msgpack or avro
+    WIRE_FORMAT = os.getenv("WIRE_FORMAT", "json").lower()
+    # off, gzip or zstd - Compress frames of newline delimited JSON events into one kinesis record
+    FRAME_CODEC = os.getenv("FRAME_CODEC", "off").lower()
+    FRAME_MAX_RECORDS = int(os.getenv("FRAME_MAX_RECORDS", FRAME_MAX_RECORDS))
+    # Replay a newline delimited JSON file(local path or s3://bkt/key) instead of generating events
+    REPLAY_SOURCE = os.getenv("REPLAY_SOURCE")
+    # 1 - Original pace, 10 - 10x faster, max - As fast as possible
+    REPLAY_SPEED = os.getenv("REPLAY_SPEED", "1").lower()
+    REPLAY_KEEP_REQUEST_IDS = os.getenv(
+        "REPLAY_KEEP_REQUEST_IDS", "true").lower() == "true"
+    METRICS_NAMESPACE = os.getenv(
+        "METRICS_NAMESPACE", "MiztiikAutomation/StreamProducer")
+    # Share of the events that are still logged in full, 0 - None, 1 - All
+    LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.001))
 
 
 def set_logging(lv=GlobalArgs.LOG_LEVEL):
@@ -24,107 +74,240 @@ def set_logging(lv=GlobalArgs.LOG_LEVEL):
 
 logger = set_logging()
 
-
-def _rand_coin_flip():
-    r = False
-    if os.getenv("TRIGGER_RANDOM_FAILURES", True):
-        if random.randint(1, 100) > 90:
-            r = True
-    return r
+if GlobalArgs.FRAME_CODEC != "off" and (GlobalArgs.AGGREGATE_RECORDS or GlobalArgs.WIRE_FORMAT != "json"):
+    raise ValueError(
+        "Compressed frames carry newline delimited JSON, they can not be combined with AGGREGATE_RECORDS or a binary WIRE_FORMAT")
+serializer = get_serializer(GlobalArgs.WIRE_FORMAT)
+if GlobalArgs.FRAME_CODEC != "off":
+    # A codec without its package, ex: zstd, fails at cold start & not in every invocation
+    FrameBuilder(GlobalArgs.FRAME_CODEC)
+metrics = Metrics(
+    GlobalArgs.METRICS_NAMESPACE,
+    dimensions={"function_name": os.getenv(
+        "AWS_LAMBDA_FUNCTION_NAME", "data_producer_local")},
+    log_sample_rate=GlobalArgs.LOG_SAMPLE_RATE,
+)
 
 
-def _gen_uuid():
-    return str(uuid.uuid4())
+def _put(sender, scheduler, data, key, events=1):
+    ehk = None
+    if scheduler:
+        ehk = scheduler.assign(key, len(data) + len(key))
+    sender.add(data, key, ehk, events)
 
 
-def send_data(client, data, key, stream_name):
-    logger.info(
-        f'{{"data":{json.dumps(data)}}}')
-    resp = client.put_records(
-        Records=[
-            {
-                "Data": json.dumps(data),
-                "PartitionKey": key},
-        ],
-        StreamName=stream_name
-    )
-    logger.info(f"Response:{resp}")
+def send_data(sender, data, key, packer=None, scheduler=None):
+    _d = serializer.dumps(data)
+    if metrics.sample_record():
+        # Re-use the payload for the log line, unless it is binary
+        _log_d = _d.decode(
+            "utf-8") if serializer.name == "json" else json.dumps(data)
+        logger.info(
+            f'{{"data":{_log_d}}}')
+    if packer is None:
+        _put(sender, scheduler, _d, key)
+        return
+    # KPL aggregator or compressed frame builder
+    _packed = packer.add(key, _d)
+    if _packed:
+        _put(sender, scheduler, _packed[1], _packed[0], packer.last_events)
 
 
+# boto3 clients are thread safe, size the connection pool to match the sender workers
 client = boto3.client(
-    "kinesis", region_name=GlobalArgs.STREAM_AWS_REGION)
+    "kinesis",
+    region_name=GlobalArgs.STREAM_AWS_REGION,
+    config=Config(max_pool_connections=max(
+        10, GlobalArgs.PRODUCER_WORKERS))
+)
 
 
-def lambda_handler(event, context):
-    resp = {"status": False}
-    logger.info(f"Event: {json.dumps(event)}")
+def _replay_path(src):
+    if not src.startswith("s3://"):
+        return src
+    # Fetched once per container, /tmp must be able to hold the file
+    bkt, _, key = src[len("s3://"):].partition("/")
+    _path = os.path.join("/tmp", os.path.basename(key))
+    if not os.path.exists(_path):
+        boto3.client("s3").download_file(bkt, key, _path)
+    return _path
+
+
+def _new_event_source(event):
+    if not GlobalArgs.REPLAY_SOURCE:
+        return EventGenerator(
+            store_count=GlobalArgs.STORE_COUNT,
+            store_skew=GlobalArgs.STORE_ID_SKEW,
+            bad_msg_rate=GlobalArgs.BAD_MSG_RATE,
+            return_rate=GlobalArgs.RETURN_RATE,
+        )
+    return ReplaySource(
+        _replay_path(GlobalArgs.REPLAY_SOURCE),
+        speed=0 if GlobalArgs.REPLAY_SPEED == "max" else float(
+            GlobalArgs.REPLAY_SPEED),
+        keep_request_ids=GlobalArgs.REPLAY_KEEP_REQUEST_IDS,
+        # Continue a replay from the replay_offset of the previous invocation
+        start_offset=int(event.get("replay_offset", 0)),
+        sample_record=metrics.sample_record,
+    )
 
-    _usr_names = ["Aarakocra", "Aasimar", "Beholder", "Bugbear", "Centaur", "Changeling", "Deep Gnome", "Deva", "Dragonborn", "Drow", "Dwarf", "Eladrin", "Elf", "Firbolg", "Genasi", "Githzerai", "Gnoll", "Gnome", "Goblin", "Goliath", "Hag", "Half-Elf",
-                  "Half-Orc", "Halfling"]
 
-    _categories = ["Books", "Games", "Mobiles", "Groceries", "Shoes", "Stationaries", "Laptops",
-                   "Tablets", "Notebooks", "Camera", "Printers", "Monitors", "Speakers", "Projectors", "Cables", "Furniture"]
+def _new_sender(context, scheduler=None):
+    _kwargs = {
+        "max_retries": GlobalArgs.MAX_SEND_RETRIES,
+        "backoff_base_ms": GlobalArgs.BACKOFF_BASE_MS,
+        "backoff_cap_ms": GlobalArgs.BACKOFF_CAP_MS,
+        "on_throttle": scheduler.record_throttle if scheduler else None,
+        "pace": scheduler.pace if scheduler else None,
+        "metrics": metrics,
+    }
+    if scheduler:
+        _kwargs["max_batch_records"], _kwargs["max_batch_bytes"] = scheduler.batch_limits()
+    if GlobalArgs.PRODUCER_WORKERS > 1:
+        return ConcurrentKinesisBatchSender(
+            client,
+            GlobalArgs.STREAM_NAME,
+            context.get_remaining_time_in_millis,
+            workers=GlobalArgs.PRODUCER_WORKERS,
+            **_kwargs
+        )
+    return KinesisBatchSender(
+        client,
+        GlobalArgs.STREAM_NAME,
+        context.get_remaining_time_in_millis,
+        **_kwargs
+    )
 
-    _evnt_types = ["sales-events", "inventory-events"]
 
-    _t_limit = context.get_remaining_time_in_millis()
+def lambda_handler(event, context):
+    resp = {"status": False}
+    logger.debug(f"Event: {json.dumps(event)}")
+
+    evnt_src = None
+    sender = None
+    scheduler = None
+    packer = None
+    msg_cnt = 0
+    p_cnt = 0
+    sale_evnts = 0
+    inventory_evnts = 0
+    tot_sales = 0
+    # evnt_type: [events, sales, returns]
+    by_evnt_type = {}
     try:
-        msg_cnt = 0
-        p_cnt = 0
-        sale_evnts = 0
-        inventory_evnts = 0
-        tot_sales = 0
-        while context.get_remaining_time_in_millis() > 100:
-            # _s = random.randint(1, 500)
-            _s = round(random.random() * 100, 2)
-            _evnt_type = random.choice(_evnt_types)
-            _u = _gen_uuid()
-            if _evnt_type == "sales-events":
-                sale_evnts += 1
-            elif _evnt_type == "inventory-events":
-                inventory_evnts += 1
-            evnt_body = {
-                "request_id": _u,
-                "name": random.choice(_usr_names),
-                "category": random.choice(_categories),
-                "store_id": f"store_{random.randint(1, 5)}",
-                "evnt_time": datetime.datetime.now().isoformat(),
-                "evnt_type": _evnt_type,
-                "new_order": True,
-                "sales": _s,
-                "contact_me": "github.com/miztiik"
-            }
-            # Randomly make the return type order
-            if bool(random.getrandbits(1)):
-                evnt_body.pop("new_order", None)
-                evnt_body["is_return"] = True
-            # Random remove store_id from message
-            if _rand_coin_flip():
-                evnt_body.pop("store_id", None)
-                evnt_body["bad_msg"] = True
-                p_cnt += 1
-            send_data(
-                client,
-                evnt_body,
-                _u,
-                GlobalArgs.STREAM_NAME
+        evnt_src = _new_event_source(event)
+        if GlobalArgs.SHARD_SCHEDULER != "off":
+            scheduler = ShardScheduler(
+                list_open_shards(client, GlobalArgs.STREAM_NAME),
+                mode=GlobalArgs.SHARD_SCHEDULER,
+                max_bytes_per_sec=GlobalArgs.SHARD_MAX_BYTES_PER_SEC,
+                max_records_per_sec=GlobalArgs.SHARD_MAX_RECORDS_PER_SEC,
+                get_remaining_time_in_millis=context.get_remaining_time_in_millis,
+                min_remaining_ms=GlobalArgs.FLUSH_MARGIN_MS // 2,
             )
-            msg_cnt += 1
-            tot_sales += _s
+        sender = _new_sender(context, scheduler)
+        if GlobalArgs.AGGREGATE_RECORDS:
+            packer = RecordAggregator(GlobalArgs.AGG_MAX_BYTES)
+        elif GlobalArgs.FRAME_CODEC != "off":
+            packer = FrameBuilder(GlobalArgs.FRAME_CODEC,
+                                  max_records=GlobalArgs.FRAME_MAX_RECORDS)
+        # Leave enough time to flush the last partial batch
+        while context.get_remaining_time_in_millis() > GlobalArgs.FLUSH_MARGIN_MS:
+            _n = GlobalArgs.GEN_BLOCK_SIZE
+            if GlobalArgs.MAX_MSGS_TO_PRODUCE:
+                _n = min(_n, GlobalArgs.MAX_MSGS_TO_PRODUCE - msg_cnt)
+                if _n <= 0:
+                    break
+            for evnt_body in evnt_src.gen_block(_n):
+                # Replayed events may not follow the sample_records shape
+                _evnt_type = evnt_body.get("evnt_type", "unknown")
+                _sales = evnt_body.get("sales", 0)
+                if _evnt_type == "sales-events":
+                    sale_evnts += 1
+                elif _evnt_type == "inventory-events":
+                    inventory_evnts += 1
+                if evnt_body.get("bad_msg"):
+                    p_cnt += 1
+                _t = by_evnt_type.setdefault(_evnt_type, [0, 0, 0])
+                _t[0] += 1
+                _t[1] += _sales
+                _t[2] += 1 if evnt_body.get("is_return") else 0
+                _key = evnt_body.get("request_id") or str(uuid.uuid4())
+                if GlobalArgs.SHARD_SCHEDULER == "pin":
+                    _key = evnt_body.get(GlobalArgs.PIN_KEY_FIELD, _key)
+                send_data(
+                    sender,
+                    evnt_body,
+                    _key,
+                    packer,
+                    scheduler
+                )
+                msg_cnt += 1
+                tot_sales += _sales
+            if getattr(evnt_src, "exhausted", False):
+                break
+            if scheduler and scheduler.out_of_time:
+                # The shards can not take the events already buffered before the deadline
+                break
 
             logger.debug(
                 f'{{"remaining_time":{context.get_remaining_time_in_millis()}}}')
-        resp["msg_cnt"] = msg_cnt
-        resp["bad_msgs"] = p_cnt
-        resp["sale_evnts"] = sale_evnts
-        resp["inventory_evnts"] = inventory_evnts
-        resp["tot_sales"] = tot_sales
+        if packer:
+            _packed = packer.flush()
+            if _packed:
+                _put(sender, scheduler, _packed[1],
+                     _packed[0], packer.last_events)
         resp["status"] = True
-        logger.info(f'{{"resp":{json.dumps(resp)}}}')
-
     except Exception as e:
         logger.error(f"ERROR:{str(e)}")
         resp["error_message"] = str(e)
+        metrics.incr("errors")
+    finally:
+        # Exactly once, sends the last batch & stops the sender workers, so they do not linger in a re-used container
+        try:
+            if sender:
+                sender.close()
+        except Exception as e:
+            logger.error(f"ERROR:{str(e)}")
+            resp.update(status=False, error_message=str(e))
+            metrics.incr("errors")
+        if isinstance(evnt_src, ReplaySource):
+            evnt_src.close()
+
+    if packer:
+        if isinstance(packer, RecordAggregator):
+            resp["agg_records"] = packer.agg_records
+        else:
+            resp.update(packer.stats())
+    if isinstance(evnt_src, ReplaySource):
+        resp.update(evnt_src.stats())
+        metrics.incr("replay_bad_lines", evnt_src.bad_lines)
+    resp["msg_cnt"] = msg_cnt
+    resp["bad_msgs"] = p_cnt
+    resp["sale_evnts"] = sale_evnts
+    resp["inventory_evnts"] = inventory_evnts
+    resp["tot_sales"] = tot_sales
+    if sender:
+        resp.update(sender.stats)
+    if scheduler:
+        resp["shards"] = scheduler.shard_stats
+    logger.info(f'{{"resp":{json.dumps(resp)}}}')
+
+    metrics.incr("events", msg_cnt)
+    metrics.incr("bad_msgs", p_cnt)
+    if sender:
+        metrics.incr("kinesis_records", sender.stats["records_sent"])
+        metrics.incr("bytes", sender.stats["bytes_sent"], unit="Bytes")
+        metrics.incr("throttled_records", sender.stats["throttled_records"])
+        metrics.incr("retries", sender.stats["retries"])
+        # Events, not kinesis records, an aggregated record or a frame holds many events
+        metrics.incr("dropped_events", sender.stats["dropped_events"])
+    for _evnt_type, (_cnt, _sales, _returns) in by_evnt_type.items():
+        _dims = {"evnt_type": _evnt_type}
+        metrics.incr("events", _cnt, dims=_dims)
+        metrics.incr("tot_sales", round(_sales, 2), unit="None", dims=_dims)
+        metrics.incr("returns", _returns, dims=_dims)
+    metrics.flush()
 
     return {
         "statusCode": 200,
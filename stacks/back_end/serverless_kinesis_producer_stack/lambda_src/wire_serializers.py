@@ -0,0 +1,163 @@
+"""
+Wire formats for the store events.
+
+JSON records go on the stream as is, so the JSON catalog table keeps working. Every other format
+carries a two byte marker(0x00 + format id) in front of the payload. JSON starts with "{" and KPL
+aggregated records with 0xF3, so the consumer can tell them all apart record by record.
+"""
+
+import io
+import json
+import time
+
+
+_MARKER = b"\x00"
+# 0x03 is taken by the compressed frames in frame_codec
+_FMT_IDS = {"msgpack": b"\x01", "avro": b"\x02"}
+_FMT_NAMES = {v[0]: k for k, v in _FMT_IDS.items()}
+
+# Same fields as sample_records/producer_event.json, optional fields are nullable
+EVENT_FIELDS = [
+    ("request_id", "string", False),
+    ("name", "string", False),
+    ("category", "string", False),
+    ("store_id", "string", True),
+    ("evnt_time", "string", False),
+    ("evnt_type", "string", False),
+    ("new_order", "boolean", True),
+    ("sales", "double", False),
+    ("contact_me", "string", False),
+    ("is_return", "boolean", True),
+    ("bad_msg", "boolean", True),
+]
+
+AVRO_SCHEMA = {
+    "type": "record",
+    "name": "StoreEvent",
+    "namespace": "miztiik.sales",
+    "fields": [
+        {"name": n, "type": ["null", t], "default": None} if nullable else {
+            "name": n, "type": t}
+        for n, t, nullable in EVENT_FIELDS
+    ],
+}
+
+
+class JsonSerializer:
+    """ orjson when it is available, else compact stdlib json """
+    name = "json"
+
+    def __init__(self):
+        try:
+            import orjson
+            self._dumps = orjson.dumps
+            self._loads = orjson.loads
+        except ImportError:
+            self._dumps = lambda d: json.dumps(
+                d, separators=(",", ":")).encode("utf-8")
+            self._loads = json.loads
+
+    def dumps(self, evnt):
+        return self._dumps(evnt)
+
+    def loads(self, payload):
+        return self._loads(payload)
+
+
+class MsgpackSerializer:
+    name = "msgpack"
+
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+
+    def dumps(self, evnt):
+        return _MARKER + _FMT_IDS[self.name] + self._msgpack.packb(evnt, use_bin_type=True)
+
+    def loads(self, payload):
+        return self._msgpack.unpackb(payload[2:], raw=False)
+
+
+class AvroSerializer:
+    """ Schemaless avro records, the reader & writer share AVRO_SCHEMA """
+    name = "avro"
+
+    def __init__(self):
+        import fastavro
+        self._fastavro = fastavro
+        self._schema = fastavro.parse_schema(AVRO_SCHEMA)
+
+    def dumps(self, evnt):
+        buf = io.BytesIO()
+        buf.write(_MARKER + _FMT_IDS[self.name])
+        self._fastavro.schemaless_writer(buf, self._schema, evnt)
+        return buf.getvalue()
+
+    def loads(self, payload):
+        evnt = self._fastavro.schemaless_reader(
+            io.BytesIO(payload[2:]), self._schema)
+        # Missing optional fields come back as None, drop them to keep the event shape
+        return {k: v for k, v in evnt.items() if v is not None}
+
+
+_SERIALIZERS = {
+    "json": JsonSerializer,
+    "msgpack": MsgpackSerializer,
+    "avro": AvroSerializer,
+}
+_INSTANCES = {}
+# The third party package of a wire format, the lambda assets ship none of them
+_PACKAGES = {"msgpack": "msgpack", "avro": "fastavro"}
+
+
+def get_serializer(name):
+    if name not in _SERIALIZERS:
+        raise ValueError(f"Unknown wire format:{name}")
+    if name not in _INSTANCES:
+        try:
+            _INSTANCES[name] = _SERIALIZERS[name]()
+        except ImportError as e:
+            raise ImportError(
+                f"Wire format {name} needs the {_PACKAGES[name]} package, it is not in the lambda assets. "
+                f"Add it to a layer or use WIRE_FORMAT=json") from e
+    return _INSTANCES[name]
+
+
+def wire_format(payload):
+    if payload[:1] == _MARKER and len(payload) > 1:
+        return _FMT_NAMES.get(payload[1], "unknown")
+    return "json"
+
+
+def decode(payload):
+    """ Event dict from a single(not aggregated) kinesis record, whatever its wire format """
+    return get_serializer(wire_format(payload)).loads(payload)
+
+
+def _bench(n=20000):
+    from event_generator import EventGenerator
+    evnts = EventGenerator(seed=1).gen_block(n)
+    res = {}
+    for name in _SERIALIZERS:
+        try:
+            ser = get_serializer(name)
+        except ImportError as e:
+            res[name] = {"skipped": str(e)}
+            continue
+        t = time.perf_counter()
+        payloads = [ser.dumps(e) for e in evnts]
+        encode_secs = time.perf_counter() - t
+        t = time.perf_counter()
+        for p in payloads:
+            decode(p)
+        decode_secs = time.perf_counter() - t
+        res[name] = {
+            "encode_records_per_sec": int(n / encode_secs),
+            "decode_records_per_sec": int(n / decode_secs),
+            "avg_bytes_per_record": round(sum(len(p) for p in payloads) / n, 1),
+        }
+    return res
+
+
+if __name__ == "__main__":
+    print(json.dumps(_bench(), indent=2))
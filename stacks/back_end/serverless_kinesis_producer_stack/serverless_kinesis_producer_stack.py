@@ -1,3 +1,5 @@
+from aws_cdk import aws_events as _evnts
+from aws_cdk import aws_events_targets as _evnts_tgt
 from aws_cdk import aws_kinesis as _kinesis
 from aws_cdk import aws_lambda as _lambda
 from aws_cdk import aws_iam as _iam
@@ -28,34 +30,54 @@ class ServerlessKinesisProducerStack(cdk.Stack):
         #######                          #######
         ########################################
 
-        # Read Lambda Code
-        try:
-            with open(
-                "stacks/back_end/serverless_kinesis_producer_stack/lambda_src/stream_data_producer.py",
-                encoding="utf-8",
-                mode="r",
-            ) as f:
-                data_producer_fn_code = f.read()
-        except OSError:
-            print("Unable to read Lambda Function Code")
-            raise
+        # Helper modules shared by our functions, ex: lambda_metrics
+        common_layer = _lambda.LayerVersion(
+            self,
+            "commonLambdaLayer",
+            code=_lambda.Code.from_asset(
+                "stacks/back_end/lambda_layers/common"),
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_7],
+            description="Miztiik Automation: Common helpers for lambda functions",
+        )
 
+        # off | gzip. zstd needs the zstandard package, the lambda assets ship no third party packages
+        _frame_codec = "off"
+        if _frame_codec not in ("off", "gzip"):
+            raise ValueError(
+                f"FRAME_CODEC {_frame_codec} is not supported, zstandard is not in the lambda assets")
+
+        # Ship the whole lambda_src dir, the handler imports its helper modules
         data_producer_fn = _lambda.Function(
             self,
             "streamDataProducerFn",
             function_name=f"data_producer_{construct_id}",
             description="Produce streaming data events and push to Kinesis stream",
             runtime=_lambda.Runtime.PYTHON_3_7,
-            code=_lambda.InlineCode(data_producer_fn_code),
-            handler="index.lambda_handler",
+            code=_lambda.Code.from_asset(
+                "stacks/back_end/serverless_kinesis_producer_stack/lambda_src"),
+            handler="stream_data_producer.lambda_handler",
+            layers=[common_layer],
             timeout=cdk.Duration.seconds(60),
             reserved_concurrent_executions=1,
             environment={
                 "LOG_LEVEL": "INFO",
                 "APP_ENV": "Production",
-                "MAX_MSGS_TO_PRODUCE": "5",
+                "MAX_MSGS_TO_PRODUCE": "0",
+                # Paced by the balance scheduler, unpaced workers throttle the shards of the stream themselves
+                "PRODUCER_WORKERS": "4",
                 "STREAM_NAME": f"{self.data_pipe_stream.stream_name}",
                 "STREAM_AWS_REGION": f"{cdk.Aws.REGION}",
+                "MAX_SEND_RETRIES": "5",
+                "FLUSH_MARGIN_MS": "1500",
+                "GEN_BLOCK_SIZE": "500",
+                "STORE_ID_SKEW": "0",
+                "BAD_MSG_RATE": "0.1",
+                "AGGREGATE_RECORDS": "false",
+                "SHARD_SCHEDULER": "balance",
+                # msgpack & avro need the msgpack & fastavro packages in a layer, the function fails at cold start without them
+                "WIRE_FORMAT": "json",
+                "FRAME_CODEC": _frame_codec,
+                "LOG_SAMPLE_RATE": "0.001",
             },
         )
 
@@ -87,6 +109,78 @@ class ServerlessKinesisProducerStack(cdk.Stack):
             source_account=cdk.Aws.ACCOUNT_ID,
         )
 
+        ########################################
+        #######                          #######
+        #######  Stream Shard Autoscaler #######
+        #######                          #######
+        ########################################
+
+        # Resizes dataPipeStream from its write throughput, every minute. The shard_count above is only the start
+        shard_autoscaler_fn = _lambda.Function(
+            self,
+            "streamShardAutoscalerFn",
+            function_name=f"shard_autoscaler_{construct_id}",
+            description="Scale the shards of the kinesis stream with its write throughput",
+            runtime=_lambda.Runtime.PYTHON_3_7,
+            code=_lambda.Code.from_asset(
+                "stacks/back_end/serverless_kinesis_producer_stack/lambda_src"),
+            handler="shard_autoscaler_fn.lambda_handler",
+            layers=[common_layer],
+            timeout=cdk.Duration.seconds(30),
+            reserved_concurrent_executions=1,
+            environment={
+                "LOG_LEVEL": "INFO",
+                "STREAM_NAME": f"{self.data_pipe_stream.stream_name}",
+                "MIN_SHARDS": "1",
+                "MAX_SHARDS": "16",
+                "TARGET_UTIL": "0.6",
+                "SCALE_OUT_UTIL": "0.8",
+                "SCALE_IN_UTIL": "0.3",
+                "SCALE_OUT_COOLDOWN_SECS": "300",
+                "SCALE_IN_COOLDOWN_SECS": "1800",
+                "SCALE_OUT_LOOKAHEAD_MINS": "120",
+                "RESERVE_CHANGES": "1",
+                "DRY_RUN": "false",
+            },
+        )
+        shard_autoscaler_fn.add_to_role_policy(
+            _iam.PolicyStatement(
+                actions=[
+                    "kinesis:DescribeStreamSummary",
+                    "kinesis:UpdateShardCount",
+                    "kinesis:ListTagsForStream",
+                    "kinesis:AddTagsToStream"
+                ],
+                resources=[
+                    f"{self.data_pipe_stream.stream_arn}"
+                ]
+            )
+        )
+        shard_autoscaler_fn.add_to_role_policy(
+            _iam.PolicyStatement(
+                actions=[
+                    "cloudwatch:GetMetricData"
+                ],
+                resources=["*"]
+            )
+        )
+
+        shard_autoscaler_lg = _logs.LogGroup(
+            self,
+            "streamShardAutoscalerFnLogGroup",
+            log_group_name=f"/aws/lambda/{shard_autoscaler_fn.function_name}",
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+            retention=_logs.RetentionDays.ONE_DAY,
+        )
+
+        shard_autoscaler_schedule = _evnts.Rule(
+            self,
+            "shardAutoscalerSchedule",
+            description="Miztiik Automation: Resize the kinesis stream every minute",
+            schedule=_evnts.Schedule.rate(cdk.Duration.minutes(1)),
+            targets=[_evnts_tgt.LambdaFunction(shard_autoscaler_fn)]
+        )
+
         ###########################################
         ################# OUTPUTS #################
         ###########################################
@@ -104,6 +198,13 @@ class ServerlessKinesisProducerStack(cdk.Stack):
             description="Produce streaming data events and push to Kinesis stream.",
         )
 
+        output_2 = cdk.CfnOutput(
+            self,
+            "StreamShardAutoscaler",
+            value=f"https://console.aws.amazon.com/lambda/home?region={cdk.Aws.REGION}#/functions/{shard_autoscaler_fn.function_name}",
+            description="Scale the shards of the kinesis stream with its write throughput.",
+        )
+
     # properties to share with other stacks
     @property
     def get_stream(self):
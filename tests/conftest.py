@@ -0,0 +1,11 @@
+import os
+import sys
+
+# The lambda & glue modules import their siblings by name, as they are deployed
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for _dir in (
+    "stacks/back_end/serverless_kinesis_producer_stack/lambda_src",
+    "stacks/back_end/lambda_layers/common/python",
+    "stacks/back_end/glue_stacks/glue_job_scripts",
+):
+    sys.path.insert(0, os.path.join(_ROOT, _dir))
@@ -0,0 +1,150 @@
+import json
+
+import pytest
+
+from batch_controller import BatchController, kinesis_options
+
+
+def _ctl(**kwargs):
+    # alpha 1, the smoothed signals are the last batch's, every decision follows from its own batch
+    return BatchController(**dict({"alpha": 1.0}, **kwargs))
+
+
+def _batch(batch_secs, lag_secs=0, row_count=1000, batch_id=1):
+    return {"batch_id": batch_id, "batch_secs": batch_secs, "lag_secs": lag_secs, "row_count": row_count}
+
+
+def test_unknown_goal():
+    with pytest.raises(ValueError):
+        BatchController(goal="cheapest")
+
+
+def test_from_args():
+    _args = {"batch_controller": "Throughput", "latency_slo_secs": "90", "window_bounds_secs": "20,600",
+             "fetch_records_bounds": "1000,20000", "fetch_interval_ms_bounds": "100,2000"}
+    ctl = BatchController.from_args(_args, window_secs=700, shards=4)
+    assert (ctl.goal, ctl.latency_slo_secs, ctl.shards) == ("throughput", 90, 4)
+    # The starting settings are clamped to the bounds
+    assert ctl.settings == {"window_secs": 600,
+                            "fetch_records": 20000, "fetch_interval_ms": 1000}
+    assert BatchController.from_args(
+        dict(_args, batch_controller="off")) is None
+    assert BatchController.from_args(dict(_args, batch_controller="")) is None
+
+
+def test_kinesis_options():
+    assert kinesis_options({"window_secs": 60, "fetch_records": 5000, "fetch_interval_ms": 250}) == {
+        "maxFetchRecordsPerShard": "5000", "idleTimeBetweenReadsInMs": "250", "addIdleTimeBetweenReads": "true"}
+
+
+def test_behind_grows_window_and_fetch():
+    ctl = _ctl(goal="throughput")
+    d = ctl.observe(_batch(95))
+    assert (d["action"], d["reason"]) == ("change", "behind")
+    assert d["new_settings"] == {"window_secs": 150,
+                                 "fetch_records": 150000, "fetch_interval_ms": 666}
+    assert ctl.settings == d["new_settings"] and ctl.changes == 1
+
+
+def test_behind_window_stays_within_the_latency_slo():
+    ctl = _ctl(goal="latency", latency_slo_secs=120)
+    d = ctl.observe(_batch(95))
+    assert d["reason"] == "behind"
+    # 100 + 50% would be 150, over the slo with a 95 sec batch. The window holds, the fetch grows
+    assert d["new_settings"]["window_secs"] == 100
+    assert d["new_settings"]["fetch_records"] == 150000
+
+
+def test_lag_with_short_batches_is_fetch_bound():
+    ctl = _ctl(goal="latency")
+    d = ctl.observe(_batch(30, lag_secs=200))
+    assert d["reason"] == "fetch_bound"
+    assert d["new_settings"] == {"window_secs": 100,
+                                 "fetch_records": 225000, "fetch_interval_ms": 666}
+
+
+def test_batch_at_the_fetch_limit_is_fetch_bound():
+    ctl = _ctl(goal="latency", shards=2, fetch_records=10000)
+    assert ctl.observe(_batch(30, row_count=19000))["reason"] == "fetch_bound"
+    ctl = _ctl(goal="latency", shards=2, fetch_records=10000)
+    assert ctl.observe(_batch(30, row_count=15000))["reason"] != "fetch_bound"
+
+
+def test_over_slo_shrinks_the_window():
+    ctl = _ctl(goal="latency", latency_slo_secs=120)
+    d = ctl.observe(_batch(40))
+    assert d["reason"] == "over_slo"
+    assert d["new_settings"]["window_secs"] == 80
+
+
+@pytest.mark.parametrize("goal, window_secs", [("latency", 66), ("throughput", 150)])
+def test_idle(goal, window_secs):
+    ctl = _ctl(goal=goal)
+    d = ctl.observe(_batch(20))
+    assert d["reason"] == "idle"
+    # Fewer GetRecords calls either way, the latency goal shrinks the window & the throughput goal grows it
+    assert d["new_settings"]["window_secs"] == window_secs
+    assert d["new_settings"]["fetch_interval_ms"] == 1500
+
+
+def test_on_target_holds():
+    ctl = _ctl(goal="latency", window_secs=60)
+    _before = dict(ctl.settings)
+    d = ctl.observe(_batch(30))
+    assert (d["action"], d["reason"]) == ("hold", "on_target")
+    assert "new_settings" not in d and ctl.settings == _before
+
+
+def test_settings_stay_within_bounds():
+    ctl = _ctl(goal="throughput", window_bounds_secs=(10, 120),
+               fetch_records_bounds=(10000, 120000), fetch_interval_ms_bounds=(800, 5000))
+    for i in range(10):
+        ctl.observe(_batch(ctl.settings["window_secs"], batch_id=i))
+    assert ctl.settings == {"window_secs": 120,
+                            "fetch_records": 120000, "fetch_interval_ms": 800}
+
+
+def test_ramp_keeps_stepping():
+    ctl = _ctl(goal="throughput")
+    assert ctl.observe(_batch(95, batch_id=1))["action"] == "change"
+    d = ctl.observe(_batch(140, batch_id=2))
+    assert (d["action"], d["reason"]) == ("change", "behind")
+    assert ctl.settings["window_secs"] == 225
+
+
+def test_turning_around_waits_cooldown_batches():
+    ctl = _ctl(goal="throughput", cooldown_batches=3)
+    ctl.observe(_batch(95, batch_id=1))
+    _after_change = dict(ctl.settings)
+    for i in (2, 3):
+        d = ctl.observe(_batch(10, batch_id=i))
+        assert (d["action"], d["reason"]) == ("hold", "idle_cooldown")
+        assert ctl.settings == _after_change
+    d = ctl.observe(_batch(10, batch_id=4))
+    assert (d["action"], d["reason"]) == ("change", "idle")
+
+
+def test_signals_are_smoothed():
+    ctl = BatchController(goal="throughput", alpha=0.5)
+    ctl.observe(_batch(20))
+    # One slow batch after a quiet one, 0.5 * 140 + 0.5 * 20 = 80 of a 150 sec window
+    d = ctl.observe(_batch(140))
+    assert d["signals"]["smoothed"]["batch_secs"] == 80
+    assert d["reason"] != "behind"
+
+
+def test_audit_gets_every_decision():
+    lines = []
+    ctl = _ctl(goal="latency", audit=lines.append, max_history=2)
+    for i in range(3):
+        ctl.observe(_batch(40, batch_id=i))
+    _decisions = [json.loads(l) for l in lines[-1].split("\n")]
+    assert [d["batch_id"] for d in _decisions] == [1, 2]
+    assert len(ctl.decisions) == 2
+
+
+def test_failing_audit_does_not_stop_the_batch():
+    def _audit(text):
+        raise IOError("s3 unavailable")
+    ctl = _ctl(goal="latency", audit=_audit)
+    assert ctl.observe(_batch(40))["action"] == "change"
@@ -0,0 +1,127 @@
+import datetime
+
+import pytest
+
+from catalog_partitions import (EVENT_TIME_KEYS, INGEST_KEYS, MAX_BATCH, LocalCatalog, PartitionRegistrar,
+                                ingest_values, partition_keys, partition_path, projection_parameters)
+
+_COLUMNS = [{"name": "request_id", "type": "string"},
+            {"name": "sales", "type": "double"}]
+_KEYS = ["evnt_date", "evnt_hour", "evnt_type"]
+
+
+def _registrar(glue, keys=_KEYS, **kwargs):
+    return PartitionRegistrar(glue, "sales_db", "sales_txns", "s3://bkt/stream-etl", keys, **kwargs)
+
+
+def _values(n, evnt_type="sales-events"):
+    _start = datetime.datetime(2021, 3, 20)
+    return [((_start + datetime.timedelta(hours=h)).strftime("%Y-%m-%d"),
+             (_start + datetime.timedelta(hours=h)).strftime("%H"), evnt_type) for h in range(n)]
+
+
+@pytest.mark.parametrize("partition_mode, partition_cols, keys", [
+    ("ingest_time", "evnt_type,store_id", INGEST_KEYS),
+    ("INGEST_TIME", "", INGEST_KEYS),
+    ("event_time", "evnt_type", EVENT_TIME_KEYS + ["evnt_type"]),
+    ("event_time", " evnt_type , store_id ,", EVENT_TIME_KEYS + ["evnt_type", "store_id"]),
+    ("event_time", "", EVENT_TIME_KEYS),
+])
+def test_partition_keys(partition_mode, partition_cols, keys):
+    assert partition_keys(partition_mode, partition_cols) == keys
+
+
+def test_partition_path():
+    assert ingest_values(datetime.datetime(2021, 1, 2, 3, 4)) == (
+        "2021", "01", "02", "03")
+    assert partition_path("s3://bkt/stream-etl/", INGEST_KEYS, ("2021", "01", "02", "03")) == \
+        "s3://bkt/stream-etl/ingest_year=2021/ingest_month=01/ingest_day=02/ingest_hour=03/"
+    assert partition_path("s3://bkt/stream-etl", ["evnt_date"], ["2021-01-02"]) == \
+        "s3://bkt/stream-etl/evnt_date=2021-01-02/"
+
+
+def test_projection_parameters():
+    params = projection_parameters(
+        "s3://bkt/stream-etl/", EVENT_TIME_KEYS + ["evnt_type", "store_id"])
+    assert params["projection.enabled"] == "true"
+    assert params["projection.evnt_date.type"] == "date"
+    assert params["projection.evnt_date.range"] == "2021-01-01,NOW+1DAYS"
+    assert (params["projection.evnt_hour.type"], params["projection.evnt_hour.range"],
+            params["projection.evnt_hour.digits"]) == ("integer", "0,23", "2")
+    assert params["projection.evnt_type.type"] == "enum"
+    assert params["projection.evnt_type.values"].split(",") == [
+        "sales-events", "inventory-events", "unknown"]
+    # No known values, athena needs the value in the query
+    assert params["projection.store_id.type"] == "injected"
+    assert params["storage.location.template"] == \
+        "s3://bkt/stream-etl/evnt_date=${evnt_date}/evnt_hour=${evnt_hour}/evnt_type=${evnt_type}/store_id=${store_id}/"
+
+
+def test_creates_the_table_once():
+    glue = LocalCatalog()
+    reg = _registrar(glue)
+    assert reg.register(_values(1), _COLUMNS)["table_created"] is True
+    assert reg.register(_values(2), _COLUMNS)["table_created"] is False
+    _tbl = glue.get_table(DatabaseName="sales_db", Name="sales_txns")["Table"]
+    assert [k["Name"] for k in _tbl["PartitionKeys"]] == _KEYS
+    assert _tbl["StorageDescriptor"]["Columns"] == _COLUMNS
+    assert glue.calls["CreateTable"] == 1
+
+
+def test_existing_table_with_other_keys():
+    glue = LocalCatalog()
+    _registrar(glue, keys=INGEST_KEYS).register(
+        [("2021", "03", "20", "00")], _COLUMNS)
+    with pytest.raises(ValueError):
+        _registrar(glue).register(_values(1), _COLUMNS)
+
+
+def test_known_partitions_are_not_registered_again():
+    glue = LocalCatalog()
+    reg = _registrar(glue)
+    res = reg.register(_values(3) + _values(3), _COLUMNS)
+    assert (res["partitions_new"], res["partitions_failed"]) == (3, 0)
+    _calls = dict(glue.calls)
+    res = reg.register(_values(3), _COLUMNS)
+    assert (res["partitions_new"], res["catalog_calls"]) == (0, 0)
+    assert glue.calls == _calls
+    _parts = glue.get_partitions(DatabaseName="sales_db", TableName="sales_txns")[
+        "Partitions"]
+    assert sorted(tuple(p["Values"]) for p in _parts) == sorted(_values(3))
+    assert _parts[0]["StorageDescriptor"]["Location"].startswith(
+        "s3://bkt/stream-etl/evnt_date=2021-03-20/")
+
+
+def test_partitions_go_out_in_batches_of_max_batch():
+    glue = LocalCatalog()
+    res = _registrar(glue).register(_values(MAX_BATCH + 50), _COLUMNS)
+    assert res["partitions_new"] == MAX_BATCH + 50
+    assert glue.calls["BatchCreatePartition"] == 2
+
+
+def test_partitions_of_another_writer_count_as_registered():
+    glue = LocalCatalog()
+    _registrar(glue).register(_values(2), _COLUMNS)
+    reg = _registrar(glue)
+    res = reg.register(_values(3), _COLUMNS)
+    assert (res["partitions_new"], res["partitions_failed"]) == (3, 0)
+    assert reg.known == set(_values(3))
+
+
+def test_failed_partitions_are_retried_with_the_next_batch():
+    glue = LocalCatalog(fail_rate=1.0)
+    reg = _registrar(glue, max_attempts=2)
+    res = reg.register(_values(2), _COLUMNS)
+    assert res["partitions_failed"] == 2 and not reg.known
+    assert glue.calls["BatchCreatePartition"] == 2
+    glue.fail_rate = 0.0
+    res = reg.register(_values(2), _COLUMNS)
+    assert (res["partitions_new"], res["partitions_failed"]) == (2, 0)
+
+
+def test_local_catalog_persists(tmp_path):
+    _path = str(tmp_path / "catalog.json")
+    _registrar(LocalCatalog(_path)).register(_values(2), _COLUMNS)
+    _parts = LocalCatalog(_path).get_partitions(
+        DatabaseName="sales_db", TableName="sales_txns")["Partitions"]
+    assert len(_parts) == 2
@@ -0,0 +1,111 @@
+import datetime
+import os
+import re
+import shutil
+import tempfile
+
+import pytest
+
+from aws_cdk import core as cdk
+from stacks.back_end.glue_stacks.glue_curated_table import GlueCuratedTable
+from stacks.back_end.glue_stacks.glue_job_scripts import catalog_partitions
+
+_ROOT = "s3://etl-bkt/stream-etl/"
+_MODES = [("ingest_time", "evnt_type"), ("event_time", "evnt_type"),
+          ("event_time", "evnt_type,store_id")]
+# Day, month & year edges, hour 00 & 23
+_TIMES = [datetime.datetime(2021, 1, 1, 0, 5), datetime.datetime(2021, 12, 31, 23, 59),
+          datetime.datetime(2024, 2, 29, 9, 30), datetime.datetime.now()]
+
+
+def _table(partition_mode, partition_cols):
+    """ TableInput of the synthesized table """
+    app = cdk.App(outdir=tempfile.mkdtemp())
+    stack = cdk.Stack(app, "curatedTableCheck")
+    GlueCuratedTable(stack, "curatedTable", "sales_db", "sales_txns_stream_etl_curated", _ROOT,
+                     partition_mode=partition_mode, partition_cols=partition_cols)
+    _tmpl = app.synth().get_stack_by_name("curatedTableCheck").template
+    return next(r for r in _tmpl["Resources"].values()
+                if r["Type"] == "AWS::Glue::Table")["Properties"]["TableInput"]
+
+
+def _projected(params, key, val):
+    """ Whether athena projects the partition value val of key """
+    _type = params[f"projection.{key}.type"]
+    if _type == "enum":
+        return val in params[f"projection.{key}.values"].split(",")
+    if _type == "integer":
+        lo, hi = (int(x) for x in params[f"projection.{key}.range"].split(","))
+        return len(val) == int(params[f"projection.{key}.digits"]) and lo <= int(val) <= hi
+    if _type == "date":
+        lo, hi = params[f"projection.{key}.range"].split(",")
+        _hi = datetime.date.today() + datetime.timedelta(
+            days=int(re.fullmatch(r"NOW(?:\+(\d+)DAYS)?", hi).group(1) or 0))
+        return lo <= val <= _hi.isoformat() and bool(re.fullmatch(r"\d{4}-\d{2}-\d{2}", val))
+    return _type == "injected"
+
+
+@pytest.fixture(scope="module")
+def spark():
+    pytest.importorskip("pyspark")
+    if not (os.environ.get("JAVA_HOME") or shutil.which("java")):
+        pytest.skip("pyspark needs a java runtime")
+    from pyspark.sql import SparkSession
+    _spark = SparkSession.builder.master("local[1]").appName(
+        "curated_table_check").getOrCreate()
+    yield _spark
+    _spark.stop()
+
+
+def _spark_partition_dirs(spark, keys, partition_mode, times):
+    """
+    Partition directories of a local spark partitionBy write of one row per time, relative to the output root.
+    The values come from spark date_format patterns of the time, not from catalog_partitions
+    """
+    from pyspark.sql import functions as F
+    _ts = F.to_timestamp(F.col("t"))
+    if partition_mode == "event_time":
+        _cols = [F.date_format(_ts, "yyyy-MM-dd"), F.date_format(_ts, "HH")] + [
+            F.lit(catalog_partitions.PARTITION_ENUMS.get(c, ["store_1"])[-1]) for c in keys[2:]]
+    else:
+        _cols = [F.date_format(_ts, p) for p in ("yyyy", "MM", "dd", "HH")]
+    _out = tempfile.mkdtemp()
+    (
+        spark.createDataFrame([(t.strftime("%Y-%m-%d %H:%M:%S"),) for t in times], ["t"])
+        .select("t", *[c.alias(k) for c, k in zip(_cols, keys)])
+        .write.mode("overwrite").partitionBy(*keys).parquet(_out)
+    )
+    return sorted(os.path.relpath(d, _out) + "/" for d, _, files in os.walk(_out)
+                  if any(f.endswith(".parquet") for f in files))
+
+
+@pytest.mark.parametrize("partition_mode, partition_cols", _MODES)
+def test_partition_keys_are_the_etl_keys(partition_mode, partition_cols):
+    tbl = _table(partition_mode, partition_cols)
+    keys = [k["Name"] for k in tbl["PartitionKeys"]]
+    assert keys == catalog_partitions.partition_keys(
+        partition_mode, partition_cols)
+    assert not set(keys) & {c["Name"]
+                            for c in tbl["StorageDescriptor"]["Columns"]}
+
+
+@pytest.mark.parametrize("partition_mode, partition_cols", _MODES)
+def test_projection_matches_the_spark_partition_dirs(spark, partition_mode, partition_cols):
+    tbl = _table(partition_mode, partition_cols)
+    params = tbl["Parameters"]
+    keys = [k["Name"] for k in tbl["PartitionKeys"]]
+    _dirs = _spark_partition_dirs(spark, keys, partition_mode, _TIMES)
+    assert len(_dirs) == len(_TIMES)
+    for t, _dir in zip(_TIMES, _dirs):
+        _written = _ROOT + _dir
+        _kvs = [kv.split("=", 1) for kv in _dir.rstrip("/").split("/")]
+        assert [k for k, _ in _kvs] == keys
+        _projected_path = params["storage.location.template"]
+        for k, v in _kvs:
+            _projected_path = _projected_path.replace(f"${{{k}}}", v)
+            assert _projected(params, k, v), f"{k}={v} is not projected"
+        assert _projected_path == _written
+        if partition_mode != "event_time":
+            # The ingest_time job writes to a path it builds itself, not with partitionBy
+            assert catalog_partitions.partition_path(
+                _ROOT, keys, catalog_partitions.ingest_values(t)) == _written
@@ -0,0 +1,101 @@
+import hashlib
+
+import pytest
+
+from kpl_aggregation import (AGG_MAX_BYTES, KPL_MAGIC, RecordAggregator,
+                             deaggregate, decode, encode, is_aggregated)
+
+
+def _recs(n, rec_bytes=300, ehk=False):
+    return [(f"store_{i % 5}", (f"{i}:" + "x" * rec_bytes).encode(), str(i % 3) if ehk else None)
+            for i in range(n)]
+
+
+def _aggregate(recs, max_bytes=AGG_MAX_BYTES):
+    agg = RecordAggregator(max_bytes)
+    blobs = [b for b in (agg.add(pk, d, ehk) for pk, d, ehk in recs) if b]
+    _last = agg.flush()
+    return blobs + ([_last] if _last else []), agg
+
+
+@pytest.mark.parametrize("ehk", [False, True])
+def test_encode_decode_round_trip(ehk):
+    recs = _recs(50, ehk=ehk)
+    blob = encode(recs)
+    assert is_aggregated(blob)
+    assert decode(blob) == recs
+
+
+def test_round_trip_keeps_empty_data_and_unicode_keys():
+    recs = [("störe_1", b"", None), ("störe_1", b"\x00\xff", "42"), ("店", b"{}", None)]
+    assert decode(encode(recs)) == recs
+
+
+def test_aggregator_round_trip_in_order():
+    recs = _recs(5000)
+    blobs, agg = _aggregate(recs)
+    assert [r for _, blob, _ in blobs for r in decode(blob)] == recs
+    assert agg.user_records == len(recs)
+    assert agg.agg_records == len(blobs) > 1
+
+
+def test_aggregated_record_takes_the_keys_of_its_first_user_record():
+    recs = _recs(500, ehk=True)
+    for pk, blob, ehk in _aggregate(recs)[0]:
+        assert decode(blob)[0][0] == pk
+        assert decode(blob)[0][2] == ehk
+
+
+@pytest.mark.parametrize("max_bytes", [1024, 25 * 1024, AGG_MAX_BYTES])
+def test_aggregated_records_stay_within_max_bytes(max_bytes):
+    for pk, blob, _ in _aggregate(_recs(3000, ehk=True), max_bytes)[0]:
+        assert len(blob) <= max_bytes
+
+
+def test_aggregated_records_are_filled():
+    blobs, _ = _aggregate(_recs(3000), 25 * 1024)
+    # The size estimate is an upper bound, it must not leave much of a record unused
+    assert min(len(b) for _, b, _ in blobs[:-1]) > 0.95 * 25 * 1024
+
+
+def test_last_events_counts_the_record_returned_last():
+    agg = RecordAggregator(2048)
+    _counts = []
+    for pk, d, _ in _recs(100):
+        if agg.add(pk, d):
+            _counts.append(agg.last_events)
+    agg.flush()
+    _counts.append(agg.last_events)
+    assert sum(_counts) == 100
+
+
+def test_user_record_over_max_bytes_goes_alone():
+    big = ("store_1", b"x" * 4096, None)
+    blobs, _ = _aggregate([("store_0", b"a", None), big, ("store_2", b"b", None)], 1024)
+    assert [decode(b) for _, b, _ in blobs] == [[("store_0", b"a", None)], [big], [("store_2", b"b", None)]]
+
+
+def test_plain_record_passes_through():
+    assert decode(b'{"a":1}') == [(None, b'{"a":1}', None)]
+    assert deaggregate(b'{"a":1}') == [b'{"a":1}']
+    # Just the magic, too short to be an aggregate
+    assert deaggregate(KPL_MAGIC) == [KPL_MAGIC]
+
+
+@pytest.mark.parametrize("cut", [1, 16, 100])
+def test_truncated_aggregate_is_returned_as_is(cut):
+    blob = encode(_recs(20))[:-cut]
+    assert decode(blob) == [(None, blob, None)]
+
+
+def test_corrupt_aggregate_fails_the_checksum_and_is_returned_as_is():
+    blob = bytearray(encode(_recs(20)))
+    blob[len(KPL_MAGIC) + 40] ^= 0xFF
+    assert decode(bytes(blob)) == [(None, bytes(blob), None)]
+
+
+def test_corrupt_aggregate_with_a_valid_checksum_raises():
+    # A record pointing at partition key 7 of a table of 1
+    msg = b"\x0a\x01k" + b"\x1a\x05\x08\x07\x1a\x01x"
+    with pytest.raises(IndexError):
+        decode(KPL_MAGIC + msg + hashlib.md5(msg).digest())
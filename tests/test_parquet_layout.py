@@ -0,0 +1,113 @@
+import pytest
+
+from parquet_layout import CODECS, ParquetLayout, _cols, _may_match, scan_bytes
+
+_ARGS = {"parquet_codec": "GZIP", "parquet_row_group_mb": "16", "parquet_page_kb": "512",
+         "parquet_dictionary": "False", "sort_cols": " store_id , category ,"}
+
+
+class _Conf(dict):
+    def set(self, k, v):
+        self[k] = v
+
+
+class _Spark:
+    """ The session calls of ParquetLayout.apply """
+
+    def __init__(self, version="3.1.1"):
+        self.version = version
+        self.conf = _Conf()
+        self.hadoop_conf = _Conf()
+        self._jsc = self
+
+    def hadoopConfiguration(self):
+        return self.hadoop_conf
+
+
+class _Stats:
+    def __init__(self, lo, hi, has_min_max=True):
+        self.min, self.max, self.has_min_max = lo, hi, has_min_max
+
+
+@pytest.mark.parametrize("val, cols", [
+    ("store_id,category", ("store_id", "category")),
+    (" store_id , ,category ", ("store_id", "category")),
+    ("off", ()),
+    ("OFF", ()),
+    ("", ()),
+])
+def test_sort_cols(val, cols):
+    assert _cols(val) == cols
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        ParquetLayout(codec="lz4")
+    assert "snappy" in CODECS
+
+
+def test_from_args():
+    layout = ParquetLayout.from_args(_ARGS)
+    assert layout.to_dict() == {"codec": "gzip", "row_group_mb": 16, "page_kb": 512,
+                                "dictionary": False, "sort_cols": "store_id,category"}
+    with pytest.raises(ValueError):
+        ParquetLayout.from_args(dict(_ARGS, parquet_codec="brotli"))
+
+
+def test_defaults():
+    assert ParquetLayout().to_dict() == {"codec": "snappy", "row_group_mb": 128, "page_kb": 1024,
+                                         "dictionary": True, "sort_cols": "off"}
+
+
+def test_format_options():
+    assert ParquetLayout.from_args(_ARGS).format_options() == {
+        "compression": "gzip", "blockSize": 16 * 1024 * 1024, "pageSize": 512 * 1024}
+
+
+def test_apply_sets_the_session_conf():
+    spark = _Spark()
+    ParquetLayout.from_args(_ARGS).apply(spark)
+    assert spark.conf == {"spark.sql.parquet.compression.codec": "gzip"}
+    assert spark.hadoop_conf == {"parquet.block.size": str(16 * 1024 * 1024), "parquet.page.size": str(512 * 1024),
+                                 "parquet.enable.dictionary": "false"}
+
+
+def test_zstd_needs_spark_3():
+    with pytest.raises(ValueError):
+        ParquetLayout(codec="zstd").apply(_Spark("2.4.3"))
+    spark = _Spark("3.1.1")
+    ParquetLayout(codec="zstd").apply(spark)
+    assert spark.conf["spark.sql.parquet.compression.codec"] == "zstd"
+    # The others are there on glue 2.0
+    for codec in ("snappy", "gzip", "uncompressed"):
+        ParquetLayout(codec=codec).apply(_Spark("2.4.3"))
+
+
+@pytest.mark.parametrize("stats, op, val, may_match", [
+    (_Stats("store_1", "store_3"), "=", "store_2", True),
+    (_Stats("store_1", "store_3"), "=", "store_7", False),
+    (_Stats("a", "c"), "between", ("b", "z"), True),
+    (_Stats("a", "c"), "between", ("d", "z"), False),
+    # No statistics, the row group has to be read
+    (_Stats(None, None, has_min_max=False), "=", "x", True),
+    (None, "=", "x", True),
+])
+def test_row_group_pruning(stats, op, val, may_match):
+    assert _may_match(stats, op, val) is may_match
+
+
+def test_scan_bytes_prunes_sorted_row_groups(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    _stores = [f"store_{i % 10}" for i in range(10000)]
+    _path = str(tmp_path / "sorted.parquet")
+    pq.write_table(pa.table({"store_id": sorted(_stores), "sales": [1.0] * len(_stores)}), _path,
+                   row_group_size=1000)
+    res = scan_bytes([_path], [("store_id", "=", "store_7")], ["store_id", "sales"])
+    assert res["row_groups"] == 10
+    assert res["row_groups_read"] == 1
+    _path = str(tmp_path / "unsorted.parquet")
+    pq.write_table(pa.table({"store_id": _stores, "sales": [1.0] * len(_stores)}), _path,
+                   row_group_size=1000)
+    res = scan_bytes([_path], [("store_id", "=", "store_7")], ["store_id", "sales"])
+    assert res["row_groups_read"] == 10
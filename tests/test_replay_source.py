@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from replay_source import ReplaySource
+
+
+@pytest.fixture
+def replay(tmp_path):
+    _sources = []
+
+    def _open(evnts, **kwargs):
+        _path = tmp_path / "events.jsonl"
+        _path.write_text("".join(json.dumps(e) + "\n" for e in evnts))
+        _sources.append(ReplaySource(str(_path), **kwargs))
+        return _sources[-1]
+    yield _open
+    for s in _sources:
+        s.close()
+
+
+@pytest.mark.parametrize("evnt_time", ["2021-03-20T21:05:00Z", "2021-03-20T21:05:00.250000Z",
+                                       "2021-03-20T21:05:00+00:00", "2021-03-20T23:05:00+02:00"])
+def test_utc_suffixes(replay, evnt_time):
+    src = replay([])
+    # 2021-03-20T21:05:00 UTC
+    assert int(src._evnt_ts({"evnt_time": evnt_time})) == 1616274300
+
+
+@pytest.mark.parametrize("evnt", [{}, {"evnt_time": None}, {"evnt_time": 7}, {"evnt_time": ""},
+                                  {"evnt_time": "yesterday"}, {"evnt_time": "Z"}])
+def test_unusable_times_are_not_paced(replay, evnt):
+    src = replay([])
+    assert src._evnt_ts(evnt) is None
+    assert src._due_in_secs(evnt) == 0
+
+
+def test_paced_by_the_z_timestamps(replay):
+    src = replay([{"request_id": "a", "evnt_time": "2021-03-20T21:05:00Z"},
+                  {"request_id": "b", "evnt_time": "2021-03-20T21:05:10Z"}], speed=1.0, max_wait_secs=0.01)
+    assert [e["request_id"] for e in src.gen_block(10)] == ["a"]
+    # 10 secs of event time later, not due yet
+    assert src.gen_block(10) == []
+    src.speed = 0
+    assert [e["request_id"] for e in src.gen_block(10)] == ["b"]
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+import schema_registry
+from catalog_partitions import columns_of
+from schema_registry import LATEST, SCHEMAS, coerce, field_names, get_schema, glue_columns
+
+_SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                       "sample_records", "producer_event.json")
+_EVENT = {"request_id": "r1", "name": "Kristy", "category": "Books", "store_id": "store_7",
+          "evnt_time": "2021-03-20T21:05:00", "evnt_type": "sales-events", "new_order": True,
+          "sales": 12.5, "contact_me": "github.com/miztiik", "is_return": False, "bad_msg": False}
+
+
+def test_versions():
+    assert get_schema("latest") == (LATEST, SCHEMAS[LATEST])
+    assert get_schema("1") == (1, SCHEMAS[1])
+    with pytest.raises(ValueError):
+        get_schema(99)
+
+
+def test_v1_is_seeded_from_the_sample():
+    assert schema_registry.seed_from_sample(_SAMPLE) == SCHEMAS[1]["fields"]
+
+
+def test_later_versions_keep_the_earlier_fields():
+    for v in range(2, LATEST + 1):
+        assert set(field_names(v - 1)) <= set(field_names(v))
+
+
+@pytest.mark.parametrize("version", sorted(SCHEMAS))
+def test_glue_columns(version):
+    _cols = glue_columns(version)
+    assert [c["name"] for c in _cols] == field_names(version)
+    # Glue & athena type names
+    assert {c["type"] for c in _cols} <= {"string", "double", "boolean"}
+    assert {c["name"]: c["type"] for c in _cols}["sales"] == "double"
+
+
+@pytest.mark.parametrize("version", sorted(SCHEMAS))
+def test_spark_schema_maps_to_the_glue_columns(version):
+    pytest.importorskip("pyspark")
+    schema = schema_registry.spark_schema(version, extra_string_cols=("_decode_reasons",))
+    assert all(f.nullable for f in schema.fields)
+    assert columns_of(schema, partition_keys=("_decode_reasons",)) == glue_columns(version)
+
+
+def test_coerce_valid_event():
+    vals, reasons = coerce(_EVENT)
+    assert reasons == []
+    assert vals == tuple(_EVENT[n] for n in field_names())
+
+
+def test_coerce_wrong_types():
+    vals, reasons = coerce(dict(_EVENT, sales="12.5", is_return="no", store_id=7))
+    assert reasons == ["bad_type_store_id", "bad_type_sales", "bad_type_is_return"]
+    _row = dict(zip(field_names(), vals))
+    assert (_row["store_id"], _row["sales"], _row["is_return"]) == (None, None, None)
+
+
+def test_coerce_numbers():
+    _row = dict(zip(field_names(), coerce(dict(_EVENT, sales=12))[0]))
+    assert _row["sales"] == 12.0 and isinstance(_row["sales"], float)
+    # bool is an int in python, it is not a double
+    vals, reasons = coerce(dict(_EVENT, sales=True))
+    assert reasons == ["bad_type_sales"]
+
+
+def test_coerce_missing_fields_are_none():
+    vals, reasons = coerce({"request_id": "r1"}, version=1)
+    assert reasons == []
+    assert vals == ("r1",) + (None,) * (len(field_names(1)) - 1)
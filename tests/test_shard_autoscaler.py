@@ -0,0 +1,136 @@
+import functools
+
+import pytest
+
+from shard_autoscaler import (MAX_CHANGES_PER_DAY, LocalStream, ShardAutoscaler,
+                              autoscale, diurnal_curve)
+
+_NOW = 1700000000
+
+
+def _policy(**kwargs):
+    # As the shard autoscaler stack deploys it
+    return ShardAutoscaler(**dict({"max_shards": 16, "scale_out_lookahead_mins": 120, "reserve_changes": 1}, **kwargs))
+
+
+def _run(curve, policy):
+    """ simulate(), keeping the per minute view of the stream & the (epoch secs, action) of the changes """
+    stream = LocalStream(curve)
+    changes = []
+    for m in range(len(curve)):
+        now = (m + 1) * 60
+        stream.tick(now)
+        d = autoscale(stream, stream, policy, "local", now)
+        if d["action"] != "hold":
+            changes.append((now, d["action"]))
+    return stream.minutes, changes
+
+
+def _series(shards_util, mins=40, records_per_sec=1000, throttled=0):
+    """ Flat per minute sums at shards_util of one shard's records limit, up to the minute before _NOW """
+    _end = _NOW // 60
+    return [{"ts": m * 60, "records": int(shards_util * records_per_sec * 60), "bytes": 0, "throttled": throttled}
+            for m in range(_end - mins, _end)]
+
+
+def _sawtooth(days=2, period_mins=90, low_rps=200, high_rps=12000):
+    # Traffic that would have the stream resized every period, were there no cooldown & daily limit
+    return [{"records": (high_rps if (m // period_mins) % 2 else low_rps) * 60,
+             "bytes": (high_rps if (m // period_mins) % 2 else low_rps) * 60 * 250}
+            for m in range(days * 1440)]
+
+
+_CURVES = {
+    "diurnal": lambda: diurnal_curve(6000),
+    "diurnal_spike": lambda: diurnal_curve(6000, spike_at_min=600),
+    "sawtooth": _sawtooth,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _replay(curve):
+    # Two days a minute at a time, shared by the tests of the same curve
+    return _run(_CURVES[curve](), _policy())
+
+
+def test_no_throttling_after_the_first_ramp():
+    minutes, _ = _replay("diurnal")
+    throttled = [m for m, p in enumerate(minutes) if p["throttled"]]
+    # Starting at 1 shard, the first minutes until the first change takes effect
+    assert throttled and max(throttled) < 5
+
+
+def test_spike_throttles_only_until_the_scale_out_lands():
+    minutes, _ = _replay("diurnal_spike")
+    throttled = [m for m, p in enumerate(minutes) if p["throttled"] and m >= 5]
+    # Per spike, the metric delay & the resharding time
+    assert throttled
+    assert all(600 <= m % 1440 < 610 for m in throttled)
+
+
+@pytest.mark.parametrize("curve", sorted(_CURVES))
+def test_changes_stay_within_the_daily_limit(curve):
+    _, changes = _replay(curve)
+    assert changes
+    assert max(sum(1 for c, _ in changes if t - 86400 < c <= t) for t, _ in changes) <= MAX_CHANGES_PER_DAY
+
+
+def test_sawtooth_hits_the_daily_limit_not_throttling_forever():
+    minutes, changes = _replay("sawtooth")
+    assert max(p["shards"] for p in minutes) == 16
+    assert max(sum(1 for c, _ in changes if t - 86400 < c <= t) for t, _ in changes) == MAX_CHANGES_PER_DAY
+    # The scale ins stop first, the last changes of a day are left for the next peak
+    for t, action in changes:
+        if action == "scale_in":
+            assert sum(1 for c, _ in changes if t - 86400 < c < t) < MAX_CHANGES_PER_DAY - _policy().reserve_changes
+
+
+def test_cooldowns_between_changes():
+    policy = _policy()
+    _, changes = _replay("sawtooth")
+    assert {a for _, a in changes} == {"scale_out", "scale_in"}
+    for (prev, _), (cur, action) in zip(changes, changes[1:]):
+        assert cur - prev >= (policy.scale_out_cooldown_secs if action == "scale_out"
+                              else policy.scale_in_cooldown_secs)
+
+
+def test_scale_out_holds_in_cooldown():
+    policy = _policy()
+    d = policy.decide(4, _series(4 * 0.95), _NOW, changes=[_NOW - 60])
+    assert (d["action"], d["reason"], d["target"]) == ("hold", "scale_out_cooldown", 4)
+    d = policy.decide(4, _series(4 * 0.95), _NOW,
+                      changes=[_NOW - policy.scale_out_cooldown_secs])
+    assert d["action"] == "scale_out" and d["target"] > 4
+
+
+def test_scale_in_holds_in_cooldown():
+    policy = _policy()
+    d = policy.decide(8, _series(8 * 0.1), _NOW,
+                      changes=[_NOW - policy.scale_in_cooldown_secs + 60])
+    assert (d["action"], d["reason"], d["target"]) == ("hold", "scale_in_cooldown", 8)
+    d = policy.decide(8, _series(8 * 0.1), _NOW,
+                      changes=[_NOW - policy.scale_in_cooldown_secs])
+    assert (d["action"], d["target"]) == ("scale_in", 4)
+
+
+def test_scale_in_leaves_reserve_changes_for_scale_outs():
+    policy = _policy(reserve_changes=2)
+    _changes = [_NOW - 7200 - i * 600
+                for i in range(MAX_CHANGES_PER_DAY - policy.reserve_changes)]
+    d = policy.decide(8, _series(8 * 0.1), _NOW, changes=_changes)
+    assert (d["action"], d["reason"]) == ("hold", "daily_limit")
+    d = policy.decide(8, _series(8 * 0.1), _NOW, changes=_changes[1:])
+    assert d["action"] == "scale_in"
+    # The reserved changes are there for a scale out
+    d = policy.decide(4, _series(4 * 0.95), _NOW, changes=_changes)
+    assert d["action"] == "scale_out"
+    d = policy.decide(4, _series(4 * 0.95), _NOW,
+                      changes=_changes + [_NOW - 3600] * policy.reserve_changes)
+    assert (d["action"], d["reason"]) == ("hold", "daily_limit")
+
+
+def test_changes_older_than_a_day_do_not_count():
+    policy = _policy()
+    d = policy.decide(8, _series(8 * 0.1), _NOW,
+                      changes=[_NOW - 86400 - i for i in range(MAX_CHANGES_PER_DAY)])
+    assert (d["action"], d["changes_24h"]) == ("scale_in", 0)